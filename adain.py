@@ -14,57 +14,103 @@ def calc_mean_std(feat, eps=1e-5):
     return feat_mean, feat_std
 
 
+def calc_mean_std_masked(feat, mask, eps=1e-5):
+    # like calc_mean_std, but only over the positions where the (N, 1, H, W) mask is non-zero
+    size = feat.size()
+    assert (len(size) == 4)
+    assert (mask.size()[2:] == size[2:])
+    N, C = size[:2]
+    mask = mask.to(feat.dtype).view(N, 1, -1)
+    count = mask.sum(dim=2).clamp(min=2)
+    feat_flat = feat.view(N, C, -1)
+    feat_mean = (feat_flat * mask).sum(dim=2) / count
+    feat_var = ((feat_flat - feat_mean.unsqueeze(2)).pow(2) * mask).sum(dim=2) / (count - 1) + eps
+    return feat_mean.view(N, C, 1, 1), feat_var.sqrt().view(N, C, 1, 1)
+
+
 def adaptive_instance_normalization(content_feat, style_feat):
     assert (content_feat.size()[:2] == style_feat.size()[:2])
-    size = content_feat.size()
     style_mean, style_std = calc_mean_std(style_feat)
-    content_mean, content_std = calc_mean_std(content_feat)
+    return adaptive_instance_normalization_from_stats(content_feat, style_mean, style_std)
+
+
+def adaptive_instance_normalization_from_stats(content_feat, style_mean, style_std, content_mask=None):
+    # style_mean and style_std are (N, C, 1, 1), e.g. precomputed by calc_mean_std
+    # if content_mask (N, 1, H, W) is given, the content statistics are only taken where it is non-zero
+    assert (content_feat.size()[:2] == style_mean.size()[:2] == style_std.size()[:2])
+    size = content_feat.size()
+    if content_mask is None:
+        content_mean, content_std = calc_mean_std(content_feat)
+    else:
+        content_mean, content_std = calc_mean_std_masked(content_feat, content_mask)
 
     normalized_feat = (content_feat - content_mean.expand(
         size)) / content_std.expand(size)
     return normalized_feat * style_std.expand(size) + style_mean.expand(size)
 
 
-def _calc_feat_flatten_mean_std(feat):
-    # takes 3D feat (C, H, W), return mean and std of array within channels
-    assert (feat.size()[0] == 3)
-    assert (isinstance(feat, torch.FloatTensor))
-    feat_flatten = feat.view(3, -1)
+def _subsample(feat_flatten, max_samples=None, random=False):
+    # keep at most max_samples positions of the (..., C, L) array, evenly strided or at random
+    length = feat_flatten.size(-1)
+    if not max_samples or length <= max_samples:
+        return feat_flatten
+    if random:
+        index = torch.randperm(length, device=feat_flatten.device)[:max_samples]
+        return feat_flatten[..., index]
+    return feat_flatten[..., ::-(-length // max_samples)]
+
+
+def _calc_feat_flatten_mean_std(feat, max_samples=None, random=False):
+    # takes 3D feat (C, H, W) or 4D feat (N, C, H, W), return the flattened (and possibly subsampled) array,
+    # and mean and std of array within channels
+    assert (feat.size()[-3] == 3)
+    feat_flatten = _subsample(feat.reshape(*feat.size()[:-2], -1), max_samples, random)
     mean = feat_flatten.mean(dim=-1, keepdim=True)
     std = feat_flatten.std(dim=-1, keepdim=True)
     return feat_flatten, mean, std
 
 
-def _mat_sqrt(x):
-    U, D, V = torch.svd(x)
-    return torch.mm(torch.mm(U, D.pow(0.5).diag()), V.t())
+def _mat_sqrt(x, inverse=False):
+    # (inverse) square root of the symmetric positive definite (..., 3, 3) matrix x, via its eigendecomposition
+    D, V = torch.linalg.eigh(x)
+    D = D.clamp(min=1e-12).pow(-0.5 if inverse else 0.5)
+    return torch.matmul(V * D.unsqueeze(-2), V.transpose(-2, -1))
+
+
+def coral_stats(feat, max_samples=None, random=False):
+    # takes 3D feat (C, H, W) or 4D feat (N, C, H, W), return mean, std and (normalised covariance + identity)
+    # within channels; with max_samples, they are estimated from at most that many pixels (strided, or random
+    # if random is True), and the covariance is scaled up to the full pixel count as if every pixel were used
+    num_pixels = feat.size(-1) * feat.size(-2)
+    feat_f, feat_f_mean, feat_f_std = _calc_feat_flatten_mean_std(feat, max_samples, random)
+    feat_f_norm = (feat_f - feat_f_mean) / feat_f_std
+    feat_f_cov_eye = torch.matmul(feat_f_norm, feat_f_norm.transpose(-2, -1)) * (num_pixels / feat_f.size(-1)) + \
+        torch.eye(3, device=feat.device, dtype=feat.dtype)
+    return feat_f_mean, feat_f_std, feat_f_cov_eye
 
 
-def coral(source, target):
-    # assume both source and target are 3D array (C, H, W)
+def coral(source, target, max_samples=None, random=False):
+    # source and target are 3D (C, H, W) or 4D (N, C, H, W) arrays on any device, and a batch of N targets
+    # applies to a batch of N sources; see coral_stats for max_samples and random
+    return coral_from_stats(source, coral_stats(source, max_samples, random),
+                            coral_stats(target, max_samples, random))
+
+
+def coral_from_stats(source, source_stats, target_stats):
+    # map the colours of `source` (C, H, W) or (N, C, H, W) from the distribution described by `source_stats`
+    # to the one described by `target_stats`, both as returned by coral_stats
     # Note: flatten -> f
 
-    source_f, source_f_mean, source_f_std = _calc_feat_flatten_mean_std(source)
-    source_f_norm = (source_f - source_f_mean.expand_as(
-        source_f)) / source_f_std.expand_as(source_f)
-    source_f_cov_eye = \
-        torch.mm(source_f_norm, source_f_norm.t()) + torch.eye(3)
-
-    target_f, target_f_mean, target_f_std = _calc_feat_flatten_mean_std(target)
-    target_f_norm = (target_f - target_f_mean.expand_as(
-        target_f)) / target_f_std.expand_as(target_f)
-    target_f_cov_eye = \
-        torch.mm(target_f_norm, target_f_norm.t()) + torch.eye(3)
-
-    source_f_norm_transfer = torch.mm(
-        _mat_sqrt(target_f_cov_eye),
-        torch.mm(torch.inverse(_mat_sqrt(source_f_cov_eye)),
-                 source_f_norm)
-    )
-
-    source_f_transfer = source_f_norm_transfer * \
-                        target_f_std.expand_as(source_f_norm) + \
-                        target_f_mean.expand_as(source_f_norm)
+    source_f_mean, source_f_std, source_f_cov_eye = source_stats
+    target_f_mean, target_f_std, target_f_cov_eye = target_stats
+
+    # Normalising, the covariance transform and de-normalising fold into one affine map, weight @ x + bias
+    transform = torch.matmul(_mat_sqrt(target_f_cov_eye), _mat_sqrt(source_f_cov_eye, inverse=True))
+    weight = target_f_std * transform / source_f_std.transpose(-2, -1)
+    bias = target_f_mean - torch.matmul(weight, source_f_mean)
+
+    source_f = source.reshape(*source.size()[:-2], -1)
+    source_f_transfer = torch.matmul(weight, source_f).add_(bias)
 
     return source_f_transfer.view(source.size())
 
@@ -0,0 +1,169 @@
+"""
+A disk store for the uploads and results of the app's sessions.
+
+Files are named by the hash of their content (or of the inputs they were made from), in one folder per session, so
+sessions never overwrite each other's files and a file that is already stored is not written again. The store keeps
+the total size under a byte budget by deleting the least recently used files, and deletes files unused for longer
+than a time to live.
+"""
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from hashlib import blake2b
+from pathlib import Path
+from threading import Lock
+from time import time
+from typing import Callable, Optional, Tuple
+
+from PIL import Image
+from streamlit import cache_resource
+
+from utils import image_hash
+
+ARTIFACT_ROOT = Path('temp_images')
+MAX_BYTES = 1024 * 2 ** 20  # 1 GiB over all sessions
+TTL_SECONDS = 2 * 60 * 60  # Files unused for 2 hours are deleted
+
+
+class ArtifactStore:
+    """
+    Content-addressed files under `root/<session id>/`, evicted least recently used first under a byte budget and
+    after a time to live. Safe to share between sessions.
+    """
+
+    def __init__(self, root: Path = ARTIFACT_ROOT, max_bytes: int = MAX_BYTES, ttl: float = TTL_SECONDS):
+        """
+        :param root: The folder holding one folder per session. Files already in it are adopted.
+            Default `ARTIFACT_ROOT`.
+        :param max_bytes: The most bytes the stored files take together. Default `MAX_BYTES`.
+        :param ttl: The seconds after its last use that a file is deleted. Default `TTL_SECONDS`.
+        """
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = Lock()
+        # Path -> (size, last use), least recently used first
+        self._entries: 'OrderedDict[Path, Tuple[int, float]]' = OrderedDict()
+        self._total = 0
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        stored = [(path, path.stat()) for path in self.root.glob('*/*') if path.is_file()]
+        for path, stat in sorted(stored, key=lambda item: item[1].st_mtime):
+            if path.suffix == '.part':  # Left by an interrupted write
+                path.unlink(missing_ok=True)
+            else:
+                self._entries[path] = (stat.st_size, stat.st_mtime)
+                self._total += stat.st_size
+        with self._lock:
+            self._evict()
+
+    @property
+    def total_bytes(self) -> int:
+        """The bytes the stored files take together."""
+        return self._total
+
+    def session_dir(self, session_id: str) -> Path:
+        """The folder of a session's files."""
+        return self.root.joinpath(session_id)
+
+    def put_bytes(self, session_id: str, data: bytes, suffix: str = '') -> Path:
+        """
+        Store encoded data, e.g. an uploaded file, as it is.
+        :param suffix: The file extension including the dot, e.g. '.png'. Default ''
+        :return: The path of the file, named by the hash of `data`.
+        """
+        name = blake2b(data, digest_size=16).hexdigest() + suffix
+        return self._put(self.session_dir(session_id).joinpath(name), lambda f: f.write(data))
+
+    def put_image(self, session_id: str, image: Image.Image, key: Optional[str] = None,
+                  image_format: str = 'PNG') -> Path:
+        """
+        Store an image, encoding it only if it is not stored yet.
+        :param key: The name of the file without extension, e.g. a hash of the inputs the image was made from.
+            Default None, which uses the hash of the image's pixels.
+        :param image_format: The PIL format to encode in. Default 'PNG'.
+        :return: The path of the file.
+        """
+        name = f'{key or image_hash(image)}.{image_format.lower()}'
+        return self._put(self.session_dir(session_id).joinpath(name), lambda f: image.save(f, format=image_format))
+
+    def get(self, session_id: str, name: str) -> Optional[Path]:
+        """The path of a stored file, marking it as used, or None if it is not stored or has expired."""
+        path = self.session_dir(session_id).joinpath(name)
+        with self._lock:
+            return path if self._touch(path) else None
+
+    def _touch(self, path: Path) -> bool:
+        """
+        Mark a stored file as used, after evicting expired files, so that sessions that only read evict them too.
+        Needs the lock held.
+        :return: Boolean, whether the file is stored.
+        """
+        self._evict()
+        entry = self._entries.get(path)
+        if entry is None or not path.exists():  # Also deleted files, e.g. by `delete_session` in another process
+            return False
+        now = time()
+        self._entries[path] = (entry[0], now)
+        self._entries.move_to_end(path)
+        os.utime(path, (now, now))  # So that the order survives restarts
+        return True
+
+    def _put(self, path: Path, write: Callable) -> Path:
+        with self._lock:
+            if self._touch(path):
+                return path  # Same content, nothing to write
+            # Created under the lock, so that `_evict` cannot remove the folder before the file is in it
+            path.parent.mkdir(parents=True, exist_ok=True)
+            f = tempfile.NamedTemporaryFile(dir=path.parent, suffix='.part', delete=False)
+
+        # Written to a temporary file first, so that no session sees a partly written file
+        try:
+            with f:
+                write(f)
+            os.replace(f.name, path)
+        except BaseException:
+            Path(f.name).unlink(missing_ok=True)
+            raise
+
+        size = path.stat().st_size
+        with self._lock:
+            old = self._entries.pop(path, None)  # Another session may have written the same file meanwhile
+            self._total += size - (old[0] if old else 0)
+            now = time()
+            self._entries[path] = (size, now)
+            os.utime(path, (now, now))  # The same time as in the entries, as in `_touch`
+            self._evict()
+        return path
+
+    def _evict(self):
+        """Delete expired files, then the least recently used ones until under the budget. Needs the lock held."""
+        expired = time() - self.ttl
+        while self._entries:
+            path, (size, last_use) = next(iter(self._entries.items()))
+            if last_use >= expired and self._total <= self.max_bytes:
+                break
+            del self._entries[path]
+            self._total -= size
+            path.unlink(missing_ok=True)
+            try:
+                path.parent.rmdir()  # Only succeeds once the session has no files left
+            except OSError:
+                pass
+
+    def delete_session(self, session_id: str):
+        """Delete all of a session's files."""
+        directory = self.session_dir(session_id)
+        with self._lock:
+            for path in [path for path in self._entries if path.parent == directory]:
+                self._total -= self._entries.pop(path)[0]
+                path.unlink(missing_ok=True)
+            # Also any files written outside the store. A file another thread is still writing may be left behind
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+@cache_resource(show_spinner=False)
+def get_store() -> ArtifactStore:
+    """The store shared by all sessions."""
+    return ArtifactStore()
@@ -0,0 +1,317 @@
+"""
+Stylize many images without the Streamlit app.
+
+Example:
+    python batch.py --content imgs/test_images/content --styles imgs/test_images/style --alphas 0.7 1.0 \
+        --top-k 1 --output results
+
+Images are decoded and transformed on worker threads, stylized in batches (the content is encoded once for all of
+its styles and alphas) and written on a writer thread, with bounded queues between the stages. Finished outputs are
+recorded in `progress.jsonl` in the output directory, so an interrupted run picks up where it stopped. An image that
+cannot be read or stylized is recorded as failed and skipped; the run goes on with the others and exits with status 1.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from hashlib import blake2b
+from pathlib import Path
+from queue import Queue
+from threading import Lock, Thread
+from time import time
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple, Union
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.utils import save_image
+
+from masks import CompactMask
+from stylization import StyleTransferEngine
+from utils import composite_with_mask
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg'}
+PROGRESS_FILE = 'progress.jsonl'
+
+
+class Loaded(NamedTuple):
+    """A content image with everything the model stage needs, prepared on a worker thread."""
+    content_path: Path
+    content: Image.Image
+    content_tensor: torch.Tensor
+    style_paths: List[Path]  # The distinct styles of the content's variants
+    style_tensors: List[torch.Tensor]
+    variants: List[Tuple[Path, float]]  # The (style path, alpha) pairs still to render
+    failed: List[Tuple[Path, float, BaseException]]  # The (style path, alpha, error) of variants with unreadable styles
+
+
+def list_images(directory: Path) -> List[Path]:
+    """List the image files of a directory, sorted by name."""
+    return sorted(p for p in directory.iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS)
+
+
+def read_manifest(manifest: Path, default_alphas: List[float]) -> Dict[Path, List[Tuple[Path, float]]]:
+    """
+    Read a CSV manifest with `content` and `style` columns and an optional `alpha` column.
+    Relative paths are resolved against the manifest's directory.
+    :return: A dictionary from content path to its list of (style path, alpha) pairs.
+    """
+    jobs: Dict[Path, List[Tuple[Path, float]]] = {}
+    with manifest.open(newline='') as f:
+        for row in csv.DictReader(f):
+            content = manifest.parent.joinpath(row['content'])
+            style = manifest.parent.joinpath(row['style'])
+            alphas = [float(row['alpha'])] if row.get('alpha') else default_alphas
+            jobs.setdefault(content, []).extend((style, alpha) for alpha in alphas)
+    return jobs
+
+
+def output_name(content_path: Path, style_path: Path, alpha: float) -> str:
+    """
+    The file name of one output image, also its key in the progress file. It ends in a short hash of the two source
+    paths, so that images with the same name in different directories (e.g. `a/img.jpg` and `b/img.jpg`) get
+    different outputs.
+    """
+    digest = blake2b(f'{content_path.resolve()}\n{style_path.resolve()}'.encode(), digest_size=4).hexdigest()
+    return f'{content_path.stem}__{style_path.stem}__alpha_{round(alpha * 100)}__{digest}.png'
+
+
+def read_progress(output_dir: Path) -> Set[str]:
+    """The names of the outputs finished by earlier runs. Failed outputs are not included, so a rerun retries them."""
+    progress_file = output_dir.joinpath(PROGRESS_FILE)
+    if not progress_file.exists():
+        return set()
+    with progress_file.open() as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    return {entry['output'] for entry in entries if 'failed' not in entry}
+
+
+class Writer:
+    """Saves outputs on a background thread and records each finished one in the progress file."""
+
+    def __init__(self, output_dir: Path, queue_size: int, track_progress: bool = True):
+        """
+        :param output_dir: The directory for the outputs and the progress file.
+        :param queue_size: The maximum number of outputs waiting to be written.
+        :param track_progress: Boolean to record the finished outputs in `PROGRESS_FILE`. Default True
+        """
+        self.output_dir = output_dir
+        self.track_progress = track_progress
+        self.queue: Queue = Queue(maxsize=queue_size)  # Blocks the model stage when writing falls behind
+        self.error: Optional[BaseException] = None
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, name: str, image):
+        """Queue an output, a PIL.Image object or a tensor from `stylize`, for saving as `name`."""
+        if self.error:
+            raise self.error
+        self.queue.put((name, image))
+
+    def fail(self, name: str, error: BaseException):
+        """Queue a failed output, recorded in the progress file with its error after the outputs queued before it."""
+        self.put(name, error)
+
+    def close(self):
+        """Wait for all queued outputs to be written."""
+        self.queue.put(None)
+        self._thread.join()
+        if self.error:
+            raise self.error
+
+    def _run(self):
+        with self.output_dir.joinpath(PROGRESS_FILE).open('a') if self.track_progress else nullcontext() as progress:
+            while (item := self.queue.get()) is not None:
+                if self.error:
+                    continue
+                name, image = item
+                if isinstance(image, BaseException):
+                    if progress is not None:
+                        entry = {'output': name, 'failed': f'{type(image).__name__}: {image}'}
+                        progress.write(json.dumps(entry) + '\n')
+                        progress.flush()
+                    continue
+                try:
+                    # Write to a temporary file first, so an interrupted run never leaves a truncated output
+                    temp_path = self.output_dir.joinpath(name + '.part')
+                    if isinstance(image, Image.Image):
+                        image.save(temp_path, format='PNG')
+                    else:
+                        save_image(image, str(temp_path), format='PNG')
+                    os.replace(temp_path, self.output_dir.joinpath(name))
+                    if progress is not None:
+                        progress.write(json.dumps({'output': name}) + '\n')
+                        progress.flush()
+                except BaseException as e:
+                    self.error = e
+
+
+def run(jobs: Dict[Path, List[Tuple[Path, float]]], output_dir: Path, top_k: int = 0, workers: int = 4,
+        queue_size: int = 8, batch_size: int = 4, content_size: int = 0, style_size: int = 0,
+        preserve_color: bool = True, vgg_path: str = 'models/vgg_normalised.pth',
+        decoder_path: str = 'models/decoder.pth', precision: str = 'fp32', channels_last: bool = False,
+        fast_segmentation: bool = False):
+    """
+    Stylize every (content, style, alpha) job, skipping outputs recorded in the progress file.
+    :param jobs: A dictionary from content path to its list of (style path, alpha) pairs.
+    :param output_dir: The directory for the outputs and the progress file.
+    :param top_k: If positive, only the union of the `top_k` largest SAM segments is stylized. Default 0 (everything).
+    :param workers: The number of threads decoding and transforming images. Default 4.
+    :param queue_size: The maximum number of images waiting between two stages. Default 8.
+    :param batch_size: The number of variants decoded together in one decoder forward. Default 4.
+    :param precision: The inference mode of the networks, see `precision.py`. Default 'fp32'.
+    :param channels_last: Boolean to run the networks in the channels_last memory format. Default False
+    :param fast_segmentation: Boolean to find the `top_k` segments with `segmentation.fast_masks`. Default False
+    The remaining parameters are as in `stylization.stylize`.
+    :return: The number of outputs that failed.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    done = read_progress(output_dir)
+    pending = {content: [(style, alpha) for style, alpha in variants
+                         if output_name(content, style, alpha) not in done]
+               for content, variants in jobs.items()}
+    pending = {content: variants for content, variants in pending.items() if variants}
+    total = sum(len(variants) for variants in pending.values())
+    print(f'{total} outputs to render, {len(done)} already done')
+    if not total:
+        return 0
+
+    engine = StyleTransferEngine.get(vgg_path, decoder_path, 'cpu' if precision == 'int8' else None,
+                                     precision=precision, channels_last=channels_last)
+    if top_k > 0:
+        from segmentation import init, perform_segmentation  # Only needed, and only imported, for segments
+        model_file, model_type, device = init()
+
+    styles: Dict[Path, Union[Image.Image, BaseException]] = {}  # An unreadable style is kept as its error
+    styles_lock = Lock()
+
+    def load_style(path: Path) -> Union[Image.Image, BaseException]:
+        with styles_lock:
+            if path not in styles:
+                try:
+                    styles[path] = Image.open(path).convert('RGB')
+                except Exception as e:
+                    styles[path] = e
+            return styles[path]
+
+    def load(content_path: Path, variants: List[Tuple[Path, float]]) -> Loaded:
+        content = Image.open(content_path).convert('RGB')
+        style_images = {p: load_style(p) for p in dict.fromkeys(style for style, _ in variants)}
+        style_images = {p: image for p, image in style_images.items() if not isinstance(image, BaseException)}
+        failed = [(style, alpha, styles[style]) for style, alpha in variants if style not in style_images]
+        variants = [(style, alpha) for style, alpha in variants if style in style_images]
+        content_tensor, style_tensors = engine.prepare_batch(content, list(style_images.values()), content_size,
+                                                             style_size, False, preserve_color)
+        return Loaded(content_path, content, content_tensor, list(style_images), style_tensors, variants, failed)
+
+    def fail(content_path: Path, variants: List[Tuple[Path, float]], error: BaseException, path: Path):
+        print(f'Failed {path}: {type(error).__name__}: {error}', file=sys.stderr)
+        for style, alpha in variants:
+            writer.fail(output_name(content_path, style, alpha), error)
+
+    writer = Writer(output_dir, queue_size)
+    start, rendered, failed = time(), 0, 0
+    items = iter(pending.items())
+    with ThreadPoolExecutor(workers) as executor:
+        # Keep at most `queue_size` images decoded ahead of the model stage
+        in_flight = deque((item, executor.submit(load, *item)) for _, item in zip(range(queue_size), items))
+        while in_flight:
+            (content_path, variants), future = in_flight.popleft()
+            for item in items:
+                in_flight.append((item, executor.submit(load, *item)))
+                break
+
+            # One unreadable or corrupt image fails only its own outputs
+            try:
+                loaded: Loaded = future.result()
+            except Exception as e:
+                fail(content_path, variants, e, content_path)
+                failed += len(variants)
+                continue
+            for style, alpha, error in loaded.failed:
+                fail(content_path, [(style, alpha)], error, style)
+            failed += len(loaded.failed)
+            if not loaded.variants:
+                continue
+
+            try:
+                mask = None
+                if top_k > 0:
+                    segments = perform_segmentation(np.asarray(loaded.content), top_k, model_file, model_type,
+                                                    device, fast=fast_segmentation)
+                    mask = (segments[0].union(*segments[1:]) if segments
+                            else CompactMask.empty(loaded.content.size[::-1]))
+
+                style_index = {path: i for i, path in enumerate(loaded.style_paths)}
+                pairs = [(style_index[style], alpha) for style, alpha in loaded.variants]
+                outputs = engine.transfer_batch(loaded.content_tensor, loaded.style_tensors, batch_size=batch_size,
+                                                pairs=pairs)
+                images = [output if mask is None else composite_with_mask(loaded.content, output, mask)
+                          for output in outputs]
+            except Exception as e:
+                fail(content_path, loaded.variants, e, content_path)
+                failed += len(loaded.variants)
+                continue
+
+            for (style, alpha), image in zip(loaded.variants, images):
+                writer.put(output_name(loaded.content_path, style, alpha), image)
+
+            rendered += len(loaded.variants)
+            print(f'[{rendered + failed}/{total}] {loaded.content_path.name} '
+                  f'({rendered / (time() - start):.2f} outputs/s)')
+
+    writer.close()
+    print(f'Rendered {rendered} outputs in {time() - start:.1f} seconds' + (f', {failed} failed' if failed else ''))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stylize a directory or manifest of images without the app.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--content', type=Path, help='Directory of content images, each stylized with every style.')
+    source.add_argument('--manifest', type=Path,
+                        help='CSV file with `content`, `style` and optional `alpha` columns.')
+    parser.add_argument('--styles', type=Path, help='Directory of style images (with --content).')
+    parser.add_argument('--alphas', type=float, nargs='+', default=[1.0],
+                        help='Alphas to render for every pair without an `alpha`. Default 1.0.')
+    parser.add_argument('--top-k', type=int, default=0,
+                        help='Stylize only the union of the k largest SAM segments. Default 0 (whole image).')
+    parser.add_argument('--fast-segmentation', action='store_true',
+                        help='With --top-k, stop searching once k large segments are found.')
+    parser.add_argument('--output', type=Path, required=True, help='Directory for the outputs.')
+    parser.add_argument('--workers', type=int, default=4, help='Threads decoding images. Default 4.')
+    parser.add_argument('--queue-size', type=int, default=8, help='Images buffered between stages. Default 8.')
+    parser.add_argument('--batch-size', type=int, default=4, help='Variants per decoder forward. Default 4.')
+    parser.add_argument('--content-size', type=int, default=0, help='Minimum content size, 0 to keep. Default 0.')
+    parser.add_argument('--style-size', type=int, default=0, help='Minimum style size, 0 to keep. Default 0.')
+    parser.add_argument('--no-preserve-color', dest='preserve_color', action='store_false',
+                        help='Do not preserve the colors of the content image.')
+    parser.add_argument('--precision', choices=['fp32', 'bf16', 'int8'], default='fp32',
+                        help='Inference mode of the networks, int8 runs on the CPU. Default fp32.')
+    parser.add_argument('--channels-last', action='store_true', help='Use the channels_last memory format.')
+    parser.add_argument('--vgg', default='models/vgg_normalised.pth', help='Path to the vgg model.')
+    parser.add_argument('--decoder', default='models/decoder.pth', help='Path to the decoder model.')
+    args = parser.parse_args()
+
+    if args.content:
+        if not args.styles:
+            parser.error('--styles is required with --content')
+        styles = list_images(args.styles)
+        jobs = {content: [(style, alpha) for style in styles for alpha in args.alphas]
+                for content in list_images(args.content)}
+    else:
+        jobs = read_manifest(args.manifest, args.alphas)
+
+    failed = run(jobs, args.output, args.top_k, args.workers, args.queue_size, args.batch_size, args.content_size,
+                 args.style_size, args.preserve_color, args.vgg, args.decoder, args.precision, args.channels_last,
+                 args.fast_segmentation)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""
+Time the stylization and segmentation hot paths across image sizes and thread counts.
+
+Example:
+    python benchmark.py --sizes 256 512 1024 --threads 1 4 --output bench.json
+    python benchmark.py --sizes 256 512 1024 --threads 1 4 --baseline bench.json
+
+Checkpoints that are missing (or are Git LFS pointers) are replaced by randomly initialised weights, so the suite runs
+offline. With `--baseline`, every timing is compared with the saved results and the exit code is 1 if any stage got
+slower by more than `--threshold`. `--compare OLD NEW` compares two saved result files without running anything.
+"""
+import argparse
+import json
+import platform
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from statistics import mean, median
+from time import perf_counter
+from typing import Callable, Dict, List
+
+import numpy as np
+import torch
+from PIL import Image
+
+import adain_net
+from adain import adaptive_instance_normalization, calc_mean_std, coral
+from stylization import StyleTransferEngine, stylize
+from utils import composite_with_mask
+
+STAGES = ['calc_mean_std', 'adain', 'coral', 'encoder', 'decoder', 'stylize', 'composite', 'sam', 'sam_fast']
+SAM_STAGES = {'sam', 'sam_fast'}  # Slow on CPU, so timed once without warm-up
+NETWORK_STAGES = {'encoder', 'decoder'}  # Run whole-image networks without tiling
+
+
+def time_call(func: Callable, repeats: int, warmup: int) -> Dict[str, float]:
+    """
+    Time a function call.
+    :return: A dictionary with the median, min and mean times in milliseconds.
+    """
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        func()
+        times.append((perf_counter() - start) * 1000)
+    return {'median_ms': median(times), 'min_ms': min(times), 'mean_ms': mean(times)}
+
+
+def random_image(size: int, seed: int = 0) -> Image.Image:
+    """A smooth random RGB image of `size` x `size` pixels."""
+    rng = np.random.default_rng(seed)
+    small = Image.fromarray(rng.integers(0, 256, (16, 16, 3), dtype=np.uint8))
+    return small.resize((size, size), Image.Resampling.BICUBIC)
+
+
+def weight_paths(vgg_path: str, decoder_path: str, temp_dir: Path) -> Dict[str, str]:
+    """
+    Use the given AdaIN checkpoints if they load, otherwise save randomly initialised weights to `temp_dir`.
+    :return: A dictionary with the 'vgg' and 'decoder' paths and 'weights', either 'checkpoint' or 'random'.
+    """
+    try:
+        StyleTransferEngine(vgg_path, decoder_path, device='cpu')
+        return {'vgg': vgg_path, 'decoder': decoder_path, 'weights': 'checkpoint'}
+    except Exception:
+        torch.manual_seed(0)
+        vgg, decoder = temp_dir.joinpath('vgg.pth'), temp_dir.joinpath('decoder.pth')
+        for module, path in ((adain_net.vgg, vgg), (adain_net.decoder, decoder)):
+            state = {name: torch.randn_like(value) * 0.05 for name, value in module.state_dict().items()}
+            torch.save(state, path)
+        return {'vgg': str(vgg), 'decoder': str(decoder), 'weights': 'random'}
+
+
+def load_sam_or_random(model_file: str, model_type: str):
+    """Load SAM from `model_file` if possible, otherwise build it with random weights."""
+    from segment_anything import sam_model_registry
+    try:
+        return sam_model_registry[model_type](checkpoint=model_file).eval(), 'checkpoint'
+    except Exception:
+        torch.manual_seed(0)
+        return sam_model_registry[model_type](checkpoint=None).eval(), 'random'
+
+
+def run(sizes: List[int], threads: List[int], stages: List[str], repeats: int, warmup: int,
+        max_network_size: int, memory_budget_mb: float, sam_points: int, vgg_path: str, decoder_path: str,
+        sam_path: str, precision: str = 'fp32', channels_last: bool = False) -> Dict:
+    """
+    Run the benchmarks.
+    :return: The results as a JSON-serialisable dictionary.
+    """
+    meta = {'timestamp': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+            'torch': torch.__version__, 'platform': platform.platform(), 'device': 'cpu',
+            'repeats': repeats, 'memory_budget_mb': memory_budget_mb, 'sam_points_per_side': sam_points,
+            'precision': precision, 'channels_last': channels_last}
+    results = []
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        paths = weight_paths(vgg_path, decoder_path, Path(temp_dir))
+        meta['adain_weights'] = paths['weights']
+        engine = StyleTransferEngine.get(paths['vgg'], paths['decoder'], device='cpu', precision=precision,
+                                         channels_last=channels_last)
+
+        sam, mask_generator = None, None
+        if SAM_STAGES.intersection(stages):
+            from segment_anything import SamAutomaticMaskGenerator
+            sam, meta['sam_weights'] = load_sam_or_random(sam_path, 'vit_b')
+            mask_generator = SamAutomaticMaskGenerator(sam, points_per_side=sam_points)
+        if 'sam_fast' in stages:
+            from segmentation import embedding_cache, fast_masks
+
+            def sam_fast(image):
+                embedding_cache.clear()  # Time the embedding too, like the 'sam' stage
+                return fast_masks(sam, image, 3, ('benchmark',))
+
+        for num_threads in threads:
+            torch.set_num_threads(num_threads)
+            for size in sizes:
+                content = random_image(size)
+                style = random_image(size, seed=1)  # Scaled with the content, so 'stylize' scales with the sweep
+                content_np = np.asarray(content)
+                image = torch.rand(1, 3, size, size)
+                feat = torch.rand(1, 512, size // 8, size // 8)
+                mask = np.zeros((size, size), bool)
+                mask[size // 4:3 * size // 4, size // 4:3 * size // 4] = True
+
+                benchmarks = {
+                    'calc_mean_std': lambda: calc_mean_std(feat),
+                    'adain': lambda: adaptive_instance_normalization(feat, feat),
+                    'coral': lambda: coral(image[0], image[0]),
+                    'encoder': lambda: engine.vgg(image),
+                    'decoder': lambda: engine.decoder(feat),
+                    'stylize': lambda: stylize(content, style, paths['vgg'], paths['decoder'],
+                                               memory_budget_mb=memory_budget_mb, precision=precision),
+                    'composite': lambda: composite_with_mask(content, image, mask),
+                    'sam': lambda: mask_generator.generate(content_np),
+                    'sam_fast': lambda: sam_fast(content_np),
+                }
+                for stage in stages:
+                    entry = {'stage': stage, 'size': size, 'threads': num_threads}
+                    if stage in NETWORK_STAGES and size > max_network_size:
+                        results.append({**entry, 'skipped': f'larger than --max-network-size {max_network_size}'})
+                        continue
+                    with torch.no_grad():
+                        sam_stage = stage in SAM_STAGES
+                        timing = time_call(benchmarks[stage], 1 if sam_stage else repeats, 0 if sam_stage else warmup)
+                    results.append({**entry, **timing})
+                    print(f'{stage:>14} {size:>5}px {num_threads:>3} threads: {timing["median_ms"]:10.2f} ms')
+
+    return {'meta': meta, 'results': results}
+
+
+def compare(baseline: Dict, current: Dict, threshold: float) -> List[str]:
+    """
+    Compare the median times of two result dictionaries.
+    :param threshold: The relative slowdown counted as a regression, e.g. 0.1 for 10%.
+    :return: A list of messages, one per regression.
+    """
+    def key(entry):
+        return entry['stage'], entry['size'], entry['threads']
+
+    old = {key(entry): entry for entry in baseline['results'] if 'median_ms' in entry}
+    regressions = []
+    for entry in current['results']:
+        if 'median_ms' not in entry or key(entry) not in old:
+            continue
+        before, after = old[key(entry)]['median_ms'], entry['median_ms']
+        change = after / before - 1
+        label = f'{entry["stage"]} {entry["size"]}px {entry["threads"]} threads'
+        print(f'{label:>36}: {before:10.2f} -> {after:10.2f} ms ({change:+.1%})')
+        if change > threshold:
+            regressions.append(f'{label} is {change:.1%} slower ({before:.2f} -> {after:.2f} ms)')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the stylization and segmentation hot paths.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024, 2048, 4096],
+                        help='Square image sizes in pixels. Default 256 512 1024 2048 4096.')
+    parser.add_argument('--threads', type=int, nargs='+', default=[torch.get_num_threads()],
+                        help='Torch thread counts. Default the current thread count.')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='Stages to time. Default all.')
+    parser.add_argument('--repeats', type=int, default=5, help='Timed runs per benchmark. Default 5.')
+    parser.add_argument('--warmup', type=int, default=1, help='Untimed runs per benchmark. Default 1.')
+    parser.add_argument('--max-network-size', type=int, default=2048,
+                        help='Largest size for the untiled encoder and decoder stages. Default 2048.')
+    parser.add_argument('--memory-budget-mb', type=float, default=1024,
+                        help='Memory budget of the end-to-end stylize stage, see `stylize`. Default 1024.')
+    parser.add_argument('--sam-points', type=int, default=8, help='SAM points per side. Default 8.')
+    parser.add_argument('--precision', choices=['fp32', 'bf16', 'int8'], default='fp32',
+                        help='Inference mode of the encoder, decoder and stylize stages. Default fp32.')
+    parser.add_argument('--channels-last', action='store_true',
+                        help='Run the encoder and decoder stages in the channels_last memory format.')
+    parser.add_argument('--vgg', default='models/vgg_normalised.pth', help='Path to the vgg model.')
+    parser.add_argument('--decoder', default='models/decoder.pth', help='Path to the decoder model.')
+    parser.add_argument('--sam', default='models/sam_vit_b_01ec64.pth', help='Path to the SAM model.')
+    parser.add_argument('--output', type=Path, help='Path to save the results as JSON.')
+    parser.add_argument('--baseline', type=Path, help='Saved results to compare this run with.')
+    parser.add_argument('--compare', type=Path, nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help='Compare two saved results without running the benchmarks.')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative slowdown reported as a regression. Default 0.1 (10%%).')
+    args = parser.parse_args()
+
+    if args.compare:
+        baseline, current = (json.loads(path.read_text()) for path in args.compare)
+    else:
+        current = run(args.sizes, args.threads, args.stages, args.repeats, args.warmup, args.max_network_size,
+                      args.memory_budget_mb, args.sam_points, args.vgg, args.decoder, args.sam, args.precision,
+                      args.channels_last)
+        if args.output:
+            args.output.write_text(json.dumps(current, indent=2))
+            print(f'Results saved at {args.output}')
+        if not args.baseline:
+            return
+        baseline = json.loads(args.baseline.read_text())
+
+    regressions = compare(baseline, current, args.threshold)
+    for message in regressions:
+        print(f'REGRESSION: {message}')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Export the VGG encoder (up to relu4_1) and decoder as one frozen TorchScript file per precision mode.
+
+Example:
+    python export_models.py --precision fp32 int8
+
+`StyleTransferEngine` loads the artifact of its mode from `models/` when present, so a CPU worker starts without
+building the full 53-layer `adain_net.vgg`, reading the relu4_2-relu5_4 weights it never uses or, for 'int8',
+calibrating. The artifact records the size and modification time of the checkpoints it was exported from and is
+ignored once they change. Artifacts are CPU-only.
+"""
+import argparse
+import json
+from pathlib import Path
+from typing import Optional, Sequence, Tuple
+
+import torch
+import torch.nn as nn
+from PIL import Image
+
+from stylization import ARTIFACT_DIR, StyleTransferEngine, artifact_path, checkpoint_signature
+
+
+class _Networks(nn.Module):
+    """The traced networks, with one method each so that both live in a single frozen module."""
+
+    def __init__(self, vgg: torch.jit.ScriptModule, decoder: torch.jit.ScriptModule):
+        super().__init__()
+        self.vgg = vgg
+        self.decoder = decoder
+
+    @torch.jit.export
+    def encode(self, x: torch.Tensor) -> torch.Tensor:
+        return self.vgg(x)
+
+    @torch.jit.export
+    def decode(self, x: torch.Tensor) -> torch.Tensor:
+        return self.decoder(x)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.decoder(self.vgg(x))
+
+
+def export(vgg_path: str = 'models/vgg_normalised.pth', decoder_path: str = 'models/decoder.pth',
+           precision: str = 'fp32', channels_last: bool = False, directory: Path = ARTIFACT_DIR,
+           calibration: Optional[Sequence[Tuple[Image.Image, Image.Image]]] = None) -> Path:
+    """
+    Trace, freeze and save the networks of a precision mode.
+    :param precision: The precision mode, see `precision.py`. Default 'fp32'.
+    :param channels_last: Boolean to use the channels_last memory format. Default False
+    :param directory: The directory to save the artifact in. Default `ARTIFACT_DIR`.
+    :param calibration: The (content, style) image pairs to calibrate 'int8' on. Default None (the test images).
+    :return: The path of the artifact.
+    """
+    engine = StyleTransferEngine(vgg_path, decoder_path, 'cpu', precision=precision, channels_last=channels_last,
+                                 calibration=calibration, artifact_dir=None)
+    example = torch.rand(1, 3, 256, 256)
+    with torch.no_grad():
+        vgg = torch.jit.trace(engine.vgg, example)
+        decoder = torch.jit.trace(engine.decoder, engine.vgg(example))
+        networks = torch.jit.freeze(torch.jit.script(_Networks(vgg, decoder)).eval(),
+                                    preserved_attrs=['encode', 'decode'])
+
+    meta = {'precision': precision, 'channels_last': channels_last, 'torch': torch.__version__,
+            'checkpoints': checkpoint_signature(vgg_path, decoder_path)}
+    path = artifact_path(precision, channels_last, directory)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(path.name + '.part')
+    torch.jit.save(networks, str(temp_path), _extra_files={'meta.json': json.dumps(meta)})
+    temp_path.replace(path)  # Workers never see a partly written artifact
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export frozen TorchScript networks for fast worker start-up.')
+    parser.add_argument('--precision', nargs='+', choices=['fp32', 'bf16', 'int8'], default=['fp32'],
+                        help='Precision modes to export. Default fp32.')
+    parser.add_argument('--channels-last', action='store_true', help='Export channels_last variants.')
+    parser.add_argument('--output-dir', type=Path, default=ARTIFACT_DIR,
+                        help=f'Directory for the artifacts. Default {ARTIFACT_DIR}.')
+    parser.add_argument('--vgg', default='models/vgg_normalised.pth', help='Path to the vgg model.')
+    parser.add_argument('--decoder', default='models/decoder.pth', help='Path to the decoder model.')
+    args = parser.parse_args()
+
+    for precision in args.precision:
+        path = export(args.vgg, args.decoder, precision, args.channels_last, args.output_dir)
+        print(f'Exported {precision} networks at {path} ({path.stat().st_size / 2 ** 20:.1f} MiB)')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,22 @@
+from uuid import uuid4
+
 import streamlit as st
-from utils import create_folder
+from artifacts import get_store
+from tracing import setup_logging
+from warmup import start_warmup
 
 
 def main():
+    setup_logging()  # Shows the per-request traces in the server's output
+    # Load the models in the background while the user uploads the images
+    start_warmup()
+
     st.write(""" # Segify: Semantic Segmentation for Localized Artistic Effects  """)
 
-    st.session_state['folder_path'] = create_folder('temp_images')
+    # Each session keeps its files in its own folder of the shared store
+    if 'session_id' not in st.session_state:
+        st.session_state['session_id'] = uuid4().hex
+    st.session_state['folder_path'] = get_store().session_dir(st.session_state['session_id'])
 
     st.write("Segify is a user-friendly tool that empowers you to creatively manipulate your images "
              "using the power of neural style transfer.")
@@ -0,0 +1,156 @@
+"""
+A compact boolean mask type for SAM segments.
+
+A full-resolution bool mask of a 12 MP photo takes 12 MB, and every cached segment, clicked mask and session holds one.
+`CompactMask` keeps only the pixels inside the mask's bounding box, bit-packed (8 pixels per byte), together with the
+box and area, so a segment takes at most an eighth of that and a small one far less. Numpy sees it as the dense array
+(`np.asarray(mask)` decodes it), while cropping, resizing and unions work on the packed box without decoding the rest.
+"""
+from hashlib import blake2b
+from typing import Optional, Tuple
+
+import numpy as np
+
+Box = Tuple[int, int, int, int]  # (top, left, bottom, right), with bottom and right exclusive
+
+
+def mask_bbox(mask) -> Optional[Box]:
+    """
+    Get the bounding box of a mask.
+    :param mask: The 2D mask array or a CompactMask object.
+    :return: The (top, left, bottom, right) box, with bottom and right exclusive, or None if the mask is empty.
+    """
+    if isinstance(mask, CompactMask):
+        return mask.box
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return int(rows[0]), int(cols[0]), int(rows[-1]) + 1, int(cols[-1]) + 1
+
+
+class CompactMask:
+    """
+    A boolean mask stored as the bit-packed pixels of its bounding box, with the box and area kept alongside.
+    Instances are immutable and can be shared between caches and sessions.
+    """
+    __slots__ = ('shape', 'box', 'area', '_bits')
+
+    def __init__(self, shape: Tuple[int, int], box: Optional[Box], bits: np.ndarray, area: int):
+        """
+        Use `from_dense` to build one from an array.
+        :param shape: The (H, W) shape of the mask.
+        :param box: The (top, left, bottom, right) bounding box, or None if the mask is empty.
+        :param bits: The `np.packbits` of the pixels inside `box`, row by row.
+        :param area: The number of pixels in the mask.
+        """
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.box = box
+        self.area = area
+        self._bits = bits
+
+    @classmethod
+    def from_dense(cls, mask: np.ndarray) -> 'CompactMask':
+        """Compress a 2D boolean array."""
+        mask = np.asarray(mask, dtype=bool)
+        return cls._from_region(mask.shape, (0, 0), mask)
+
+    @classmethod
+    def empty(cls, shape: Tuple[int, int]) -> 'CompactMask':
+        """A mask of `shape` with no pixels set."""
+        return cls(shape, None, np.empty(0, np.uint8), 0)
+
+    @classmethod
+    def _from_region(cls, shape: Tuple[int, int], offset: Tuple[int, int], region: np.ndarray) -> 'CompactMask':
+        """Compress the boolean `region` of a mask of `shape`, placed at `offset` and empty elsewhere."""
+        box = mask_bbox(region)
+        if box is None:
+            return cls.empty(shape)
+        top, left, bottom, right = box
+        region = region[top:bottom, left:right]
+        return cls(shape, (offset[0] + top, offset[1] + left, offset[0] + bottom, offset[1] + right),
+                   np.packbits(region), int(np.count_nonzero(region)))
+
+    @property
+    def nbytes(self) -> int:
+        """The size of the packed pixels in bytes."""
+        return self._bits.nbytes
+
+    def _box_pixels(self) -> np.ndarray:
+        """Decode the pixels inside the bounding box."""
+        top, left, bottom, right = self.box
+        h, w = bottom - top, right - left
+        return np.unpackbits(self._bits, count=h * w).reshape(h, w).view(bool)
+
+    def to_dense(self) -> np.ndarray:
+        """Decode the full (H, W) boolean array."""
+        return self.crop((0, 0, *self.shape))
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        dense = self.to_dense()
+        return dense if dtype is None else dense.astype(dtype)
+
+    def crop(self, box: Box) -> np.ndarray:
+        """
+        Decode only a region of the mask.
+        :param box: The (top, left, bottom, right) region, within the mask's shape.
+        :return: The boolean array of the region.
+        """
+        top, left, bottom, right = box
+        region = np.zeros((bottom - top, right - left), bool)
+        if self.box is None:
+            return region
+        own_top, own_left, own_bottom, own_right = self.box
+        t, l, b, r = max(top, own_top), max(left, own_left), min(bottom, own_bottom), min(right, own_right)
+        if t < b and l < r:
+            region[t - top:b - top, l - left:r - left] = \
+                self._box_pixels()[t - own_top:b - own_top, l - own_left:r - own_left]
+        return region
+
+    def resize(self, shape: Tuple[int, int]) -> 'CompactMask':
+        """
+        Resize the mask with nearest-neighbour sampling, decoding only the bounding box.
+        :param shape: The new (H, W) shape.
+        :return: The resized CompactMask object.
+        """
+        H, W = shape
+        if (H, W) == self.shape or self.box is None:
+            return self if (H, W) == self.shape else CompactMask.empty(shape)
+        # Output pixel i samples the source pixel under its centre, floor((i + 0.5) * scale), in exact integers
+        rows = (2 * np.arange(H) + 1) * self.shape[0] // (2 * H)
+        cols = (2 * np.arange(W) + 1) * self.shape[1] // (2 * W)
+        top, left, bottom, right = self.box
+        r0, r1 = np.searchsorted(rows, [top, bottom])
+        c0, c1 = np.searchsorted(cols, [left, right])
+        region = self._box_pixels()[np.ix_(rows[r0:r1] - top, cols[c0:c1] - left)]
+        return CompactMask._from_region((H, W), (int(r0), int(c0)), region)
+
+    def union(self, *others: 'CompactMask') -> 'CompactMask':
+        """The pixel-wise OR with masks of the same shape, decoding only the union of their boxes."""
+        masks = [self, *others]
+        if any(mask.shape != self.shape for mask in masks):
+            raise ValueError(f'Cannot combine masks of shapes {[mask.shape for mask in masks]}')
+        boxes = [mask.box for mask in masks if mask.box is not None]
+        if not boxes:
+            return CompactMask.empty(self.shape)
+        top, left = min(box[0] for box in boxes), min(box[1] for box in boxes)
+        bottom, right = max(box[2] for box in boxes), max(box[3] for box in boxes)
+        region = np.zeros((bottom - top, right - left), bool)
+        for mask in masks:
+            if mask.box is not None:
+                t, l, b, r = mask.box
+                region[t - top:b - top, l - left:r - left] |= mask._box_pixels()
+        return CompactMask._from_region(self.shape, (top, left), region)
+
+    def __or__(self, other: 'CompactMask') -> 'CompactMask':
+        return self.union(other)
+
+    def digest(self) -> str:
+        """A hex digest of the mask's pixels, equal for equal masks, for cache keys. Nothing is decoded."""
+        digest = blake2b(digest_size=16)
+        digest.update(f'{self.shape}{self.box}'.encode())
+        digest.update(self._bits.data)
+        return digest.hexdigest()
+
+    def __repr__(self) -> str:
+        return f'CompactMask(shape={self.shape}, box={self.box}, area={self.area}, nbytes={self.nbytes})'
@@ -0,0 +1,92 @@
+"""
+Render SAM segments over an image for display, in uint8 and at preview resolution.
+
+All segments are drawn into one colour-coded label map, blended with the image in a single vectorized pass, and each
+segment also gets a thumbnail highlighting it alone. Masks are resized in packed form (see `masks.CompactMask`), so
+no full-resolution array is decoded.
+"""
+from typing import List, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+from masks import CompactMask
+
+PREVIEW_SIZE = 640  # The default longest side of the overlay, in pixels
+THUMBNAIL_SIZE = 192  # The default longest side of the per-segment thumbnails, in pixels
+# Colour of segment i is PALETTE[i % len(PALETTE)] (matplotlib's tab10)
+PALETTE = np.array([[31, 119, 180], [255, 127, 14], [44, 160, 44], [214, 39, 40], [148, 103, 189],
+                    [140, 86, 75], [227, 119, 194], [127, 127, 127], [188, 189, 34], [23, 190, 207]], np.uint8)
+
+
+def preview_shape(shape: Tuple[int, int], size: int) -> Tuple[int, int]:
+    """The (H, W) shape fitting `shape` into `size` x `size` pixels with its aspect ratio, never enlarged."""
+    H, W = shape[:2]
+    scale = min(size / max(H, W), 1.0)
+    return max(round(H * scale), 1), max(round(W * scale), 1)
+
+
+def downscale(image: np.ndarray, size: int) -> np.ndarray:
+    """Resize an (H, W, 3) uint8 image to fit into `size` x `size` pixels, see `preview_shape`."""
+    h, w = preview_shape(image.shape, size)
+    if (h, w) == image.shape[:2]:
+        return image
+    return np.asarray(Image.fromarray(image).resize((w, h), Image.Resampling.BILINEAR))
+
+
+def _blend(image: np.ndarray, colours: np.ndarray, opacity: float) -> np.ndarray:
+    """Blend uint8 colours over a uint8 image with integer arithmetic."""
+    weight = int(round(opacity * 256))
+    return ((image.astype(np.uint16) * (256 - weight) + colours.astype(np.uint16) * weight) >> 8).astype(np.uint8)
+
+
+def label_map(segments: Sequence[CompactMask], shape: Tuple[int, int]) -> np.ndarray:
+    """
+    Draw masks into one label map, segment i as label i + 1 and 0 elsewhere. Later segments are drawn over earlier
+    ones, so with segments sorted largest first the small ones stay visible.
+    :param segments: Up to 255 CompactMask objects of the same shape.
+    :param shape: The (H, W) shape to render at, the masks are resized to it.
+    :return: The (H, W) uint8 label map.
+    """
+    labels = np.zeros(shape, np.uint8)
+    for label, segment in enumerate(segments, 1):
+        segment = segment.resize(shape)
+        if segment.box is not None:
+            top, left, bottom, right = segment.box
+            labels[top:bottom, left:right][segment.crop(segment.box)] = label
+    return labels
+
+
+def render_overlay(image: np.ndarray, segments: Sequence[CompactMask], size: int = PREVIEW_SIZE,
+                   opacity: float = 0.6) -> np.ndarray:
+    """
+    Show every segment in its own colour over a downscaled copy of the image.
+    :param image: The (H, W, 3) uint8 image the masks belong to.
+    :param segments: The CompactMask objects, coloured as in `PALETTE`.
+    :param size: The longest side of the rendered image in pixels. Default `PREVIEW_SIZE`.
+    :param opacity: The opacity of the colours, between 0 and 1. Default 0.6.
+    :return: The (h, w, 3) uint8 rendered image.
+    """
+    preview = downscale(image, size)
+    labels = label_map(segments, preview.shape[:2])
+    colours = PALETTE[(labels.astype(np.intp) - 1) % len(PALETTE)]
+    return np.where(labels[..., None] > 0, _blend(preview, colours, opacity), preview)
+
+
+def render_thumbnails(image: np.ndarray, segments: Sequence[CompactMask], size: int = THUMBNAIL_SIZE,
+                      opacity: float = 0.6) -> List[np.ndarray]:
+    """
+    Render one thumbnail per segment, highlighting it alone in its `PALETTE` colour.
+    :param image: The (H, W, 3) uint8 image the masks belong to.
+    :param segments: The CompactMask objects.
+    :param size: The longest side of the thumbnails in pixels. Default `THUMBNAIL_SIZE`.
+    :param opacity: The opacity of the colours, between 0 and 1. Default 0.6.
+    :return: A list of (h, w, 3) uint8 thumbnails, one per segment.
+    """
+    if not segments:
+        return []
+    thumbnail = downscale(image, size)
+    shape = thumbnail.shape[:2]
+    masks = np.stack([np.asarray(segment.resize(shape)) for segment in segments])  # Small at thumbnail size
+    colours = PALETTE[np.arange(len(segments)) % len(PALETTE)][:, None, None]
+    return list(np.where(masks[..., None], _blend(thumbnail, colours, opacity), thumbnail))
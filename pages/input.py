@@ -2,12 +2,12 @@ import time
 
 import streamlit as st
 from PIL import Image
-from os.path import join
+from artifacts import get_store
 
 
 def main():
     # Check if the needed variables are available from session state
-    if 'folder_path' not in st.session_state:
+    if 'session_id' not in st.session_state:
         st.switch_page('main.py')
 
     st.write(""" # Segify: Inputs""")
@@ -17,6 +17,9 @@ def main():
     uploaded_image = st.sidebar.file_uploader("## Image to annotate:", type=["png", "jpg", "jpeg"])
     if uploaded_image:
         uploaded_image_ext: str = uploaded_image.name.split(".")[-1]
+        # Save the uploaded file as it is, named by its hash, so a rerun finds it stored and writes nothing
+        temp_uploaded_path: str = str(get_store().put_bytes(st.session_state['session_id'],
+                                                             uploaded_image.getvalue(), "." + uploaded_image_ext))
         uploaded_image = Image.open(uploaded_image)
         # uploaded_image_np = np.array(uploaded_image)  # to numpy array
 
@@ -26,9 +29,10 @@ def main():
         st.sidebar.markdown("_The top right corner shows the running status of the app._")
         st.sidebar.markdown("---")
 
-        # Save the image to a temp directory for later use
-        temp_uploaded_path: str = join(st.session_state['folder_path'], "uploaded." + uploaded_image_ext)
-        uploaded_image.save(temp_uploaded_path)
+        # The features encoded from the previous image are of no use for the new one
+        if st.session_state.get('temp_uploaded_path') != temp_uploaded_path:
+            for key in ('preview_features', 'full_features'):
+                st.session_state.pop(key, None)
         st.session_state['temp_uploaded_path'] = temp_uploaded_path
 
         # Get the number of segmented masks to show
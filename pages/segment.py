@@ -3,59 +3,146 @@ from datetime import timedelta
 
 import streamlit as st
 import numpy as np
-from typing import List
+from typing import List, Optional, Tuple
 
-from segmentation import init, perform_segmentation
+from masks import CompactMask
+from overlays import PREVIEW_SIZE, THUMBNAIL_SIZE, downscale, render_overlay, render_thumbnails
+from scheduler import InferenceScheduler, SchedulerBusy
+from segmentation import embed_image, init, perform_segmentation, predict_mask
+from tracing import setup_logging, show_trace, stage, trace
+from utils import image_hash
 
+try:
+    from streamlit_image_coordinates import streamlit_image_coordinates
+except ImportError:  # Optional, see `select_by_click`
+    streamlit_image_coordinates = None
 
-def overlay_mask_on_image(image: np.ndarray, segments: List[np.ndarray], blending_factor: float) -> List[np.ndarray]:
-    """
-    Overlays segmentation masks on an original image for visualization.
-    :param image: The original image.
-    :param segments: A list of NumPy boolean arrays representing masks.
-    :param blending_factor: Blending factor level of the mask overlay (0.0 to 1.0).
-    :return: A list of numpy arrays consisting of the original image with overlaid masks.
-    """
-    result = image.copy().astype(np.uint8)  # Create a copy to avoid modifying the original
-    overlays = []
-
-    for segment in segments:
-        mask = segment.astype(float) * blending_factor
-
-        # Change the image based on the adjusted mask
-        new_im = result * (1 - mask[..., None])
+CLICK_WIDTH = 700  # The largest display width of the clickable image, in pixels
+PREVIEW_SIZES = (320, 480, PREVIEW_SIZE, 960, 1280)  # The choices of the overlay's longest side, in pixels
+THUMBNAILS_PER_ROW = 5
 
-        # Clip the resulting values to stay within 0.0 and 1.0
-        new_im = np.clip(new_im, 0.0, 255.0) / 255.0
 
-        overlays.append(new_im)
-
-    return overlays
-
-
-def main():
-    # Check if the needed variables are available from session state
-    vars_needed = ['uploaded_image', 'temp_uploaded_path', 'num_masks']
-    if not all(var in st.session_state for var in vars_needed):
-        st.switch_page('pages/input.py')
+@st.cache_resource(max_entries=32, show_spinner=False)
+def render_previews(image_key: str, mask_keys: Tuple[str, ...], _image: np.ndarray, _segments: List[CompactMask],
+                    preview_size: int, thumbnail_size: Optional[int] = None) -> Tuple[np.ndarray, List[np.ndarray]]:
+    """
+    Render the colour-coded overlay of an image's segments and, optionally, one thumbnail per segment.
+    Cached by the content hashes of the image and masks, so reruns reuse the small uint8 previews.
+    The returned arrays are shared between reruns and sessions and must not be modified.
+    :param preview_size: The longest side of the overlay in pixels.
+    :param thumbnail_size: If specified, the longest side of the thumbnails in pixels. Default None (no thumbnails).
+    :return: A 2-tuple of the overlay and the list of thumbnails, as uint8 arrays.
+    """
+    preview = downscale(_image, preview_size)  # Downscaled once, the thumbnails are made from the preview
+    overlay = render_overlay(preview, _segments, preview_size)
+    thumbnails = render_thumbnails(preview, _segments, thumbnail_size) if thumbnail_size else []
+    return overlay, thumbnails
 
-    # st.write(""" # Segify: Segmentation""")
-    model_file, model_type, device = init()
 
-    # Get the segments as a list
-    uploaded_image_np: np.ndarray = np.array(st.session_state['uploaded_image'])
-    start = time()
+def clear_clicks():
+    """Forget the clicked points. The click shown by the component counts as handled, so it is not added again."""
+    st.session_state['prompt_points'].clear()
+    st.session_state['prompt_last_click'] = st.session_state.get('segment_click')
 
-    segments: List[np.ndarray] = perform_segmentation(uploaded_image_np, st.session_state['num_masks'],
-                                                      model_file, model_type, device)
 
-    st.sidebar.write(f'Segmentation took {timedelta(seconds= (time() - start))} seconds.')
-    captions: List[str] = [f'Segment {i + 1}' for i in range(len(segments))]  # Captions for each segment
+def select_by_click(uploaded_image_np: np.ndarray, model_file, model_type, device):
+    """
+    Let the user click the region to stylize. Every click is answered from the image's cached SAM embedding.
+    :param uploaded_image_np: The uploaded image as an (H, W, 3) uint8 array.
+    """
+    # Clicks as (x, y, label) in image pixels, forgotten when a new image is uploaded
+    image_key = image_hash(uploaded_image_np)
+    if st.session_state.get('prompt_image') != image_key:
+        st.session_state['prompt_image'] = image_key
+        st.session_state['prompt_points'] = []
+        st.session_state.pop('prompt_last_click', None)
+    points = st.session_state['prompt_points']
+
+    st.sidebar.subheader("Click the region to stylize")
+    label = st.sidebar.radio("A click marks", ('Region', 'Background'), horizontal=True)
+    st.sidebar.button("Clear clicks", on_click=clear_clicks)
+
+    profile = st.sidebar.checkbox('Capture torch profiler', key='profile_segment')
+    with trace('prompted segmentation', profile=profile) as segment_trace:
+        # SAM runs on the shared workers, so sessions don't compete for the cores
+        scheduler = InferenceScheduler.get()
+        mask = None
+        try:
+            scheduler.submit(embed_image, uploaded_image_np, model_file, model_type, device).result()  # Once per image
+            if points:
+                mask = scheduler.submit(predict_mask, uploaded_image_np, model_file, model_type, device,
+                                        [p[:2] for p in points], [p[2] for p in points]).result()
+        except SchedulerBusy as e:
+            st.sidebar.error(f'The server is busy: {e}')
+            return
+        with stage('overlay rendering'):
+            # Rendered at the display width, so the browser gets no more pixels than it shows
+            H, W = uploaded_image_np.shape[:2]
+            size = -(-min(CLICK_WIDTH, W) * max(H, W) // W)
+            shown, _ = render_previews(image_key, () if mask is None else (mask.digest(),), uploaded_image_np,
+                                       [] if mask is None else [mask], size)
+    show_trace(segment_trace)
+
+    display_width = shown.shape[1]
+    scale = W / display_width
+    if streamlit_image_coordinates is not None:
+        click = streamlit_image_coordinates(shown, width=display_width, key='segment_click')
+    else:  # Without the component, points are entered as coordinates
+        st.image(shown, width=display_width)
+        x = st.sidebar.number_input("x", 0, uploaded_image_np.shape[1] - 1)
+        y = st.sidebar.number_input("y", 0, uploaded_image_np.shape[0] - 1)
+        click = {'x': x / scale, 'y': y / scale} if st.sidebar.button("Add point") else None
+
+    # The component keeps returning the last click, so only a new one adds a point
+    if click is not None and click != st.session_state.get('prompt_last_click'):
+        st.session_state['prompt_last_click'] = click
+        points.append((click['x'] * scale, click['y'] * scale, int(label == 'Region')))
+        st.rerun()
+
+    if mask is None:
+        st.sidebar.markdown("_Click the image to select a region_")
+    elif st.sidebar.button("Stylize this region"):
+        st.session_state['mask'] = mask
+        st.switch_page('pages/style.py')
 
-    overlays = overlay_mask_on_image(uploaded_image_np, segments, blending_factor=0.77)
 
-    for i, overlay in enumerate(overlays):
-        st.image(overlay, caption=captions[i])
+def select_automatic(uploaded_image_np: np.ndarray, model_file, model_type, device):
+    """
+    Show the largest automatically generated segments and let the user pick one.
+    :param uploaded_image_np: The uploaded image as an (H, W, 3) uint8 array.
+    """
+    fast = st.sidebar.checkbox('Fast segmentation', value=True, key='fast_segmentation',
+                               help='Stop once enough large segments are found, instead of trying every point')
+    preview_size = st.sidebar.select_slider('Preview size', PREVIEW_SIZES, value=PREVIEW_SIZE, key='preview_size',
+                                            help='The longest side of the segment overlay, in pixels')
+    profile = st.sidebar.checkbox('Capture torch profiler', key='profile_segment')
+    with trace('segmentation', profile=profile) as segment_trace:
+        # Get the segments as a list
+        start = time()
+
+        try:
+            segments: List[CompactMask] = InferenceScheduler.get().submit(
+                perform_segmentation, uploaded_image_np, st.session_state['num_masks'], model_file, model_type,
+                device, fast=fast).result()
+        except SchedulerBusy as e:
+            st.sidebar.error(f'The server is busy: {e}')
+            return
+
+        st.sidebar.write(f'Segmentation took {timedelta(seconds= (time() - start))} seconds.')
+        captions: List[str] = [f'Segment {i + 1}' for i in range(len(segments))]  # Captions for each segment
+
+        with stage('overlay rendering'):
+            overlay, thumbnails = render_previews(image_hash(uploaded_image_np),
+                                                  tuple(segment.digest() for segment in segments),
+                                                  uploaded_image_np, segments, preview_size, THUMBNAIL_SIZE)
+    show_trace(segment_trace)
+
+    # Every segment in its colour, then each one alone
+    st.image(overlay, caption='All segments')
+    for row in range(0, len(thumbnails), THUMBNAILS_PER_ROW):
+        for column, thumbnail, caption in zip(st.columns(THUMBNAILS_PER_ROW), thumbnails[row:row + THUMBNAILS_PER_ROW],
+                                              captions[row:row + THUMBNAILS_PER_ROW]):
+            column.image(thumbnail, caption=caption, use_column_width=True)
 
     st.sidebar.subheader("Select segmentation settings")
     st.sidebar.markdown("_Segments are highlighted_")
@@ -69,7 +156,7 @@ def main():
         mask_num = int(selected_seg_num.split()[-1]) - 1  # Get the index of the segment
 
         # The mask of the segmentation to use for stylizing
-        mask: np.ndarray = segments[mask_num]
+        mask: CompactMask = segments[mask_num]
         st.session_state['mask'] = mask
 
         with st.spinner():
@@ -78,6 +165,26 @@ def main():
             st.switch_page('pages/style.py')  # Redirect to style page
 
 
+def main():
+    setup_logging()  # Also when the page is opened directly, without main.py
+
+    # Check if the needed variables are available from session state
+    vars_needed = ['uploaded_image', 'temp_uploaded_path', 'num_masks']
+    if not all(var in st.session_state for var in vars_needed):
+        st.switch_page('pages/input.py')
+
+    # st.write(""" # Segify: Segmentation""")
+    model_file, model_type, device = init()
+    uploaded_image_np: np.ndarray = np.array(st.session_state['uploaded_image'].convert('RGB'))
+
+    # Clicking runs only SAM's mask decoder per click, the automatic mode evaluates a whole grid of points
+    mode = st.sidebar.radio("Segmentation mode", ('Click a region', 'Automatic segments'), key='segment_mode')
+    if mode == 'Click a region':
+        select_by_click(uploaded_image_np, model_file, model_type, device)
+    else:
+        select_automatic(uploaded_image_np, model_file, model_type, device)
+
+
 if __name__ == "__main__":
     st.set_page_config(
         page_title="Segify: Segment",
@@ -1,29 +1,24 @@
+from time import monotonic, sleep
+
 import streamlit as st
 from PIL import Image
-from os.path import join
-from stylization import stylize
-from utils import combine_with_mask, delete_folder, get_model
-
-
-def init():
-    """Initialize the models."""
-
-    model_dir = 'models'
-    model_name = "vgg_normalised.pth"
-    url = "https://github.com/naoto0804/pytorch-AdaIN/releases/download/v0.0.0/vgg_normalised.pth"
-
-    response = get_model(model_name,
-                         url,
-                         model_dir)
-
-    if not response[0]:  # Check if the file downloaded successfully
-        print(response[1])
-        exit()
-
-
-def delete_and_main(folder_path):
-    """Delete the temp folder and keys in the session state. Also, switch to the main page."""
-    delete_folder(folder_path)
+from artifacts import get_store
+from masks import CompactMask
+from scheduler import InferenceScheduler, SchedulerBusy
+from stylization import init, stylize
+from tracing import setup_logging, show_trace, trace
+from utils import composite_with_mask, image_hash
+
+PREVIEW_SIZE = 256  # The content and style size of the first, low-resolution result
+REFINE_POLL = 0.25  # Seconds between checks whether the full-resolution result is done
+MEMORY_BUDGET_MB = 1024  # Large photos are stylized tile by tile within this many MiB of activations
+TILE_CACHE_MB = 64  # The most MiB of tile features a session keeps for later alphas
+
+
+def delete_and_main(session_id):
+    """Delete the session's stored files and keys in the session state. Also, switch to the main page."""
+    cancel_refinement()
+    get_store().delete_session(session_id)
     keys = list(st.session_state.keys())
     for key in keys:
         st.session_state.pop(key)
@@ -34,7 +29,36 @@ def toggle_styling(boolean):
     st.session_state['perform_styling'] = boolean
 
 
+def cancel_refinement():
+    """Cancel the session's full-resolution stylization, if it is still queued or running."""
+    refinement = st.session_state.pop('refinement', None)
+    if refinement is not None:
+        InferenceScheduler.get().cancel(refinement[1])
+
+
+def render_preview(content: Image, style: Image, alpha: float, mask: CompactMask, feature_cache: dict) -> Image:
+    """
+    Stylize and combine at `PREVIEW_SIZE`, which takes a small fraction of the full-resolution time.
+    :return: The Pil.Image object of the combined image, with the content's aspect ratio.
+    """
+    stylized = stylize(content, style, content_size=PREVIEW_SIZE, style_size=PREVIEW_SIZE, alpha=alpha,
+                       feature_cache=feature_cache, mask=mask)
+    h, w = stylized.size()[-2:]
+    return composite_with_mask(content.resize((w, h), Image.Resampling.BILINEAR), stylized, mask.resize((h, w)))
+
+
+def render_full(content: Image, style: Image, alpha: float, mask: CompactMask, feature_cache: dict) -> Image:
+    """
+    Stylize and combine at the content's resolution.
+    :return: The Pil.Image object of the combined image.
+    """
+    stylized = stylize(content, style, alpha=alpha, feature_cache=feature_cache, mask=mask,
+                       memory_budget_mb=MEMORY_BUDGET_MB, tile_cache_mb=TILE_CACHE_MB)
+    return composite_with_mask(content, stylized, mask)
+
+
 def main():
+    setup_logging()  # Also when the page is opened directly, without main.py
     st.write(""" # Segify: Style Transfer""")
     init()
 
@@ -44,44 +68,88 @@ def main():
 
     # Get style image logic (similar to segment_page.py)
     st.sidebar.subheader('Upload files')
-    style_image = st.sidebar.file_uploader("## Image for styling:", type=["png", "jpg", "jpeg"])
+    style_image = st.sidebar.file_uploader("## Image for styling:", type=["png", "jpg", "jpeg"],
+                                           on_change=toggle_styling, args=[False])
+    if 'perform_styling' not in st.session_state:
+        toggle_styling(False)
 
     if style_image:
-        style_image_ext: str = style_image.name.split(".")[-1]
         style_image = Image.open(style_image)
         st.session_state['style_image'] = style_image
 
-        toggle_styling(False)
+        # Once styled, moving the slider re-renders with the cached features, running only the decoder
         alpha = st.sidebar.slider("Select styling weight (alpha).\nHigher means more styling.", min_value=0.0,
                                   max_value=1.0,
-                                  value=1.0, on_change=toggle_styling, args=[False])
+                                  value=1.0)
 
         # Button to perform stylization
         style = st.sidebar.button("Begin Styling", on_click=toggle_styling, args=[True])
         if style or st.session_state['perform_styling']:
             st.sidebar.markdown('_Styling..._')
-            # Output is saved
-            stylize(st.session_state['uploaded_image'], style_image,
-                    output_dir=st.session_state['folder_path'], output_file_name="stylized_mask." + style_image_ext,
-                    alpha=alpha)
-
-            # Read in image
-            temp_style_path: str = join(st.session_state['folder_path'], "stylized_mask." + style_image_ext)
-            st.session_state['temp_style_path'] = temp_style_path
-
-            # styled_output_img: Image = Image.open(temp_style_path)
-
-            # Combine images
-            combined_image: Image = combine_with_mask(st.session_state['temp_uploaded_path'],
-                                                      temp_style_path, st.session_state['mask'])
+            progressive = st.sidebar.checkbox('Progressive preview', value=True, key='progressive_style',
+                                              help='Show a low-resolution result first, then refine it')
+            profile = st.sidebar.checkbox('Capture torch profiler', key='profile_style')
+            status = st.sidebar.empty()
+            actions = st.sidebar.container()
+            st.sidebar.button('Exit', on_click=delete_and_main, args=[st.session_state['session_id']])
+
+            content, mask = st.session_state['uploaded_image'], st.session_state['mask']
+            request = (image_hash(content), image_hash(style_image), image_hash(mask), alpha)
+            # Separate caches, so that the preview and the full-resolution run do not evict each other's features
+            preview_cache = st.session_state.setdefault('preview_features', {})
+            full_cache = st.session_state.setdefault('full_features', {})
 
             col1, col2 = st.columns(2)
             with col1:
-                st.image(st.session_state['uploaded_image'], use_column_width=True, caption='Original')
-            with col2:
-                st.image(combined_image, use_column_width=True, caption='Styled')
-
-            st.sidebar.button('Exit', on_click=delete_and_main, args=[st.session_state['folder_path']])
+                st.image(content, use_column_width=True, caption='Original')
+            styled = col2.empty()
+
+            with trace('stylization', profile=profile) as style_trace:
+                # A different alpha, style or segment makes the running refinement stale
+                refinement = st.session_state.get('refinement')
+                if refinement is not None and refinement[0] != request:
+                    cancel_refinement()
+                    refinement = None
+
+                # Run by the shared workers, batched with other sessions' requests
+                scheduler = InferenceScheduler.get()
+                try:
+                    if progressive and (refinement is None or not refinement[1].done()):
+                        preview = st.session_state.get('style_preview')
+                        if preview is None or preview[0] != request:
+                            preview = (request, scheduler.submit(render_preview, content, style_image, alpha, mask,
+                                                                 preview_cache).result())
+                            st.session_state['style_preview'] = preview
+                        styled.image(preview[1], use_column_width=True, caption='Styled (preview)')
+                    if refinement is None:
+                        refinement = (request, scheduler.submit(render_full, content, style_image, alpha, mask,
+                                                                full_cache))
+                        st.session_state['refinement'] = refinement
+                except SchedulerBusy as e:
+                    st.sidebar.error(f'The server is busy: {e}')
+                    return
+
+                # Updating the status lets Streamlit interrupt the wait when the user changes a widget
+                start = monotonic()
+                while not refinement[1].done():
+                    status.markdown(f'_Refining at full resolution... {monotonic() - start:.0f} s_')
+                    sleep(REFINE_POLL)
+                if refinement[1].exception() is not None:
+                    st.session_state.pop('refinement')  # Retried on the next run
+                combined_image: Image = refinement[1].result()
+            status.empty()
+            styled.image(combined_image, use_column_width=True, caption='Styled')
+            show_trace(style_trace)
+
+            # Encoded only on request, and only once per distinct result
+            if actions.button('Save result'):
+                st.session_state['result_path'] = (request, get_store().put_image(st.session_state['session_id'],
+                                                                                  combined_image))
+            saved = st.session_state.get('result_path')
+            # Only the result of the current alpha, style and segment, not one saved before they changed
+            if saved is not None and saved[0] == request and saved[1].exists():
+                actions.download_button('Download result', saved[1].read_bytes(), file_name='segify.png',
+                                        mime='image/png')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,237 @@
+"""
+Reduced-precision CPU inference for the VGG encoder and decoder, and a harness measuring what it costs in accuracy.
+
+Modes:
+    fp32   The checkpoints as they are.
+    bf16   bfloat16 autocast. The weights stay fp32, convolutions run in bf16 where the hardware supports it.
+    int8   Static post-training quantization (FX graph mode), calibrated over sample (content, style) pairs.
+Any mode can also run in the channels_last memory format. Every mode takes and returns fp32 NCHW tensors, so the
+rest of the pipeline is unchanged. PyTorch's dynamic quantization only covers linear and recurrent layers, so the
+convolutional networks here are quantized statically.
+
+Example:
+    python precision.py --content imgs/test_images/content --styles imgs/test_images/style \
+        --modes fp32 fp32:channels_last bf16 int8 int8:channels_last --size 512 --output precision.json
+"""
+import argparse
+import json
+from copy import deepcopy
+from math import log10
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from PIL import Image
+
+from adain import adaptive_instance_normalization
+from stylization import StyleTransferEngine, test_transform
+
+PRECISIONS = ('fp32', 'bf16', 'int8')
+CALIBRATION_DIR = Path('imgs/test_images')  # Default calibration images, in its `content` and `style` folders
+CALIBRATION_SIZE = 256
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg'}
+
+
+class PrecisionModule(nn.Module):
+    """Runs a module in the chosen precision and memory format, taking and returning fp32 NCHW tensors."""
+
+    def __init__(self, module: nn.Module, autocast_dtype: Optional[torch.dtype] = None, channels_last: bool = False):
+        """
+        :param module: The module to run.
+        :param autocast_dtype: If specified, the dtype to autocast to, e.g. torch.bfloat16. Default None
+        :param channels_last: Boolean to feed the module channels_last tensors. Default False
+        """
+        super().__init__()
+        self.module = module.to(memory_format=torch.channels_last) if channels_last else module
+        self.autocast_dtype = autocast_dtype
+        self.channels_last = channels_last
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(x.device.type, self.autocast_dtype, enabled=self.autocast_dtype is not None):
+            output = self.module(x)
+        # AdaIN and the tiling code take `view`s of the outputs, so hand back contiguous fp32
+        return output.float().contiguous()
+
+
+def list_images(directory: Path) -> List[Path]:
+    """List the image files of a directory, sorted by name."""
+    return sorted(p for p in directory.iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS)
+
+
+def default_calibration() -> List[Tuple[Image.Image, Image.Image]]:
+    """Pair the content images of `CALIBRATION_DIR` with its style images, in order."""
+    contents = list_images(CALIBRATION_DIR.joinpath('content'))
+    styles = list_images(CALIBRATION_DIR.joinpath('style'))
+    if not contents or not styles:
+        raise ValueError(f'No calibration images in {CALIBRATION_DIR}, pass `calibration` pairs explicitly')
+    return [(Image.open(c).convert('RGB'), Image.open(s).convert('RGB')) for c, s in zip(contents, styles)]
+
+
+def quantize_int8(module: nn.Module, inputs: Sequence[torch.Tensor]) -> nn.Module:
+    """
+    Quantize a module to int8 with static post-training quantization, calibrated on `inputs`.
+    The quantized module takes and returns float tensors and only runs on the CPU.
+    :param module: The fp32 module on the CPU.
+    :param inputs: Typical inputs, used to choose the activation ranges.
+    :return: The quantized module.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    prepared = prepare_fx(deepcopy(module).eval(), get_default_qconfig_mapping('x86'), (inputs[0],))
+    with torch.no_grad():
+        for x in inputs:
+            prepared(x)
+    return convert_fx(prepared)
+
+
+def optimize_modules(vgg: nn.Module, decoder: nn.Module, precision: str = 'fp32', channels_last: bool = False,
+                     calibration: Optional[Sequence[Tuple[Image.Image, Image.Image]]] = None,
+                     calibration_size: int = CALIBRATION_SIZE) -> Tuple[nn.Module, nn.Module]:
+    """
+    Wrap the encoder and decoder to run in a precision mode.
+    :param vgg: The fp32 VGG encoder, truncated at relu4_1.
+    :param decoder: The fp32 decoder.
+    :param precision: One of `PRECISIONS`. Default 'fp32'.
+    :param channels_last: Boolean to use the channels_last memory format. Default False
+    :param calibration: The (content, style) image pairs to calibrate 'int8' on. Default None, which uses
+        `default_calibration`.
+    :param calibration_size: The size the calibration images are resized to. Default `CALIBRATION_SIZE`.
+    :return: A 2-tuple of the encoder and decoder modules.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f'Unknown precision {precision!r}, expected one of {PRECISIONS}')
+    if precision != 'int8':
+        autocast_dtype = torch.bfloat16 if precision == 'bf16' else None
+        return PrecisionModule(vgg, autocast_dtype, channels_last), PrecisionModule(decoder, autocast_dtype,
+                                                                                    channels_last)
+
+    # The decoder is calibrated on the range between the content features (alpha 0) and the AdaIN targets (alpha 1)
+    transform = test_transform(calibration_size, False)
+    images, features = [], []
+    with torch.no_grad():
+        for content, style in calibration if calibration is not None else default_calibration():
+            content, style = transform(content).unsqueeze(0), transform(style).unsqueeze(0)
+            content_f, style_f = vgg(content), vgg(style)
+            images += [content, style]
+            features += [content_f, adaptive_instance_normalization(content_f, style_f)]
+    return (PrecisionModule(quantize_int8(vgg, images), None, channels_last),
+            PrecisionModule(quantize_int8(decoder, features), None, channels_last))
+
+
+def psnr(output: torch.Tensor, reference: torch.Tensor) -> float:
+    """The peak signal-to-noise ratio in dB of two images with values in [0, 1]."""
+    mse = F.mse_loss(output.clamp(0, 1), reference.clamp(0, 1)).item()
+    return float('inf') if mse == 0 else 10 * log10(1 / mse)
+
+
+def ssim(output: torch.Tensor, reference: torch.Tensor, window_size: int = 11, sigma: float = 1.5) -> float:
+    """
+    The structural similarity of two (N, C, H, W) images with values in [0, 1], averaged over the channels.
+    Uses the usual Gaussian window with constants (0.01)^2 and (0.03)^2.
+    """
+    x, y = output.clamp(0, 1).float(), reference.clamp(0, 1).float()
+    channels = x.size(1)
+    coords = torch.arange(window_size, dtype=torch.float32) - (window_size - 1) / 2
+    gauss = torch.exp(-coords ** 2 / (2 * sigma ** 2))
+    gauss = gauss / gauss.sum()
+    window = torch.outer(gauss, gauss).expand(channels, 1, window_size, window_size)
+
+    def filt(z):
+        return F.conv2d(z, window, groups=channels)
+
+    mu_x, mu_y = filt(x), filt(y)
+    var_x = filt(x * x) - mu_x ** 2
+    var_y = filt(y * y) - mu_y ** 2
+    cov = filt(x * y) - mu_x * mu_y
+    c1, c2 = 0.01 ** 2, 0.03 ** 2
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / ((mu_x ** 2 + mu_y ** 2 + c1) * (var_x + var_y + c2))
+    return ssim_map.mean().item()
+
+
+def evaluate(pairs: Sequence[Tuple[Image.Image, Image.Image]], modes: Sequence[str], size: int = 512,
+             alpha: float = 1.0, repeats: int = 3, vgg_path: str = 'models/vgg_normalised.pth',
+             decoder_path: str = 'models/decoder.pth',
+             calibration: Optional[Sequence[Tuple[Image.Image, Image.Image]]] = None) -> List[Dict]:
+    """
+    Stylize every (content, style) pair in each mode and compare the outputs with fp32.
+    :param pairs: The (content, style) image pairs to evaluate on.
+    :param modes: Modes as 'precision' or 'precision:channels_last', e.g. 'int8:channels_last'.
+    :param size: The content and style size. Default 512.
+    :param repeats: Timed runs per pair, of which the median is reported. Default 3.
+    :param calibration: The 'int8' calibration pairs. Default None, which uses `default_calibration`.
+    :return: One dictionary per mode with the mean PSNR and SSIM, the median time and the speedup over fp32.
+    """
+    reference = StyleTransferEngine(vgg_path, decoder_path, device='cpu')
+    prepared = [reference.prepare(content, style, size, size) for content, style in pairs]
+
+    def run(engine):
+        outputs, times = [], []
+        for content, style in prepared:
+            for _ in range(repeats):
+                start = perf_counter()
+                output = engine.transfer(content, style, alpha)
+                times.append((perf_counter() - start) * 1000)
+            outputs.append(output)
+        return outputs, median(times)
+
+    expected, reference_ms = run(reference)
+    results = []
+    for mode in modes:
+        precision, _, layout = mode.partition(':')
+        if layout not in ('', 'channels_last'):
+            raise ValueError(f'Unknown layout {layout!r} in mode {mode!r}')
+        engine = StyleTransferEngine(vgg_path, decoder_path, device='cpu', precision=precision,
+                                     channels_last=bool(layout), calibration=calibration)
+        outputs, ms = run(engine)
+        result = {'mode': mode, 'psnr': sum(map(psnr, outputs, expected)) / len(outputs),
+                  'ssim': sum(map(ssim, outputs, expected)) / len(outputs),
+                  'median_ms': ms, 'speedup': reference_ms / ms}
+        results.append(result)
+        print(f'{mode:>20}: PSNR {result["psnr"]:6.2f} dB, SSIM {result["ssim"]:.4f}, '
+              f'{ms:9.1f} ms ({result["speedup"]:.2f}x)')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the reduced-precision modes with fp32.')
+    parser.add_argument('--content', type=Path, default=CALIBRATION_DIR.joinpath('content'),
+                        help='Directory of content images. Default the test images.')
+    parser.add_argument('--styles', type=Path, default=CALIBRATION_DIR.joinpath('style'),
+                        help='Directory of style images, paired with the content images in order. '
+                             'Default the test images.')
+    parser.add_argument('--calibration', type=Path,
+                        help='Directory with `content` and `style` folders to calibrate int8 on. '
+                             'Default the test images.')
+    parser.add_argument('--modes', nargs='+', default=['fp32:channels_last', 'bf16', 'int8', 'int8:channels_last'],
+                        help="Modes as 'precision' or 'precision:channels_last'. "
+                             "Default fp32:channels_last bf16 int8 int8:channels_last.")
+    parser.add_argument('--size', type=int, default=512, help='Content and style size. Default 512.')
+    parser.add_argument('--alpha', type=float, default=1.0, help='Stylization weight. Default 1.0.')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed runs per image pair. Default 3.')
+    parser.add_argument('--vgg', default='models/vgg_normalised.pth', help='Path to the vgg model.')
+    parser.add_argument('--decoder', default='models/decoder.pth', help='Path to the decoder model.')
+    parser.add_argument('--output', type=Path, help='Path to save the results as JSON.')
+    args = parser.parse_args()
+
+    pairs = [(Image.open(c).convert('RGB'), Image.open(s).convert('RGB'))
+             for c, s in zip(list_images(args.content), list_images(args.styles))]
+    calibration = None
+    if args.calibration:
+        calibration = [(Image.open(c).convert('RGB'), Image.open(s).convert('RGB'))
+                       for c, s in zip(list_images(args.calibration.joinpath('content')),
+                                       list_images(args.calibration.joinpath('style')))]
+    results = evaluate(pairs, args.modes, args.size, args.alpha, args.repeats, args.vgg, args.decoder, calibration)
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+        print(f'Results saved at {args.output}')
+
+
+if __name__ == '__main__':
+    main()
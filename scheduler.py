@@ -0,0 +1,299 @@
+"""
+An in-process scheduler for the model calls of all Streamlit sessions.
+
+Pages submit their stylization and segmentation calls to the shared `InferenceScheduler` and wait on the returned
+futures, instead of running them on their own script threads. A fixed number of workers run the calls, so concurrent
+users no longer oversubscribe the cores. The queue in front of the workers is bounded, and a submission that does
+not get a place in time raises `SchedulerBusy`. While a call runs on a worker, the encoder and decoder forwards of
+`StyleTransferEngine` go through a `DynamicBatcher`, which stacks the forwards of concurrent requests into one
+batch. Inputs of different sizes share a batch when they round up to the same bucket: each is padded to the bucket's
+size, and its output is cropped back to the part computed from its own pixels. `InferenceScheduler.cancel` drops a
+queued call, or stops a running one at its next forward.
+
+Example:
+    future = InferenceScheduler.get().submit(stylize, content, style, alpha=0.8)
+    stylized = future.result()
+"""
+import os
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+from threading import BoundedSemaphore, Condition, Event, Lock, current_thread
+from time import monotonic
+from typing import Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+import torch
+import torch.nn.functional as F
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from streamlit.runtime.scriptrunner.script_run_context import SCRIPT_RUN_CONTEXT_ATTR_NAME
+
+from tracing import stage
+
+WORKERS = 2  # Default number of requests run at once
+MAX_QUEUED = 16  # Default number of requests waiting for a worker
+BATCH_WINDOW_MS = 15  # Default time a forward waits for same-shaped forwards of other requests of the same kind
+MAX_BATCH = 4  # Default largest number of forwards stacked into one batch
+BATCH_BUCKET = 64  # Default multiple the heights and widths of image inputs are padded to, to batch different sizes
+SUBMIT_TIMEOUT = 10.0  # Default seconds a submission waits for a place in the queue
+
+# The batcher of the request running on this thread, if any
+_batcher: ContextVar[Optional['DynamicBatcher']] = ContextVar('batcher', default=None)
+# Set when the request running on this thread is cancelled
+_stop: ContextVar[Optional[Event]] = ContextVar('stop', default=None)
+# The kind of the request running on this thread, the function it calls
+_kind: ContextVar[Optional[Hashable]] = ContextVar('kind', default=None)
+
+
+class SchedulerBusy(RuntimeError):
+    """Raised when the scheduler's queue stays full for the whole submission timeout."""
+
+
+class DynamicBatcher:
+    """
+    Stacks the forwards of concurrent requests that share a key (the module and the input shape rounded up to a
+    bucket) into one batch. The first forward of a batch waits up to `window_ms` for others while more requests that
+    could run the module are active than have joined, then runs the whole batch on its own thread and hands every
+    caller its slice of the output. Requests are told apart by kind, and only the kinds that ran the module before
+    count, so e.g. a running segmentation request does not hold up the forwards of a stylization. Inputs smaller than
+    the bucket are reflection padded to it, and their outputs cropped back to the valid extent, so the statistics
+    computed from them afterwards only cover the caller's own pixels. The pixels within the receptive field of the
+    padded edges differ slightly from an unpadded run.
+    """
+
+    def __init__(self, window_ms: float = BATCH_WINDOW_MS, max_batch: int = MAX_BATCH,
+                 active: Callable[[Set[Hashable]], int] = lambda kinds: 1):
+        """
+        :param window_ms: The longest time the first forward of a batch waits for others, in milliseconds.
+        :param max_batch: The largest number of forwards in a batch.
+        :param active: Returns the number of active requests of the given kinds, the most forwards that could join
+            a batch. It is passed the kinds of the requests that ran the batch's module so far.
+        """
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.active = active
+        self._pending: Dict[Hashable, List[Tuple[torch.Tensor, Future]]] = {}
+        self._kinds: Dict[Callable, Set[Hashable]] = {}  # The kinds of requests that ran each module
+        self._condition = Condition(Lock())
+
+    def wake(self):
+        """Let waiting forwards check again whether others can still join, e.g. when a request finished."""
+        with self._condition:
+            self._condition.notify_all()
+
+    def run(self, module: Callable[[torch.Tensor], torch.Tensor], x: torch.Tensor, bucket: int = 1) -> torch.Tensor:
+        """
+        Run `module` on a batch of one, stacked with the inputs of the same bucket other requests pass meanwhile.
+        :param module: The network, applied to each sample independently (e.g. no batch normalization in training),
+            whose output height and width scale with those of its input.
+        :param x: The input of shape (1, C, H, W).
+        :param bucket: The multiple the height and width are rounded up to. Default 1, which only batches inputs of
+            the same shape.
+        :return: The output for `x`.
+        """
+        shape = (*x.shape[:-2], *(-(-size // bucket) * bucket for size in x.shape[-2:]))
+        key = (module, shape, x.dtype, x.device)
+        future = Future()
+        with self._condition:
+            kinds = self._kinds.setdefault(module, set())
+            kinds.add(_kind.get())
+            batch = self._pending.setdefault(key, [])
+            batch.append((x, future))
+            leader = len(batch) == 1
+            if len(batch) >= self.max_batch:
+                del self._pending[key]  # Full, later forwards start the next batch
+            self._condition.notify_all()
+            if leader:
+                deadline = monotonic() + self.window
+                while len(batch) < min(self.max_batch, self.active(kinds)):
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                if self._pending.get(key) is batch:
+                    del self._pending[key]
+
+        if leader:
+            try:
+                with stage('batched forward', batch=len(batch)):
+                    if len(batch) > 1:
+                        outputs = module(torch.cat([_pad_to(item, shape) for item, _ in batch]))
+                    else:
+                        outputs = module(x)  # Alone, so run unpadded
+                for (item, waiting), output in zip(batch, outputs.split(1)):
+                    waiting.set_result(_crop_to(output, item.shape, shape) if len(batch) > 1 else output)
+            except BaseException as e:
+                for _, waiting in batch:
+                    waiting.set_exception(e)
+        return future.result()
+
+
+def _pad_to(x: torch.Tensor, shape: Tuple[int, ...]) -> torch.Tensor:
+    """Pad the bottom and right of an (N, C, H, W) tensor to `shape`, reflecting where the input is large enough."""
+    pad_h, pad_w = shape[-2] - x.size(-2), shape[-1] - x.size(-1)
+    if not pad_h and not pad_w:
+        return x
+    mode = 'reflect' if pad_h < x.size(-2) and pad_w < x.size(-1) else 'replicate'
+    return F.pad(x, (0, pad_w, 0, pad_h), mode=mode)
+
+
+def _crop_to(output: torch.Tensor, input_shape: Tuple[int, ...], padded_shape: Tuple[int, ...]) -> torch.Tensor:
+    """Crop the output of a padded input to the extent computed from the input's valid part, rounding up."""
+    height = -(-input_shape[-2] * output.size(-2) // padded_shape[-2])
+    width = -(-input_shape[-1] * output.size(-1) // padded_shape[-1])
+    return output[..., :height, :width].contiguous()  # Later steps `view` it, like an unpadded output
+
+
+def check_cancelled():
+    """
+    Stop the running request if it was cancelled with `InferenceScheduler.cancel`. Call between steps of long loops.
+    :raises CancelledError: If the request was cancelled.
+    """
+    stop = _stop.get()
+    if stop is not None and stop.is_set():
+        raise CancelledError('The request was cancelled')
+
+
+def batched_forward(module: Callable[[torch.Tensor], torch.Tensor], x: torch.Tensor, bucket: int = 1) -> torch.Tensor:
+    """
+    Run `module` on `x`, through the batcher of the running request when it is scheduled, else directly.
+    :param bucket: The multiple inputs are padded to for batching, see `DynamicBatcher.run`. Default 1
+    """
+    check_cancelled()
+    batcher = _batcher.get()
+    return module(x) if batcher is None or x.size(0) != 1 else batcher.run(module, x, bucket)
+
+
+def _count(counts: Dict[Hashable, int], key: Hashable, change: int):
+    # Add `change` to a count, removing counts that drop to 0
+    counts[key] = counts.get(key, 0) + change
+    if not counts[key]:
+        del counts[key]
+
+
+class InferenceScheduler:
+    """
+    Runs model calls on a fixed pool of workers behind a bounded queue, batching their forwards across requests.
+    Use `InferenceScheduler.get` to share one scheduler per configuration between Streamlit sessions.
+    """
+
+    _instances: Dict[Tuple, 'InferenceScheduler'] = {}
+    _instances_lock = Lock()
+
+    def __init__(self, workers: int = WORKERS, threads_per_worker: Optional[int] = None,
+                 max_queued: int = MAX_QUEUED, batch_window_ms: float = BATCH_WINDOW_MS,
+                 max_batch: int = MAX_BATCH, submit_timeout: float = SUBMIT_TIMEOUT):
+        """
+        :param workers: The number of requests run at once. Default `WORKERS`.
+        :param threads_per_worker: The torch threads per request. Default None, which splits the cores evenly.
+            Note that this sets torch's process-wide intra-op thread count.
+        :param max_queued: The number of requests that can wait for a worker. Default `MAX_QUEUED`.
+        :param batch_window_ms: The time a forward waits for others to batch with, in ms. Default `BATCH_WINDOW_MS`.
+        :param max_batch: The largest number of forwards in a batch. Default `MAX_BATCH`.
+        :param submit_timeout: The seconds `submit` waits for a place in the queue. Default `SUBMIT_TIMEOUT`.
+        """
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+        self.submit_timeout = submit_timeout
+        torch.set_num_threads(self.threads_per_worker)
+
+        self._slots = BoundedSemaphore(workers + max_queued)  # Running and waiting requests
+        self._running = 0
+        self._running_kinds: Dict[Hashable, int] = {}  # The number of running requests per kind
+        self._submitted_kinds: Dict[Hashable, int] = {}  # The number of queued and running requests per kind
+        self._running_lock = Lock()
+        self._stops: Dict[Future, Event] = {}  # The cancellation flags of the submitted calls
+        self.batcher = DynamicBatcher(batch_window_ms, max_batch, self._could_join)
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='inference')
+
+    @classmethod
+    def get(cls, workers: int = WORKERS, threads_per_worker: Optional[int] = None, max_queued: int = MAX_QUEUED,
+            batch_window_ms: float = BATCH_WINDOW_MS, max_batch: int = MAX_BATCH) -> 'InferenceScheduler':
+        """
+        Get the shared scheduler for the given configuration, starting it on first use.
+        :return: The InferenceScheduler object.
+        """
+        key = (workers, threads_per_worker, max_queued, batch_window_ms, max_batch)
+        with cls._instances_lock:
+            scheduler = cls._instances.get(key)
+            if scheduler is None:
+                scheduler = cls(workers, threads_per_worker, max_queued, batch_window_ms, max_batch)
+                cls._instances[key] = scheduler
+        return scheduler
+
+    @property
+    def running(self) -> int:
+        """The number of requests running on the workers."""
+        return self._running
+
+    def _could_join(self, kinds: Set[Hashable]) -> int:
+        # The running requests of the kinds, and the queued ones that a free worker can start meanwhile
+        with self._running_lock:
+            running = sum(count for kind, count in self._running_kinds.items() if kind in kinds)
+            submitted = sum(count for kind, count in self._submitted_kinds.items() if kind in kinds)
+            return running + min(submitted - running, self.workers - self._running)
+
+    def submit(self, func: Callable, *args, **kwargs) -> Future:
+        """
+        Queue a call to run on a worker. The call sees the caller's active trace and Streamlit session, so its stages
+        are recorded and `st.session_state` and cached functions work as on the script thread. Its forwards are
+        batched with those of running calls of the same function.
+        :return: The Future object of the call's result. Cancelling it before it starts removes it from the queue.
+        :raises SchedulerBusy: If the queue stays full for `submit_timeout` seconds.
+        """
+        if not self._slots.acquire(timeout=self.submit_timeout):
+            raise SchedulerBusy(f'{self.workers} requests are running and the queue is full, try again shortly')
+        context, script_ctx, stop = copy_context(), get_script_run_ctx(suppress_warning=True), Event()
+        with self._running_lock:
+            _count(self._submitted_kinds, func, 1)
+        try:
+            future = self._executor.submit(context.run, self._run, script_ctx, stop, func, args, kwargs)
+        except BaseException:
+            with self._running_lock:
+                _count(self._submitted_kinds, func, -1)
+            self._slots.release()
+            raise
+        self._stops[future] = stop
+        future.add_done_callback(lambda done: self._done(done, func))
+        return future
+
+    def _done(self, future: Future, func: Callable):
+        self._stops.pop(future, None)
+        with self._running_lock:
+            _count(self._submitted_kinds, func, -1)
+        self.batcher.wake()  # Forwards waiting for this request stop waiting
+        self._slots.release()
+
+    def cancel(self, future: Future) -> bool:
+        """
+        Cancel a submitted call. A queued call is removed from the queue, a running one raises CancelledError at its
+        next forward (or tile, see `check_cancelled`), so the worker is free for other requests soon.
+        :return: Boolean, whether the call was cancelled. False if it already finished.
+        """
+        if future.cancel():
+            return True
+        stop = self._stops.get(future)
+        if stop is None or future.done():
+            return False
+        stop.set()
+        return True
+
+    def _run(self, script_ctx, stop: Event, func: Callable, args: Tuple, kwargs: Dict):
+        thread = current_thread()
+        setattr(thread, SCRIPT_RUN_CONTEXT_ATTR_NAME, script_ctx)  # What `add_script_run_ctx` does, undone below
+        token, stop_token, kind_token = _batcher.set(self.batcher), _stop.set(stop), _kind.set(func)
+        with self._running_lock:
+            self._running += 1
+            _count(self._running_kinds, func, 1)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._running_lock:
+                self._running -= 1
+                _count(self._running_kinds, func, -1)
+            _kind.reset(kind_token)
+            _stop.reset(stop_token)
+            _batcher.reset(token)
+            setattr(thread, SCRIPT_RUN_CONTEXT_ATTR_NAME, None)  # The worker serves other sessions next
+
+    def shutdown(self):
+        """Stop the workers once the queued requests are done."""
+        self._executor.shutdown()
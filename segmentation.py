@@ -1,22 +1,34 @@
+from collections import OrderedDict
 from pathlib import Path
+from threading import Lock
 
 import torch
 import numpy as np
-from typing import List
-from streamlit import cache_data
-from utils import get_model
-from segment_anything import sam_model_registry, SamAutomaticMaskGenerator
+from typing import Dict, List, Optional, Sequence, Tuple
+from streamlit import cache_resource
+from masks import CompactMask
+from tracing import stage
+from utils import get_model, image_hash
+from segment_anything import sam_model_registry, SamAutomaticMaskGenerator, SamPredictor
+from segment_anything.modeling import Sam
+from segment_anything.utils.amg import batch_iterator, batched_mask_to_box, build_point_grid, \
+    calculate_stability_score
+from torchvision.ops.boxes import batched_nms
 
+SAM_NAME = "sam_vit_b_01ec64.pth"
+SAM_URL = 'https://dl.fbaipublicfiles.com/segment_anything/sam_vit_b_01ec64.pth'
+# As recorded in the repository's Git LFS pointer (375042383 bytes)
+SAM_SHA256 = 'ec2df62732614e57411cdcf32a23ffdf28910380d03139ee0f4fcbe91eb8c912'
 
+
+@cache_resource(show_spinner=False)
 def init():
-    """Initialize the models."""
+    """Initialize the models. The checks and the download run once per process, not on every rerun."""
 
     model_dir = 'models'
-    model_name = "sam_vit_b_01ec64.pth"
-    model_file = Path(model_dir, model_name)  # Use Path object
+    model_file = Path(model_dir, SAM_NAME)  # Use Path object
 
-    response = get_model(model_name, 'https://dl.fbaipublicfiles.com/segment_anything/sam_vit_b_01ec64.pth',
-                         model_dir)
+    response = get_model(SAM_NAME, SAM_URL, model_dir, sha256_digest=SAM_SHA256, segments=4)
     if not response[0]:  # Check if the file downloaded successfully
         print(response[1])
         exit()
@@ -29,25 +41,234 @@ def init():
     return model_file, model_type, device
 
 
-@cache_data(ttl=10*60, show_spinner="Performing segmentation")
-def perform_segmentation(uploaded_image, num_masks, model_file, model_type, device) -> List[np.ndarray]:
-    sam = sam_model_registry[model_type](checkpoint=model_file).to(device=torch.device(device))
+@cache_resource(show_spinner="Loading the segmentation model")
+def load_sam(model_file, model_type, device) -> Sam:
+    """
+    Load the SAM model once per checkpoint, model type and device and keep it resident.
+    :return: The SAM model in eval mode on `device`.
+    """
+    with stage('model load', model='sam'):
+        sam = sam_model_registry[model_type](checkpoint=model_file)
+        return sam.to(device=torch.device(device)).eval()
+
+
+class EmbeddingCache:
+    """A small thread-safe LRU store of SAM image embeddings, keyed by model and image content hash."""
+
+    def __init__(self, max_entries: int = 8):
+        """
+        :param max_entries: The number of embeddings to keep. Default 8.
+        """
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Tuple) -> Dict:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: Tuple, entry: Dict):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+embedding_cache = EmbeddingCache()
+
+
+class CachedEmbeddingPredictor(SamPredictor):
+    """
+    A SamPredictor that restores the image embedding from `embedding_cache` when the same image has already been
+    encoded by the same model, instead of running the ViT image encoder again.
+    """
+
+    def __init__(self, sam_model: Sam, model_key: Tuple):
+        """
+        :param sam_model: The SAM model.
+        :param model_key: A hashable identifying the model's weights and device, e.g. (model_file, model_type, device).
+        """
+        super().__init__(sam_model)
+        self.model_key = model_key
+
+    def set_image(self, image: np.ndarray, image_format: str = "RGB") -> None:
+        key = (self.model_key, image_format, image_hash(image))
+        entry = embedding_cache.get(key)
+        if entry is None:
+            with stage('SAM embedding'):
+                super().set_image(image, image_format)
+            embedding_cache.put(key, {'features': self.features, 'original_size': self.original_size,
+                                      'input_size': self.input_size})
+            return
+
+        self.reset_image()
+        self.features = entry['features']
+        self.original_size = entry['original_size']
+        self.input_size = entry['input_size']
+        self.is_image_set = True
+
+
+@cache_resource(ttl=10*60, max_entries=8, show_spinner="Performing segmentation")
+def generate_masks(image_key: str, _uploaded_image: np.ndarray, model_file, model_type,
+                   device) -> List[CompactMask]:
+    """
+    Generate every SAM mask for an image, sorted by area (largest first).
+    The result is cached by `image_key`, the content hash of the image, so the image array itself is not hashed.
+    :return: A list of CompactMask objects of the original image's shape.
+    """
+    sam = load_sam(model_file, model_type, device)
 
-    # Automatic mask generation
+    # Automatic mask generation, reusing a cached image embedding if one exists
     mask_generator = SamAutomaticMaskGenerator(sam)
+    mask_generator.predictor = CachedEmbeddingPredictor(sam, (str(model_file), model_type, str(device)))
 
     # Generate a list of dictionaries describing individual segmentations
-    output_mask = mask_generator.generate(uploaded_image)
+    with stage('mask generation'):
+        output_mask = mask_generator.generate(_uploaded_image)
 
     # Sort the segments by their area
     sorted_masks = sorted(output_mask, key=(lambda x: x['area']), reverse=True)
 
-    out_masks = []  # List to hold the top `num_masks` by area
-    for i, val in enumerate(sorted_masks):
-        if i + 1 > num_masks:
-            break
-        # Append the mask (a value corresponding to 'segmentation' key)
-        out_masks.append(val['segmentation'])
+    # Keep the mask (a value corresponding to 'segmentation' key), bit-packed for the cache
+    return [CompactMask.from_dense(val['segmentation']) for val in sorted_masks]
+
+
+def fast_masks(sam: Sam, image: np.ndarray, num_masks: int, model_key: Tuple,
+               points_per_side: Sequence[int] = (4, 8, 16), points_per_batch: int = 64,
+               pred_iou_thresh: float = 0.86, stability_score_thresh: float = 0.9,
+               stability_score_offset: float = 1.0, box_nms_thresh: float = 0.7,
+               min_area_fraction: float = 0.01) -> List[CompactMask]:
+    """
+    Approximate automatic mask generation that stops once `num_masks` large masks are found.
+    Point grids are evaluated from coarse to fine, and no finer grid runs once the masks kept so far include
+    `num_masks` covering at least `min_area_fraction` of the image each. Unlike `SamAutomaticMaskGenerator`, which
+    upsamples every candidate to the image's resolution, masks are filtered and deduplicated on SAM's 256 x 256 low
+    resolution output and only the returned ones are upsampled. There are no crop layers, as each would need its own
+    image embedding.
+    :param sam: The SAM model.
+    :param image: The image as an (H, W, 3) uint8 array.
+    :param num_masks: The number of masks wanted.
+    :param model_key: A hashable identifying the model, see `CachedEmbeddingPredictor`.
+    :param points_per_side: The point grids to try in turn, as points per side. Default (4, 8, 16).
+    The remaining parameters are as in `SamAutomaticMaskGenerator`.
+    :return: Up to `num_masks` CompactMask objects of the image's shape, sorted by area (largest first).
+    """
+    predictor = CachedEmbeddingPredictor(sam, model_key)
+    predictor.set_image(image)
+    H, W = predictor.original_size
+    # The part of the low resolution masks covering the image, the rest covers the padding of SAM's input
+    h, w = (-(-side * 256 // sam.image_encoder.img_size) for side in predictor.input_size)
+    min_area = min_area_fraction * h * w
+
+    logits, iou_preds = torch.empty(0, 256, 256), torch.empty(0)
+    with torch.no_grad(), stage('mask generation', fast=True):
+        for n in points_per_side:
+            found_logits, found_iou_preds = [logits], [iou_preds]
+            for (points,) in batch_iterator(points_per_batch, build_point_grid(n) * np.array([[W, H]])):
+                coords = torch.as_tensor(predictor.transform.apply_coords(points, (H, W)), device=predictor.device)
+                labels = torch.ones(len(coords), dtype=torch.int, device=predictor.device)
+                sparse, dense = sam.prompt_encoder(points=(coords[:, None, :], labels[:, None]), boxes=None, masks=None)
+                batch_logits, batch_iou_preds = sam.mask_decoder(
+                    image_embeddings=predictor.features, image_pe=sam.prompt_encoder.get_dense_pe(),
+                    sparse_prompt_embeddings=sparse, dense_prompt_embeddings=dense, multimask_output=True)
+                batch_logits, batch_iou_preds = batch_logits.flatten(0, 1).cpu(), batch_iou_preds.flatten().cpu()
+
+                stability = calculate_stability_score(batch_logits[:, :h, :w], sam.mask_threshold,
+                                                      stability_score_offset)
+                keep = (batch_iou_preds > pred_iou_thresh) & (stability >= stability_score_thresh)
+                found_logits.append(batch_logits[keep])
+                found_iou_preds.append(batch_iou_preds[keep])
+
+            logits, iou_preds = torch.cat(found_logits), torch.cat(found_iou_preds)
+            masks = logits[:, :h, :w] > sam.mask_threshold
+            keep = batched_nms(batched_mask_to_box(masks).float(), iou_preds, torch.zeros(len(masks)),
+                               iou_threshold=box_nms_thresh)
+            logits, iou_preds, areas = logits[keep], iou_preds[keep], masks[keep].sum((1, 2))
+            if (areas >= min_area).sum() >= num_masks:
+                break  # Finer grids would only add smaller or duplicate masks
+
+        if not len(logits):
+            return []
+        largest = logits[areas.argsort(descending=True)[:num_masks]]
+        masks = sam.postprocess_masks(largest[:, None].to(predictor.device), predictor.input_size, (H, W))
+    return [CompactMask.from_dense(mask) for mask in (masks[:, 0] > sam.mask_threshold).cpu().numpy()]
+
+
+@cache_resource(ttl=10*60, max_entries=8, show_spinner="Performing segmentation")
+def generate_masks_fast(image_key: str, _uploaded_image: np.ndarray, num_masks: int, model_file, model_type,
+                        device) -> List[CompactMask]:
+    """
+    Cached `fast_masks` of an image, keyed like `generate_masks`.
+    :return: A list of up to `num_masks` CompactMask objects of the original image's shape, largest first.
+    """
+    sam = load_sam(model_file, model_type, device)
+    return fast_masks(sam, _uploaded_image, num_masks, (str(model_file), model_type, str(device)))
+
+
+def embed_image(uploaded_image: np.ndarray, model_file, model_type, device) -> CachedEmbeddingPredictor:
+    """
+    Get a predictor holding the SAM embedding of an image. The embedding is computed once per image and model and
+    shared with `generate_masks`.
+    :return: The CachedEmbeddingPredictor object, ready for `predict`.
+    """
+    predictor = CachedEmbeddingPredictor(load_sam(model_file, model_type, device),
+                                         (str(model_file), model_type, str(device)))
+    predictor.set_image(uploaded_image)
+    return predictor
+
+
+def predict_mask(uploaded_image: np.ndarray, model_file, model_type, device,
+                 points: Optional[Sequence[Tuple[float, float]]] = None, labels: Optional[Sequence[int]] = None,
+                 box: Optional[Tuple[float, float, float, float]] = None) -> CompactMask:
+    """
+    Segment the region marked by point and/or box prompts. Only SAM's light mask decoder runs per call, as the image
+    embedding comes from `embed_image`.
+    :param uploaded_image: The image as an (H, W, 3) uint8 array.
+    :param points: The (x, y) pixel coordinates of the clicked points. Default None
+    :param labels: One label per point, 1 for the region and 0 for the background. Default None, which marks every
+        point as part of the region.
+    :param box: The (left, top, right, bottom) pixel coordinates of a box around the region. Default None
+    :return: The CompactMask object of the original image's shape.
+    """
+    if not points and box is None:
+        raise ValueError('At least one point or a box is needed')
+    predictor = embed_image(uploaded_image, model_file, model_type, device)
+
+    point_coords, point_labels = None, None
+    if points:
+        point_coords = np.asarray(points, dtype=np.float32)
+        point_labels = np.asarray(labels if labels is not None else [1] * len(points))
+    # A single point is ambiguous (e.g. a shirt or the whole person), so SAM proposes three masks to pick from
+    multimask = box is None and len(points) == 1
+
+    with stage('SAM prompt'):
+        masks, scores, _ = predictor.predict(point_coords, point_labels,
+                                             None if box is None else np.asarray(box, dtype=np.float32),
+                                             multimask_output=multimask)
+    return CompactMask.from_dense(masks[np.argmax(scores)])
+
+
+def perform_segmentation(uploaded_image, num_masks, model_file, model_type, device,
+                         fast: bool = False) -> List[CompactMask]:
+    """
+    Get the `num_masks` largest segments of an image.
+    Changing only `num_masks` is served from the cached mask set of the image.
+    :param fast: Boolean to use `fast_masks`, whose latency grows with `num_masks` rather than always running the full
+        point grid. Default False
+    :return: A list of CompactMask objects of the original image's shape.
+    """
+    if fast:
+        return generate_masks_fast(image_hash(uploaded_image), uploaded_image, num_masks, model_file, model_type,
+                                   device)
+    masks = generate_masks(image_hash(uploaded_image), uploaded_image, model_file, model_type, device)
 
-    # The return type contains are boolean masks of the original image's shape
-    return out_masks
+    # The return type contains are CompactMask objects of the original image's shape
+    return masks[:num_masks]
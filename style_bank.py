@@ -0,0 +1,150 @@
+from hashlib import blake2b
+from pathlib import Path
+from threading import Lock
+from typing import Dict, NamedTuple, Optional, Union
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.utils import save_image
+
+from adain import coral_from_stats, coral_stats
+from stylization import CORAL_MAX_SAMPLES, StyleTransferEngine, test_transform
+from utils import image_hash
+
+# One fixed-size record per registered style image
+RECORD_DTYPE = np.dtype([
+    ('key', 'S32'),
+    ('feat_mean', '<f4', (512,)),  # relu4_1 per-channel mean
+    ('feat_std', '<f4', (512,)),  # relu4_1 per-channel std
+])
+
+
+class StyleStats(NamedTuple):
+    """The precomputed statistics of a style image, as stored in a StyleBank."""
+    key: str
+    feat_mean: torch.Tensor  # (1, 512, 1, 1)
+    feat_std: torch.Tensor  # (1, 512, 1, 1)
+
+
+class StyleBank:
+    """
+    An append-only, memory-mapped file of style statistics keyed by a hash of the style image.
+    Registering a style runs the VGG encoder on it once; stylizing from the bank then skips the style encoder pass.
+    The statistics depend on the VGG weights, so a bank file should only be used with one encoder.
+    """
+
+    def __init__(self, path: Union[str, Path] = 'models/style_bank_v2.bin'):
+        """
+        :param path: The path to the bank file. It is created on the first registration.
+            Default 'models/style_bank_v2.bin', as files of the older record layout cannot be read.
+        """
+        self.path = Path(path)
+        self._lock = Lock()
+        self._records: Optional[np.memmap] = None
+        self._index: Dict[str, int] = {}
+        self._refresh()
+
+    def _refresh(self):
+        """Re-map the file, picking up records appended since it was last read (possibly by another process)."""
+        num_records = self.path.stat().st_size // RECORD_DTYPE.itemsize if self.path.exists() else 0
+        if num_records == len(self._index):
+            return
+        self._records = np.memmap(self.path, dtype=RECORD_DTYPE, mode='r', shape=(num_records,))
+        self._index = {key.decode(): i for i, key in enumerate(self._records['key'])}
+
+    @staticmethod
+    def key(style: Image, style_size: int = 0, crop: bool = False) -> str:
+        """
+        The bank key of a style image under the given transform settings.
+        :return: A 32 character hex string.
+        """
+        digest = blake2b(f'{image_hash(style)}{style_size}{crop}'.encode(), digest_size=16)
+        return digest.hexdigest()
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._index)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def get(self, key: str) -> Optional[StyleStats]:
+        """
+        Get the statistics stored under `key`.
+        :return: The StyleStats object, or None if the key is not in the bank.
+        """
+        with self._lock:
+            if key not in self._index:
+                self._refresh()
+            if key not in self._index:
+                return None
+            record = self._records[self._index[key]]
+
+        return StyleStats(key,
+                          torch.from_numpy(record['feat_mean'].copy()).view(1, -1, 1, 1),
+                          torch.from_numpy(record['feat_std'].copy()).view(1, -1, 1, 1))
+
+    def register(self, style: Image, engine: StyleTransferEngine, style_size: int = 0,
+                 crop: bool = False) -> StyleStats:
+        """
+        Compute and store the statistics of a style image, unless it is already in the bank.
+        :param style: The Image object representing the style image.
+        :param engine: The StyleTransferEngine whose encoder computes the feature statistics.
+        :param style_size: The (minimum) size for the style image, keeping the original size if set to 0 (default).
+        :param crop: Boolean to center crop to create square image. Default False.
+        :return: The StyleStats object for the style image.
+        """
+        key = self.key(style, style_size, crop)
+        stats = self.get(key)
+        if stats is not None:
+            return stats
+
+        style = test_transform(style_size, crop)(style.convert('RGB'))
+        feat_mean, feat_std = engine.style_stats(style)
+
+        record = np.zeros(1, dtype=RECORD_DTYPE)
+        record['key'] = key
+        record['feat_mean'] = feat_mean.float().cpu().view(-1).numpy()
+        record['feat_std'] = feat_std.float().cpu().view(-1).numpy()
+
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open('ab') as f:
+                f.write(record.tobytes())
+            self._refresh()
+
+        return self.get(key)
+
+
+def stylize_with_stats(content: Image, stats: StyleStats,
+                       vgg_path: str = 'models/vgg_normalised.pth', decoder_path: str = 'models/decoder.pth',
+                       content_size: int = 0, crop: bool = False,
+                       output_dir: Union[str, Path, None] = None, output_file_name: str = 'stylized_mask.png',
+                       preserve_color: bool = True, alpha: float = 1.0) -> torch.Tensor:
+    """
+    Like `stylization.stylize`, but with a StyleBank entry instead of a style image, so the style is never encoded.
+    With `preserve_color`, the CORAL colour transform from the output's colours to the content's colours is applied
+    to the stylized output rather than to the style image, since the stored statistics are of the unaltered style.
+    This approximates `stylize(..., preserve_color=True)`, which recolours the style image before encoding it.
+    :param content: The Image object representing the content image.
+    :param stats: The StyleStats object from `StyleBank.register` or `StyleBank.get`.
+    :return: torch.Tensor representing the final image.
+    """
+    engine = StyleTransferEngine.get(vgg_path, decoder_path)
+
+    content = test_transform(content_size, crop)(content)
+    output = engine.transfer_with_stats(content.to(engine.device, engine.dtype).unsqueeze(0),
+                                        stats.feat_mean, stats.feat_std, alpha)
+
+    if preserve_color:
+        output = coral_from_stats(output[0], coral_stats(output[0], CORAL_MAX_SAMPLES),
+                                  coral_stats(content, CORAL_MAX_SAMPLES)).unsqueeze(0)
+
+    if output_dir:
+        output_dir = Path(output_dir)
+        output_dir.mkdir(exist_ok=True, parents=True)
+        save_image(output, str(output_dir.joinpath(output_file_name)))
+
+    return output
@@ -1,18 +1,66 @@
+import json
+import os
+from copy import deepcopy
 from pathlib import Path
-from typing import Union
+from threading import Lock
+from typing import Dict, List, MutableMapping, NamedTuple, Optional, Sequence, Tuple, Union
 
+import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from PIL import Image
+from streamlit import cache_resource
 from torchvision import transforms
 from torchvision.utils import save_image
 
-from adain import adaptive_instance_normalization, coral
-import adain_net
+from adain import adaptive_instance_normalization, adaptive_instance_normalization_from_stats, calc_mean_std, \
+    calc_mean_std_masked, coral
+from masks import CompactMask
+from scheduler import BATCH_BUCKET, batched_forward, check_cancelled
+from tracing import stage
+from utils import get_model, image_hash
 
 
 # Adapted from https://github.com/naoto0804/pytorch-AdaIN/tree/master
 
+# Half the receptive field of the encoder (up to relu4_1) followed by the decoder, in pixels.
+# Padding a region by this much keeps the crop's border from affecting the stylized pixels inside the mask.
+REGION_PADDING = 64
+
+# The number of pixels CORAL estimates the colour statistics of an image from
+CORAL_MAX_SAMPLES = 2 ** 16
+
+# Rough peak bytes of encoder and decoder activations per pixel of a float32 tile, used to size tiles
+TILE_BYTES_PER_PIXEL = 1024
+# Half the width of the strip in which neighbouring tiles are blended, in pixels
+TILE_BLEND = 16
+
+VGG_NAME = "vgg_normalised.pth"
+VGG_URL = "https://github.com/naoto0804/pytorch-AdaIN/releases/download/v0.0.0/vgg_normalised.pth"
+# As recorded in the repository's Git LFS pointer (80102481 bytes)
+VGG_SHA256 = "804ca2835ecf7539f0cd2a7ac3c18ce81e6f8468969ae7117ac0c148d286bb4a"
+
+# Where `export_models.py` saves the frozen networks
+ARTIFACT_DIR = Path('models')
+
+
+@cache_resource(show_spinner=False)
+def init():
+    """Initialize the models. The checks and the download run once per process, not on every rerun."""
+
+    model_dir = 'models'
+
+    response = get_model(VGG_NAME,
+                         VGG_URL,
+                         model_dir,
+                         sha256_digest=VGG_SHA256)
+
+    if not response[0]:  # Check if the file downloaded successfully
+        print(response[1])
+        exit()
+
+
 def test_transform(size, crop):
     transform_list = []
     if size != 0:
@@ -24,6 +72,50 @@ def test_transform(size, crop):
     return transform
 
 
+def mask_transform(size, crop):
+    # the geometric part of `test_transform` for a boolean mask, with nearest-neighbour resizing
+    transform_list = []
+    if size != 0:
+        transform_list.append(transforms.Resize(size, interpolation=transforms.InterpolationMode.NEAREST))
+    if crop:
+        transform_list.append(transforms.CenterCrop(size))
+    transform_list.append(transforms.PILToTensor())
+    transform = transforms.Compose([lambda mask: Image.fromarray(np.asarray(mask, dtype=np.uint8) * 255)] +
+                                   transform_list + [lambda mask: mask > 127])
+    return transform
+
+
+def tile_size_for_budget(memory_budget_mb: float) -> int:
+    """
+    The largest tile side (a multiple of 8, at least 64) whose padded tile fits in the memory budget.
+    :param memory_budget_mb: The memory budget for the activations of one tile, in MiB.
+    """
+    side = int((memory_budget_mb * 2 ** 20 / TILE_BYTES_PER_PIXEL) ** 0.5) - 2 * REGION_PADDING
+    return max(side // 8 * 8, 64)
+
+
+def _tiles(H, W, tile_size):
+    # yield the (top, left, bottom, right) core box of each tile and the box padded by REGION_PADDING;
+    # starts are multiples of 8, so the pooling grid of every tile lines up with that of the full image
+    for top in range(0, H, tile_size):
+        for left in range(0, W, tile_size):
+            bottom, right = min(top + tile_size, H), min(left + tile_size, W)
+            yield (top, left, bottom, right), (max(top - REGION_PADDING, 0), max(left - REGION_PADDING, 0),
+                                               min(bottom + REGION_PADDING, H), min(right + REGION_PADDING, W))
+
+
+def _blend_ramp(start, end, core_start, core_end, length):
+    # 1D weights over [start, end) that ramp over 2 * TILE_BLEND pixels around each core edge shared with a
+    # neighbouring tile; the ramps of two neighbours sum to 1, so the weights of all tiles form a partition of unity
+    pos = torch.arange(start, end, dtype=torch.float32) + 0.5
+    weight = torch.ones(end - start)
+    if core_start > 0:
+        weight = torch.minimum(weight, (pos - core_start + TILE_BLEND) / (2 * TILE_BLEND))
+    if core_end < length:
+        weight = torch.minimum(weight, (core_end + TILE_BLEND - pos) / (2 * TILE_BLEND))
+    return weight
+
+
 def style_transfer(vgg, decoder, content, style, device, alpha=1.0, interpolation_weights=None):
     assert (0.0 <= alpha <= 1.0)
     content_f = vgg(content)
@@ -41,11 +133,441 @@ def style_transfer(vgg, decoder, content, style, device, alpha=1.0, interpolatio
     return decoder(feat)
 
 
+def default_device() -> torch.device:
+    """The device used when none is given: the first GPU if available, otherwise the CPU."""
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def artifact_path(precision: str = 'fp32', channels_last: bool = False,
+                  directory: Union[str, Path] = ARTIFACT_DIR) -> Path:
+    """The path of the frozen networks of a precision mode, as saved by `export_models.py`."""
+    return Path(directory).joinpath(f'adain_{precision}{"_channels_last" if channels_last else ""}.pt')
+
+
+def checkpoint_signature(vgg_path: Union[str, Path], decoder_path: Union[str, Path]) -> Dict[str, List[int]]:
+    """The size and modification time of each checkpoint that exists, to tell whether an artifact is stale."""
+    return {name: [os.stat(path).st_size, os.stat(path).st_mtime_ns]
+            for name, path in (('vgg', vgg_path), ('decoder', decoder_path)) if os.path.exists(path)}
+
+
+class StyleTransferEngine:
+    """
+    Holds a loaded VGG encoder (truncated at relu4_1) and decoder so that the weights are read from disk only once.
+    The engine owns its own copies of the `adain_net` modules, so the module-level networks are never mutated.
+    On the CPU, the frozen networks exported by `export_models.py` are loaded instead of the checkpoints when present.
+    Use `StyleTransferEngine.get` to share one engine per (paths, device, dtype, precision) between Streamlit sessions.
+    The modules are only read during inference, so a single engine can serve concurrent calls.
+    """
+
+    _instances: Dict[Tuple[str, str, str, torch.dtype, str, bool], 'StyleTransferEngine'] = {}
+    _instances_lock = Lock()
+
+    def __init__(self, vgg_path: Union[str, Path] = 'models/vgg_normalised.pth',
+                 decoder_path: Union[str, Path] = 'models/decoder.pth',
+                 device: Union[str, torch.device, None] = None, dtype: torch.dtype = torch.float32,
+                 precision: str = 'fp32', channels_last: bool = False,
+                 calibration: Optional[Sequence[Tuple[Image, Image]]] = None,
+                 artifact_dir: Union[str, Path, None] = ARTIFACT_DIR):
+        """
+        :param vgg_path: The path to the vgg model. Default 'models/vgg_normalised.pth'.
+        :param decoder_path: The path to the decoder model. Default 'models/decoder.pth'.
+        :param device: The device to run on. Default None, which picks a GPU if available.
+        :param dtype: The floating point type of the weights and inputs. Default torch.float32.
+        :param precision: The inference mode of the networks, 'fp32' (default), 'bf16' (autocast) or 'int8'
+            (quantized, CPU only). See `precision.py`.
+        :param channels_last: Boolean to run the networks in the channels_last memory format. Default False
+        :param calibration: The (content, style) image pairs to calibrate 'int8' on. Default None, which uses the
+            test images.
+        :param artifact_dir: The directory of the artifacts from `export_models.py`, or None to always load the
+            checkpoints. Default `ARTIFACT_DIR`.
+        """
+        self.device: torch.device = torch.device(device) if device is not None else default_device()
+        self.dtype: torch.dtype = dtype
+        self.precision = precision
+        self.channels_last = channels_last
+        if precision != 'fp32' and dtype != torch.float32:
+            raise ValueError(f'Precision {precision!r} needs dtype torch.float32, got {dtype}')
+        if precision == 'int8' and self.device.type != 'cpu':
+            raise ValueError(f'Precision \'int8\' only runs on the CPU, got device {self.device}')
+
+        if artifact_dir is not None and self.device.type == 'cpu' and dtype == torch.float32:
+            with stage('model load', model='adain artifact'):
+                if self._load_artifact(artifact_path(precision, channels_last, artifact_dir), vgg_path,
+                                       decoder_path):
+                    return
+
+        import adain_net  # Only imported, building the full networks, when the checkpoints are loaded
+        with stage('model load', model='adain'):
+            decoder = deepcopy(adain_net.decoder)
+            decoder.load_state_dict(torch.load(decoder_path, map_location='cpu'))
+            self.decoder: nn.Module = decoder.to(self.device, self.dtype).eval()
+
+            vgg = deepcopy(adain_net.vgg)
+            vgg.load_state_dict(torch.load(vgg_path, map_location='cpu'))
+            vgg = nn.Sequential(*list(vgg.children())[:31])  # Up to relu4_1
+            self.vgg: nn.Module = vgg.to(self.device, self.dtype).eval()
+
+        for param in list(self.vgg.parameters()) + list(self.decoder.parameters()):
+            param.requires_grad_(False)
+
+        if precision != 'fp32' or channels_last:
+            from precision import optimize_modules  # Imported here, as it imports this module
+            with stage('optimize', precision=precision, channels_last=channels_last):
+                self.vgg, self.decoder = optimize_modules(self.vgg, self.decoder, precision, channels_last,
+                                                          calibration)
+
+    def _load_artifact(self, path: Path, vgg_path: Union[str, Path], decoder_path: Union[str, Path]) -> bool:
+        """
+        Load the frozen networks saved by `export_models.py`, unless the checkpoints changed since the export.
+        :return: Boolean, whether the artifact was loaded.
+        """
+        if not path.exists():
+            return False
+        extra_files = {'meta.json': ''}
+        networks = torch.jit.load(str(path), map_location='cpu', _extra_files=extra_files)
+        meta = json.loads(extra_files['meta.json'] or '{}')
+        signature = checkpoint_signature(vgg_path, decoder_path)
+        if any(meta.get('checkpoints', {}).get(name) != value for name, value in signature.items()):
+            print(f'Ignoring {path}, as the checkpoints changed since it was exported')
+            return False
+        self.vgg, self.decoder = networks.encode, networks.decode
+        return True
+
+    @classmethod
+    def get(cls, vgg_path: Union[str, Path] = 'models/vgg_normalised.pth',
+            decoder_path: Union[str, Path] = 'models/decoder.pth',
+            device: Union[str, torch.device, None] = None,
+            dtype: torch.dtype = torch.float32, precision: str = 'fp32',
+            channels_last: bool = False) -> 'StyleTransferEngine':
+        """
+        Get the shared engine for the given weights, device, dtype and precision mode, loading it on first use.
+        Shared 'int8' engines are calibrated on the test images.
+        :return: The StyleTransferEngine object.
+        """
+        device = torch.device(device) if device is not None else default_device()
+        key = (str(Path(vgg_path).resolve()), str(Path(decoder_path).resolve()), str(device), dtype, precision,
+               channels_last)
+
+        with cls._instances_lock:
+            engine = cls._instances.get(key)
+            if engine is None:
+                engine = cls(vgg_path, decoder_path, device, dtype, precision, channels_last)
+                cls._instances[key] = engine
+        return engine
+
+    @classmethod
+    def clear(cls):
+        """Drop all shared engines, e.g. after the weights on disk have changed."""
+        with cls._instances_lock:
+            cls._instances.clear()
+
+    def prepare(self, content: Image, style: Image, content_size: int = 0, style_size: int = 0, crop: bool = False,
+                preserve_color: bool = True) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Transform the content and style images into batched tensors on the engine's device.
+        :return: A 2-tuple of the content and style tensors, each of shape (1, 3, H, W).
+        """
+        content, styles = self.prepare_batch(content, [style], content_size, style_size, crop, preserve_color)
+        return content, styles[0]
+
+    def prepare_batch(self, content: Image, styles: Sequence[Image], content_size: int = 0, style_size: int = 0,
+                      crop: bool = False, preserve_color: bool = True) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+        """
+        Like `prepare`, but for several style images, transforming the content only once.
+        :return: A 2-tuple of the content tensor and a list of style tensors, each of shape (1, 3, H, W).
+        """
+        with stage('transform'):
+            content = test_transform(content_size, crop)(content)
+        styles = [self.prepare_style(style, content, style_size, crop, preserve_color) for style in styles]
+        return content.to(self.device, self.dtype).unsqueeze(0), styles
+
+    def prepare_style(self, style: Image, content: torch.Tensor, style_size: int = 0, crop: bool = False,
+                      preserve_color: bool = True) -> torch.Tensor:
+        """
+        Transform a style image into a batched tensor on the engine's device.
+        :param content: The transformed content tensor of shape (3, H, W), used by `preserve_color`.
+        :return: The style tensor of shape (1, 3, H, W).
+        """
+        with stage('transform'):
+            style = test_transform(style_size, crop)(style).to(self.device)
+        if preserve_color:
+            with stage('coral'):
+                style = coral(style, content.to(self.device), CORAL_MAX_SAMPLES)
+        return style.to(self.dtype).unsqueeze(0)
+
+    def transfer(self, content: torch.Tensor, style: torch.Tensor, alpha: float = 1.0,
+                 interpolation_weights=None) -> torch.Tensor:
+        """
+        Run `style_transfer` with the engine's networks on already prepared tensors.
+        :return: torch.Tensor on the CPU representing the stylized image.
+        """
+        with torch.no_grad():
+            output = style_transfer(self.vgg, self.decoder, content, style, self.device, alpha,
+                                    interpolation_weights)
+        return output.float().cpu()
+
+    def encode_features(self, content: torch.Tensor, style: torch.Tensor,
+                        content_mask: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Run every alpha-independent step of `style_transfer` on prepared tensors.
+        :param content_mask: If specified, a (1, 1, H, W) mask at the content's resolution. AdaIN then takes the
+            content statistics only over the feature positions it covers. Default None
+        :return: A 2-tuple of the content relu4_1 features and the AdaIN target features.
+        """
+        with torch.no_grad():
+            # On an `InferenceScheduler` worker, similarly sized forwards of concurrent requests run as one batch
+            with stage('content encode'):
+                content_f = batched_forward(self.vgg, content, BATCH_BUCKET)
+            with stage('style encode'):
+                style_f = batched_forward(self.vgg, style, BATCH_BUCKET)
+            with stage('AdaIN'):
+                if content_mask is None:
+                    return content_f, adaptive_instance_normalization(content_f, style_f)
+
+                mask_f = F.adaptive_max_pool2d(content_mask.to(self.device, self.dtype), content_f.size()[2:])
+                style_mean, style_std = calc_mean_std(style_f)
+                return content_f, adaptive_instance_normalization_from_stats(content_f, style_mean, style_std,
+                                                                             mask_f)
+
+    def decode_features(self, content_f: torch.Tensor, target: torch.Tensor, alpha: float = 1.0) -> torch.Tensor:
+        """
+        Blend the features from `encode_features` by `alpha` and decode them, the only alpha-dependent steps.
+        :return: torch.Tensor on the CPU representing the stylized image.
+        """
+        assert (0.0 <= alpha <= 1.0)
+        with torch.no_grad(), stage('decode'):
+            # The features are an eighth of the image size, so this is the same bucket in image pixels
+            output = batched_forward(self.decoder, target * alpha + content_f * (1 - alpha), BATCH_BUCKET // 8)
+            return output.float().cpu()
+
+    def transfer_regions(self, content: torch.Tensor, styles: Sequence[torch.Tensor], masks: Sequence[torch.Tensor],
+                         alphas: Sequence[float], batch_size: int = 4, single_decode: bool = False) -> torch.Tensor:
+        """
+        Stylize several regions of one content tensor, each with its own style and alpha, encoding the content once.
+        Each region gets AdaIN with content statistics taken only over its mask. Later regions win where masks overlap.
+        :param content: The content tensor of shape (1, 3, H, W).
+        :param styles: One style tensor of shape (1, 3, h, w) per region. A tensor passed for several regions is
+            encoded only once.
+        :param masks: One boolean mask of shape (1, 1, H, W) per region.
+        :param alphas: One alpha per region.
+        :param batch_size: The number of regions decoded together in one decoder forward. Default 4.
+        :param single_decode: Boolean to merge the regions' features into one feature map and decode it once, instead
+            of decoding every region and compositing in pixel space. Cheaper, but blurs region boundaries. Default False
+        :return: torch.Tensor on the CPU of shape (1, 3, H, W), the content image with every region stylized.
+        """
+        assert (len(styles) == len(masks) == len(alphas))
+        assert all(0.0 <= alpha <= 1.0 for alpha in alphas)
+        H, W = content.size()[2:]
+        output = content.float().cpu().clone()
+
+        with torch.no_grad(), stage('region transfer', regions=len(masks)):
+            content_f = self.vgg(content)
+            style_stats = {}
+            for style in styles:
+                if id(style) not in style_stats:
+                    style_stats[id(style)] = self.style_stats(style)
+
+            feats = []
+            for style, mask, alpha in zip(styles, masks, alphas):
+                mask_f = F.adaptive_max_pool2d(mask.to(self.device, self.dtype), content_f.size()[2:])
+                content_mean, content_std = calc_mean_std_masked(content_f, mask_f)
+                style_mean, style_std = style_stats[id(style)]
+                feat = (content_f - content_mean) / content_std * style_std + style_mean
+                feats.append((feat * alpha + content_f * (1 - alpha), mask_f))
+
+            if single_decode:
+                feat = content_f
+                for region_feat, mask_f in feats:
+                    feat = torch.where(mask_f > 0, region_feat, feat)
+                decoded = [self.decoder(feat).float().cpu()[..., :H, :W]] * len(masks)
+            else:
+                decoded = []
+                for start in range(0, len(feats), batch_size):
+                    batch = torch.cat([feat for feat, _ in feats[start:start + batch_size]])
+                    decoded.extend(self.decoder(batch).float().cpu()[..., :H, :W].split(1))
+
+        for region, mask in zip(decoded, masks):
+            output = torch.where(mask.cpu(), region, output)
+        return output
+
+    def tiled_stats(self, image: torch.Tensor, tile_size: int,
+                    mask: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Compute the relu4_1 per-channel mean and std of an image tile by tile, as `calc_mean_std` would over the
+        features of the whole image, without holding more than one tile's activations.
+        :param image: The image tensor of shape (1, 3, H, W), e.g. on the CPU.
+        :param tile_size: The side of a tile's core, a multiple of 8.
+        :param mask: If specified, a (1, 1, H, W) mask; only the feature positions it covers are counted. Default None
+        :return: A 2-tuple of the mean and std, each of shape (1, 512, 1, 1), on the engine's device.
+        """
+        H, W = image.size()[2:]
+        total, total_sq, count = 0, 0, 0
+        with torch.no_grad(), stage('tiled encode'):
+            for (top, left, bottom, right), (p_top, p_left, p_bottom, p_right) in _tiles(H, W, tile_size):
+                check_cancelled()
+                tile = image[..., p_top:p_bottom, p_left:p_right].to(self.device, self.dtype)
+                feat = self.vgg(tile)
+                feat = feat[..., (top - p_top) // 8:-(-(bottom - p_top) // 8),
+                            (left - p_left) // 8:-(-(right - p_left) // 8)].double().flatten(2)
+                if mask is None:
+                    weight = torch.ones_like(feat[:, :1])
+                else:
+                    weight = F.max_pool2d(mask[..., top:bottom, left:right].to(self.device, torch.float64),
+                                          8, 8, ceil_mode=True).flatten(2)
+                total = total + (feat * weight).sum(dim=2)
+                total_sq = total_sq + (feat.pow(2) * weight).sum(dim=2)
+                count = count + weight.sum(dim=2)
+
+        count = count.clamp(min=2)
+        mean = total / count
+        var = (total_sq - count * mean.pow(2)) / (count - 1) + 1e-5
+        return mean.to(self.dtype).view(1, -1, 1, 1), var.sqrt().to(self.dtype).view(1, -1, 1, 1)
+
+    def decode_tiled(self, content: torch.Tensor, content_mean: torch.Tensor, content_std: torch.Tensor,
+                     style_mean: torch.Tensor, style_std: torch.Tensor, alpha: float = 1.0,
+                     tile_size: int = 512, tile_features: Optional[Dict[int, Tuple[torch.Tensor, torch.Tensor]]] = None,
+                     max_cached_bytes: int = 0) -> torch.Tensor:
+        """
+        Stylize an image tile by tile with global AdaIN statistics, e.g. from `tiled_stats`.
+        Each tile is encoded with REGION_PADDING of context, and neighbouring tiles are blended over a strip of
+        2 * TILE_BLEND pixels, so the result closely matches a single-pass run.
+        :param content: The content tensor of shape (1, 3, H, W), e.g. on the CPU.
+        :param tile_size: The side of a tile's core, a multiple of 8. Default 512.
+        :param tile_features: If specified, a dictionary from tile index to the tile's relu4_1 content features and
+            AdaIN target. Tiles found in it are not encoded again, e.g. when only `alpha` changed, and encoded tiles
+            are added while the kept features stay within `max_cached_bytes`. Default None
+        :param max_cached_bytes: The most bytes of features kept in `tile_features`. Default 0
+        :return: torch.Tensor on the CPU of shape (1, 3, H, W) representing the stylized image.
+        """
+        assert (0.0 <= alpha <= 1.0)
+        H, W = content.size()[2:]
+        output = torch.zeros(1, 3, H, W)
+        with torch.no_grad(), stage('tiled encode and decode'):
+            for index, ((top, left, bottom, right), (p_top, p_left, p_bottom, p_right)) in \
+                    enumerate(_tiles(H, W, tile_size)):
+                check_cancelled()
+                features = tile_features.get(index) if tile_features is not None else None
+                if features is None:
+                    tile = content[..., p_top:p_bottom, p_left:p_right].to(self.device, self.dtype)
+                    content_f = self.vgg(tile)
+                    features = (content_f, (content_f - content_mean) / content_std * style_std + style_mean)
+                    if tile_features is not None:
+                        # Values are copied first, as a concurrent call with the same features may add tiles
+                        cached_bytes = sum(2 * f.numel() * f.element_size() for f, _ in list(tile_features.values()))
+                        if cached_bytes + 2 * content_f.numel() * content_f.element_size() <= max_cached_bytes:
+                            tile_features[index] = features
+                content_f, feat = features
+                decoded = self.decoder(feat * alpha + content_f * (1 - alpha)).float().cpu()
+
+                # The core, grown into the padding by TILE_BLEND wherever there is a neighbour
+                b_top, b_left = max(top - TILE_BLEND, 0), max(left - TILE_BLEND, 0)
+                b_bottom, b_right = min(bottom + TILE_BLEND, H), min(right + TILE_BLEND, W)
+                weight = _blend_ramp(b_top, b_bottom, top, bottom, H)[:, None] * \
+                    _blend_ramp(b_left, b_right, left, right, W)[None, :]
+                output[..., b_top:b_bottom, b_left:b_right] += \
+                    decoded[..., b_top - p_top:b_bottom - p_top, b_left - p_left:b_right - p_left] * weight
+        return output
+
+    def transfer_tiled(self, content: torch.Tensor, style: torch.Tensor, alpha: float = 1.0, tile_size: int = 512,
+                       content_mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """
+        Like `transfer`, but with memory bounded by `tile_size` regardless of the image sizes.
+        :param content_mask: If specified, a (1, 1, H, W) mask for the content statistics, as in `encode_features`.
+        :return: torch.Tensor on the CPU of shape (1, 3, H, W) representing the stylized image.
+        """
+        content_mean, content_std = self.tiled_stats(content, tile_size, content_mask)
+        style_mean, style_std = self.tiled_stats(style, tile_size)
+        return self.decode_tiled(content, content_mean, content_std, style_mean, style_std, alpha, tile_size)
+
+    def style_stats(self, style: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Encode a style tensor and return the statistics AdaIN uses from it.
+        :param style: The style tensor of shape (1, 3, H, W) or (3, H, W).
+        :return: A 2-tuple of the relu4_1 per-channel mean and std, each of shape (1, 512, 1, 1).
+        """
+        if style.dim() == 3:
+            style = style.unsqueeze(0)
+        with torch.no_grad():
+            return calc_mean_std(self.vgg(style.to(self.device, self.dtype)))
+
+    def transfer_with_stats(self, content: torch.Tensor, style_mean: torch.Tensor, style_std: torch.Tensor,
+                            alpha: float = 1.0) -> torch.Tensor:
+        """
+        Like `transfer`, but with precomputed relu4_1 style statistics instead of a style image.
+        :return: torch.Tensor on the CPU representing the stylized image.
+        """
+        assert (0.0 <= alpha <= 1.0)
+        with torch.no_grad():
+            content_f = self.vgg(content)
+            feat = adaptive_instance_normalization_from_stats(content_f, style_mean.to(self.device, self.dtype),
+                                                              style_std.to(self.device, self.dtype))
+            feat = feat * alpha + content_f * (1 - alpha)
+            output = self.decoder(feat)
+        return output.float().cpu()
+
+    def transfer_batch(self, content: torch.Tensor, styles: Sequence[torch.Tensor], alphas: Sequence[float] = (1.0,),
+                       interpolation_weights: Optional[Sequence[Sequence[float]]] = None,
+                       batch_size: int = 4, pairs: Optional[Sequence[Tuple[int, float]]] = None) -> torch.Tensor:
+        """
+        Stylize one content tensor with several styles and/or alphas, encoding the content and each style only once.
+        Without `interpolation_weights` there is one variant per (style, alpha). With them, there is one variant per
+        (weight vector, alpha), where a weight vector mixes the AdaIN targets of all styles as in `style_transfer`.
+        Variants are ordered by style (or weight vector) first, then by alpha.
+        :param content: The content tensor of shape (1, 3, H, W).
+        :param styles: The style tensors, each of shape (1, 3, H, W). Their sizes may differ.
+        :param alphas: The alphas to render for every style or weight vector. Default (1.0,).
+        :param interpolation_weights: If specified, a list of weight vectors, each with one weight per style.
+        :param batch_size: The number of variants decoded together in one decoder forward. Default 4.
+        :param pairs: If specified, the (style or weight vector index, alpha) variants to render, in this order,
+            instead of every combination. `alphas` is then ignored. Default None
+        :return: torch.Tensor on the CPU of shape (number of variants, 3, H, W).
+        """
+        if pairs is not None:
+            alphas = [alpha for _, alpha in pairs]
+        assert all(0.0 <= alpha <= 1.0 for alpha in alphas)
+        if interpolation_weights:
+            assert all(len(w) == len(styles) for w in interpolation_weights)
+            weights = torch.tensor(interpolation_weights, device=self.device, dtype=self.dtype)
+        else:
+            weights = torch.eye(len(styles), device=self.device, dtype=self.dtype)
+        if pairs is not None:
+            variants = list(pairs)
+        else:
+            variants = [(i, alpha) for i in range(len(weights)) for alpha in alphas]
+
+        outputs = []
+        with torch.no_grad(), stage('batch transfer', variants=len(variants)):
+            content_f = self.vgg(content)
+            content_mean, content_std = calc_mean_std(content_f)
+            normalized_feat = (content_f - content_mean) / content_std
+
+            # The AdaIN target statistics of every weight vector, each of shape (len(weights), C, 1, 1)
+            style_means, style_stds = zip(*(self.style_stats(style) for style in styles))
+            C = content_f.size(1)
+            target_mean = torch.mm(weights, torch.cat(style_means).view(-1, C)).view(-1, C, 1, 1)
+            target_std = torch.mm(weights, torch.cat(style_stds).view(-1, C)).view(-1, C, 1, 1)
+
+            for start in range(0, len(variants), batch_size):
+                batch = variants[start:start + batch_size]
+                index = torch.tensor([i for i, _ in batch], device=self.device)
+                alpha = torch.tensor([a for _, a in batch], device=self.device, dtype=self.dtype).view(-1, 1, 1, 1)
+
+                feat = normalized_feat * target_std[index] + target_mean[index]
+                feat = feat * alpha + content_f * (1 - alpha)
+                outputs.append(self.decoder(feat).float().cpu())
+
+        return torch.cat(outputs)
+
+
 def stylize(content: Image, style: Image,
             vgg_path: str = 'models/vgg_normalised.pth', decoder_path: str = 'models/decoder.pth',
             content_size: int = 0, style_size: int = 0, crop: bool = False,
             output_dir: Union[str, Path, None] = None, output_file_name: str = 'stylized_mask.png',
-            preserve_color: bool = True, alpha: float = 1.0) -> torch.Tensor:
+            preserve_color: bool = True, alpha: float = 1.0,
+            feature_cache: Optional[MutableMapping] = None,
+            mask: Union[np.ndarray, CompactMask, None] = None, masked_stats: bool = False,
+            memory_budget_mb: Optional[float] = None, tile_cache_mb: float = 0,
+            precision: str = 'fp32') -> torch.Tensor:
     """
     :param content: The Image object representing the content image.
     :param style: The Image object representing the style image.
@@ -59,42 +581,193 @@ def stylize(content: Image, style: Image,
         Default 'stylized_mask.jpg'. Note that the stylized image will be saved at `output_dir`->`output_file_name`.
     :param preserve_color: Boolean to preserve color of the content image. Default True
     :param alpha: The weight that controls the degree of stylization. Should be between 0 and 1 (default).
+    :param feature_cache: If specified, a mapping (e.g. `st.session_state`) that keeps the encoded features of the
+        last (content, style, settings) call, so that calls differing only in `alpha` just run the decoder. Default None
+    :param mask: If specified, a boolean mask of the content image's shape (e.g. a SAM segment), as an array or a
+        CompactMask object. Only its bounding box, padded by `REGION_PADDING`, is stylized and pasted back into the
+        content image. Default None
+    :param masked_stats: Boolean to compute the AdaIN content statistics only over the masked positions.
+        Only used with `mask`. Default False
+    :param memory_budget_mb: If specified, images larger than one tile fitting in this many MiB of activations are
+        stylized tile by tile (see `StyleTransferEngine.transfer_tiled`). Default None
+    :param tile_cache_mb: With `feature_cache` and a tiled run, the most MiB of the tiles' encoded features kept in
+        the cache, so that a later alpha mostly just decodes. Default 0 (the tiles are encoded again)
+    :param precision: The inference mode of the networks, 'fp32' (default), 'bf16' or 'int8' (always on the CPU).
+        See `precision.py`.
     :return: torch.Tensor representing the final image.
     """
-    device: torch.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    engine = StyleTransferEngine.get(vgg_path, decoder_path, 'cpu' if precision == 'int8' else None,
+                                     precision=precision)
+    tile_size = tile_size_for_budget(memory_budget_mb) if memory_budget_mb else None
+
+    key = None
+    if feature_cache is not None:
+        key = (image_hash(content), image_hash(style), None if mask is None else image_hash(mask), masked_stats,
+               str(vgg_path), str(decoder_path), content_size, style_size, crop, preserve_color, tile_size, precision)
+    cached = feature_cache.get('stylize_features') if feature_cache is not None else None
+
+    if cached is None or cached[0] != key:
+        if feature_cache is not None:
+            feature_cache.pop('stylize_features', None)  # Freed before encoding, not kept alongside the new features
+        cached = (key, _encode_for_stylize(engine, content, style, content_size, style_size, crop, preserve_color,
+                                           mask, masked_stats, tile_size))
+        if feature_cache is not None:
+            feature_cache['stylize_features'] = cached
+    state = cached[1]
+
+    if state.features is not None:
+        output = engine.decode_features(*state.features, alpha)
+    elif state.tiled_stats is not None:
+        output = engine.decode_tiled(state.region, *state.tiled_stats, alpha, tile_size, state.tile_features,
+                                     int(tile_cache_mb * 2 ** 20))
+    else:  # Nothing to stylize
+        output = state.base
+
+    if state.box is not None:
+        top, left, bottom, right = state.box
+        region = output
+        output = state.base.clone()
+        output[..., top:bottom, left:right] = region[..., :bottom - top, :right - left]
+
+    if output_dir:
+        output_dir = Path(output_dir)
+        output_dir.mkdir(exist_ok=True, parents=True)
+        output_name = output_dir.joinpath(output_file_name)
+        with stage('save'):
+            save_image(output, str(output_name))
+        # print(f'Stylized image saved at {output_name}')
+
+    return output
+
+
+class _StylizeState(NamedTuple):
+    """The alpha-independent part of a `stylize` call."""
+    features: Optional[Tuple[torch.Tensor, torch.Tensor]]  # Content features and AdaIN target of a single pass
+    tiled_stats: Optional[Tuple[torch.Tensor, ...]]  # Content and style mean/std of a tiled run
+    region: Optional[torch.Tensor]  # The content (or region) tensor of a tiled run
+    tile_features: Optional[Dict[int, Tuple[torch.Tensor, torch.Tensor]]]  # Filled by the decodes of a tiled run
+    base: Optional[torch.Tensor]  # The transformed content tensor a region is pasted into
+    box: Optional[Tuple[int, int, int, int]]  # The (top, left, bottom, right) box of the region
+
+
+def _encode_for_stylize(engine: StyleTransferEngine, content: Image, style: Image, content_size: int,
+                        style_size: int, crop: bool, preserve_color: bool,
+                        mask: Union[np.ndarray, CompactMask, None],
+                        masked_stats: bool, tile_size: Optional[int]) -> _StylizeState:
+    """Run the alpha-independent part of `stylize`."""
+    with stage('transform'):
+        content = test_transform(content_size, crop)(content)
+    base, box, region_mask = None, None, None
+
+    if mask is not None:
+        with stage('transform'):
+            if not isinstance(mask, CompactMask):
+                mask = CompactMask.from_dense(mask)
+            if crop:
+                mask = CompactMask.from_dense(mask_transform(content_size, crop)(mask)[0].numpy())
+            else:  # Resized in packed form, without decoding the pixels outside the box
+                mask = mask.resize(content.size()[1:])
+        base = content.unsqueeze(0)
+
+        box = mask.box
+        if box is None:  # Nothing to stylize
+            return _StylizeState(None, None, None, None, base, None)
+
+        H, W = mask.shape
+        top, left, bottom, right = box
+        top, left = max(top - REGION_PADDING, 0), max(left - REGION_PADDING, 0)
+        bottom, right = min(bottom + REGION_PADDING, H), min(right + REGION_PADDING, W)
+        box = (top, left, bottom, right)
+
+        content = content[:, top:bottom, left:right].contiguous()
+        if masked_stats:
+            region_mask = torch.from_numpy(mask.crop(box))[None, None]
+
+    style = engine.prepare_style(style, content, style_size, crop, preserve_color)
+    content = content.unsqueeze(0)
+
+    if tile_size is not None and max(content.size()[2:]) > tile_size:
+        tiled_stats = (*engine.tiled_stats(content, tile_size, region_mask), *engine.tiled_stats(style, tile_size))
+        return _StylizeState(None, tiled_stats, content, {}, base, box)
+
+    features = engine.encode_features(content.to(engine.device, engine.dtype), style, region_mask)
+    return _StylizeState(features, None, None, None, base, box)
+
+
+def stylize_batch(content: Image, styles: Sequence[Image], alphas: Sequence[float] = (1.0,),
+                  interpolation_weights: Optional[Sequence[Sequence[float]]] = None,
+                  vgg_path: str = 'models/vgg_normalised.pth', decoder_path: str = 'models/decoder.pth',
+                  content_size: int = 0, style_size: int = 0, crop: bool = False,
+                  output_dir: Union[str, Path, None] = None, output_file_name: str = 'stylized_grid.png',
+                  preserve_color: bool = True, batch_size: int = 4) -> torch.Tensor:
+    """
+    Stylize a content image with several styles and/or alphas in one call, e.g. for an alpha-comparison grid.
+    See `StyleTransferEngine.transfer_batch` for how the variants are formed and ordered.
+    :param content: The Image object representing the content image.
+    :param styles: The Image objects representing the style images.
+    :param alphas: The alphas to render for every style or weight vector. Default (1.0,).
+    :param interpolation_weights: If specified, a list of weight vectors, each with one weight per style.
+    :param output_dir: If specified, then the directory to save the variants as a grid, one row per style
+        (or weight vector) and one column per alpha. Default None
+    :param output_file_name: The filename for the grid image, with the specified extensions. Default 'stylized_grid.png'.
+    :param batch_size: The number of variants decoded together in one decoder forward. Default 4.
+    :return: torch.Tensor of shape (number of variants, 3, H, W) representing the final images.
+
+    The remaining parameters are as in `stylize`.
+    """
+    engine = StyleTransferEngine.get(vgg_path, decoder_path)
+
+    content, styles = engine.prepare_batch(content, styles, content_size, style_size, crop, preserve_color)
+    output = engine.transfer_batch(content, styles, alphas, interpolation_weights, batch_size)
+
+    if output_dir:
+        output_dir = Path(output_dir)
+        output_dir.mkdir(exist_ok=True, parents=True)
+        save_image(output, str(output_dir.joinpath(output_file_name)), nrow=len(alphas))
 
-    decoder = adain_net.decoder
-    decoder.eval()
-    decoder.load_state_dict(torch.load(decoder_path))
-    decoder.to(device)
+    return output
 
-    vgg = adain_net.vgg
-    vgg.eval()
-    vgg.load_state_dict(torch.load(vgg_path))
-    vgg = nn.Sequential(*list(vgg.children())[:31])
-    vgg.to(device)
 
-    content_tf = test_transform(content_size, crop)
-    style_tf = test_transform(style_size, crop)
+def stylize_regions(content: Image, assignments: Sequence[Tuple[np.ndarray, Image, float]],
+                    vgg_path: str = 'models/vgg_normalised.pth', decoder_path: str = 'models/decoder.pth',
+                    content_size: int = 0, style_size: int = 0, crop: bool = False,
+                    output_dir: Union[str, Path, None] = None, output_file_name: str = 'stylized_regions.png',
+                    preserve_color: bool = True, batch_size: int = 4, single_decode: bool = False) -> torch.Tensor:
+    """
+    Stylize several segments of a content image, each with its own style and alpha, into one composited image.
+    See `StyleTransferEngine.transfer_regions`.
+    :param content: The Image object representing the content image.
+    :param assignments: A list of (mask, style, alpha) triples, where mask is a boolean mask of the content image's
+        shape (e.g. a SAM segment) and style is an Image object. Passing the same Image object for several segments
+        encodes it only once.
+    :param preserve_color: Boolean to preserve the color of each segment of the content image. Default True
+    :param batch_size: The number of segments decoded together in one decoder forward. Default 4.
+    :param single_decode: Boolean to decode all segments in one decoder forward on merged features. Default False
+    :return: torch.Tensor of shape (1, 3, H, W) representing the final image.
 
-    content = content_tf(content)
-    style = style_tf(style)
+    The remaining parameters are as in `stylize`.
+    """
+    engine = StyleTransferEngine.get(vgg_path, decoder_path)
 
-    if preserve_color:
-        style = coral(style, content)
+    content = test_transform(content_size, crop)(content)
+    masks = [mask_transform(content_size, crop)(mask).unsqueeze(0) for mask, _, _ in assignments]
 
-    style = style.to(device).unsqueeze(0)
-    content = content.to(device).unsqueeze(0)
+    prepared, styles = {}, []
+    for (_, style, _), mask in zip(assignments, masks):
+        if preserve_color:  # Match the colours of the segment, so each style is prepared per segment
+            segment = content[:, mask[0, 0]].unsqueeze(1)
+            styles.append(engine.prepare_style(style, segment if segment.numel() else content, style_size, crop))
+        else:
+            if id(style) not in prepared:
+                prepared[id(style)] = engine.prepare_style(style, content, style_size, crop, False)
+            styles.append(prepared[id(style)])
 
-    with torch.no_grad():
-        output = style_transfer(vgg, decoder, content, style, device, alpha, None)
-    output = output.cpu()
+    output = engine.transfer_regions(content.to(engine.device, engine.dtype).unsqueeze(0), styles, masks,
+                                     [alpha for _, _, alpha in assignments], batch_size, single_decode)
 
     if output_dir:
         output_dir = Path(output_dir)
         output_dir.mkdir(exist_ok=True, parents=True)
-        output_name = output_dir.joinpath(output_file_name)
-        save_image(output, str(output_name))
-        # print(f'Stylized image saved at {output_name}')
+        save_image(output, str(output_dir.joinpath(output_file_name)))
 
     return output
@@ -0,0 +1,56 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# The modules live at the top level of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+def _save_networks(directory: Path, init) -> tuple:
+    import torch
+    import adain_net
+
+    vgg, decoder = adain_net.vgg, adain_net.decoder
+    state = (vgg.state_dict(), decoder.state_dict())  # Restored below, the modules are shared
+    with torch.no_grad():
+        for module in list(vgg.modules()) + list(decoder.modules()):
+            if isinstance(module, torch.nn.Conv2d):
+                init(module)
+    paths = directory / 'vgg_normalised.pth', directory / 'decoder.pth'
+    torch.save(vgg.state_dict(), paths[0])
+    torch.save(decoder.state_dict(), paths[1])
+    vgg.load_state_dict(state[0])
+    decoder.load_state_dict(state[1])
+    return tuple(str(path) for path in paths)
+
+
+@pytest.fixture(scope='session')
+def random_weights(tmp_path_factory):
+    """The (vgg path, decoder path) of randomly initialized AdaIN networks."""
+    import torch
+
+    generator = torch.Generator().manual_seed(0)
+
+    def init(conv):
+        conv.weight.copy_(torch.randn(conv.weight.shape, generator=generator) * 0.05)
+        conv.bias.zero_()
+
+    return _save_networks(tmp_path_factory.mktemp('random_weights'), init)
+
+
+@pytest.fixture(scope='session')
+def identity_weights(tmp_path_factory):
+    """
+    The (vgg path, decoder path) of AdaIN networks that carry the three colour channels through unchanged, apart from
+    the pooling and upsampling, and leave every other channel zero. Colours behave as with trained weights, so
+    colour-dependent results can be compared between code paths.
+    """
+    def init(conv):
+        conv.weight.zero_()
+        conv.bias.zero_()
+        centre = conv.kernel_size[0] // 2
+        for channel in range(3):
+            conv.weight[channel, channel, centre, centre] = 1
+
+    return _save_networks(tmp_path_factory.mktemp('identity_weights'), init)
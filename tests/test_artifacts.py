@@ -0,0 +1,75 @@
+"""Tests for the deduplication and eviction of `artifacts.ArtifactStore`."""
+import pytest
+
+import artifacts
+from artifacts import ArtifactStore
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A fake clock for the store, advanced by setting `clock.now`."""
+    class Clock:
+        now = 1_000_000.0
+
+    monkeypatch.setattr(artifacts, 'time', lambda: Clock.now)
+    return Clock
+
+
+def test_same_content_is_stored_once(tmp_path, clock):
+    store = ArtifactStore(tmp_path, max_bytes=1000)
+    first = store.put_bytes('a', b'x' * 100, '.png')
+    mtime = first.stat().st_mtime_ns
+    clock.now += 1
+    assert store.put_bytes('a', b'x' * 100, '.png') == first
+    assert store.total_bytes == 100 and len(list(first.parent.iterdir())) == 1
+    assert first.stat().st_mtime_ns != mtime  # Only marked as used
+    assert store.put_bytes('b', b'x' * 100, '.png') != first  # Sessions keep their own files
+    assert store.total_bytes == 200
+
+
+def test_least_recently_used_files_are_evicted_first(tmp_path, clock):
+    store = ArtifactStore(tmp_path, max_bytes=300)
+    paths = []
+    for i in range(3):
+        paths.append(store.put_bytes('a', bytes([i]) * 100))
+        clock.now += 1
+    assert store.get('a', paths[0].name) == paths[0]  # Now the most recently used
+    clock.now += 1
+    newest = store.put_bytes('b', b'n' * 100)
+
+    assert [path.exists() for path in paths] == [True, False, True]
+    assert store.get('a', paths[1].name) is None
+    assert newest.exists() and store.total_bytes == 300
+
+    # The order is kept by the files' times, and survives a restart
+    restarted = ArtifactStore(tmp_path, max_bytes=200)
+    assert [path.exists() for path in (paths[0], paths[2], newest)] == [True, False, True]
+    assert restarted.total_bytes == 200
+
+
+def test_expired_files_are_evicted_by_reads(tmp_path, clock):
+    store = ArtifactStore(tmp_path, ttl=60)
+    old = store.put_bytes('a', b'old')
+    clock.now += 30
+    recent = store.put_bytes('b', b'recent')
+    clock.now += 40  # `old` is unused for 70 seconds, `recent` for 40
+
+    assert store.get('b', recent.name) == recent  # A read evicts expired files of all sessions
+    assert not old.exists() and not old.parent.exists()
+    assert store.total_bytes == len(b'recent')
+    clock.now += 59
+    assert store.get('b', recent.name) == recent  # Every use restarts the time to live
+    clock.now += 61
+    assert store.get('b', recent.name) is None and not recent.exists()
+
+
+def test_delete_session_removes_files_written_outside_the_store(tmp_path, clock):
+    store = ArtifactStore(tmp_path)
+    kept = store.put_bytes('b', b'kept')
+    store.put_bytes('a', b'stored')
+    store.session_dir('a').joinpath('extra.txt').write_text('not stored')
+    store.session_dir('a').joinpath('nested').mkdir()
+    store.delete_session('a')
+    assert not store.session_dir('a').exists()
+    assert store.total_bytes == len(b'kept') and kept.exists()
+    store.delete_session('never-stored')
@@ -0,0 +1,64 @@
+"""Tests for the output naming and resuming of `batch`."""
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from batch import PROGRESS_FILE, Writer, main, output_name, read_progress, run
+
+
+def test_same_stem_in_different_directories():
+    style = Path('styles/wave.jpg')
+    names = {output_name(Path('a/img.jpg'), style, 1.0), output_name(Path('b/img.jpg'), style, 1.0),
+             output_name(Path('a/img.png'), style, 1.0), output_name(Path('a/img.jpg'), Path('other/wave.jpg'), 1.0)}
+    assert len(names) == 4
+    assert output_name(Path('a/img.jpg'), style, 1.0) == output_name(Path('a/../a/img.jpg'), style, 1.0)
+
+
+def test_progress_is_kept_per_source(tmp_path):
+    style = Path('styles/wave.jpg')
+    first, second = output_name(Path('a/img.jpg'), style, 0.5), output_name(Path('b/img.jpg'), style, 0.5)
+    writer = Writer(tmp_path, queue_size=2)
+    writer.put(first, Image.new('RGB', (4, 4)))
+    writer.close()
+    assert read_progress(tmp_path) == {first}  # The second is not skipped on resume
+    assert second not in read_progress(tmp_path)
+
+
+def _write_images(directory: Path, names, size=48):
+    directory.mkdir()
+    rng = np.random.default_rng(0)
+    for name in names:
+        Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8)).save(directory / name)
+
+
+def test_corrupt_inputs_fail_only_their_outputs(tmp_path, random_weights, monkeypatch):
+    _write_images(tmp_path / 'content', ['a.png', 'b.jpg', 'c.png'])
+    _write_images(tmp_path / 'styles', ['good.png', 'bad.jpg'])
+    for path in tmp_path / 'content' / 'b.jpg', tmp_path / 'styles' / 'bad.jpg':
+        path.write_bytes(path.read_bytes()[:100])  # Truncated
+    output = tmp_path / 'out'
+    monkeypatch.setattr(sys, 'argv', ['batch.py', '--content', str(tmp_path / 'content'), '--styles',
+                                      str(tmp_path / 'styles'), '--output', str(output), '--workers', '2',
+                                      '--vgg', random_weights[0], '--decoder', random_weights[1]])
+    with pytest.raises(SystemExit) as exit_info:
+        main()
+    assert exit_info.value.code == 1
+
+    rendered = {output_name(tmp_path / 'content' / name, tmp_path / 'styles' / 'good.png', 1.0)
+                for name in ('a.png', 'c.png')}  # The images after the corrupt content are still processed
+    assert {p.name for p in output.glob('*.png')} == rendered
+    assert read_progress(output) == rendered
+    with (output / PROGRESS_FILE).open() as f:
+        failed = [json.loads(line) for line in f if 'failed' in json.loads(line)]
+    assert len(failed) == 4  # b.jpg with both styles, a.png and c.png with bad.jpg
+    assert all(entry['failed'] for entry in failed)
+
+    # A rerun retries only the failed outputs, and they fail again
+    assert run({tmp_path / 'content' / 'a.png': [(tmp_path / 'styles' / 'good.png', 1.0)]}, output,
+               vgg_path=random_weights[0], decoder_path=random_weights[1]) == 0
+    assert run({tmp_path / 'content' / 'b.jpg': [(tmp_path / 'styles' / 'good.png', 1.0)]}, output,
+               vgg_path=random_weights[0], decoder_path=random_weights[1]) == 1
@@ -0,0 +1,139 @@
+"""Tests for the resumable, verified model downloads of `utils.get_model`, against a local HTTP server."""
+import os
+import re
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Barrier, Lock, Thread
+
+import pytest
+
+from utils import get_model
+
+PAYLOAD = os.urandom(200_000)
+DIGEST = sha256(PAYLOAD).hexdigest()
+CHUNK = 4096
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(PAYLOAD)))
+        self.end_headers()
+
+    def do_GET(self):
+        header = self.headers.get('Range')
+        with self.server.lock:
+            self.server.ranges_requested.append(header)
+            fail_after, self.server.fail_after = self.server.fail_after, None
+        start, end = 0, len(PAYLOAD) - 1
+        if header is not None and self.server.ranges:
+            first, last = re.fullmatch(r'bytes=(\d+)-(\d*)', header).groups()
+            start, end = int(first), int(last) if last else end
+            if start >= len(PAYLOAD):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(PAYLOAD)}')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(PAYLOAD)}')
+        else:
+            self.send_response(200)
+        body = PAYLOAD[start:end + 1]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if fail_after is not None:
+            self.wfile.write(body[:fail_after])  # The connection drops partway
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    httpd.ranges, httpd.fail_after, httpd.ranges_requested, httpd.lock = True, None, [], Lock()
+    thread = Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = f'http://127.0.0.1:{httpd.server_port}/model.pth'
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_interrupted_download_resumes(server, tmp_path):
+    server.fail_after = 50_000
+    success, message = get_model('model.pth', server.url, str(tmp_path), DIGEST, chunk_size=CHUNK, timeout=5)
+    assert not success and 'resume' in message
+    part = tmp_path / 'model.pth.part'
+    done = part.stat().st_size
+    assert 0 < done < len(PAYLOAD)
+    assert not (tmp_path / 'model.pth').exists()
+
+    success, _ = get_model('model.pth', server.url, str(tmp_path), DIGEST, chunk_size=CHUNK, timeout=5)
+    assert success
+    assert server.ranges_requested[-1] == f'bytes={done}-'
+    assert (tmp_path / 'model.pth').read_bytes() == PAYLOAD
+    assert not part.exists()
+
+
+def test_segmented_download(server, tmp_path):
+    success, _ = get_model('model.pth', server.url, str(tmp_path), DIGEST, chunk_size=CHUNK, segments=4, timeout=5)
+    assert success
+    assert len(server.ranges_requested) == 4
+    assert (tmp_path / 'model.pth').read_bytes() == PAYLOAD
+    assert [path.name for path in tmp_path.iterdir()] == ['model.pth']
+
+
+@pytest.mark.parametrize('segments', [1, 4])
+def test_complete_part_file_is_renamed(server, tmp_path, segments):
+    # An earlier run wrote the whole file but stopped before renaming it
+    (tmp_path / 'model.pth.part').write_bytes(PAYLOAD)
+    success, _ = get_model('model.pth', server.url, str(tmp_path), DIGEST, chunk_size=CHUNK, segments=segments,
+                           timeout=5)
+    assert success
+    assert (tmp_path / 'model.pth').read_bytes() == PAYLOAD
+    assert server.ranges_requested in ([], [f'bytes={len(PAYLOAD)}-'])  # At most the range that gets a 416
+
+
+def test_range_less_server_starts_over(server, tmp_path):
+    server.ranges = False
+    (tmp_path / 'model.pth.part').write_bytes(b'partial')
+    success, _ = get_model('model.pth', server.url, str(tmp_path), DIGEST, chunk_size=CHUNK, segments=4, timeout=5)
+    assert success
+    assert (tmp_path / 'model.pth').read_bytes() == PAYLOAD
+
+
+def test_bad_digest(server, tmp_path):
+    success, message = get_model('model.pth', server.url, str(tmp_path), '0' * 64, chunk_size=CHUNK, timeout=5)
+    assert not success and 'Checksum mismatch' in message
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_existing_file_with_wrong_digest_is_replaced(server, tmp_path):
+    (tmp_path / 'model.pth').write_text('version https://git-lfs.github.com/spec/v1\n')  # A Git LFS pointer
+    success, _ = get_model('model.pth', server.url, str(tmp_path), DIGEST, chunk_size=CHUNK, timeout=5)
+    assert success
+    assert (tmp_path / 'model.pth').read_bytes() == PAYLOAD
+
+
+def test_concurrent_callers_download_once(server, tmp_path):
+    callers = 8
+    barrier, results = Barrier(callers), [None] * callers
+
+    def call(i):
+        barrier.wait()
+        results[i] = get_model('model.pth', server.url, str(tmp_path), DIGEST, chunk_size=CHUNK, timeout=5)
+
+    threads = [Thread(target=call, args=(i,)) for i in range(callers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(success for success, _ in results)
+    assert len(server.ranges_requested) == 1
+    assert (tmp_path / 'model.pth').read_bytes() == PAYLOAD
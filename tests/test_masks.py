@@ -0,0 +1,73 @@
+"""Tests for the packed operations of `masks.CompactMask`, checked against the dense arrays."""
+import numpy as np
+import pytest
+from PIL import Image
+
+from masks import CompactMask, mask_bbox
+from utils import composite_with_mask
+
+
+def _blob(shape, box, seed):
+    """A random mask whose pixels lie inside `box`."""
+    mask = np.zeros(shape, bool)
+    top, left, bottom, right = box
+    mask[top:bottom, left:right] = np.random.default_rng(seed).random((bottom - top, right - left)) < 0.6
+    return mask
+
+
+MASKS = [_blob((45, 61), (3, 7, 40, 30), 0), _blob((45, 61), (20, 25, 45, 61), 1), np.zeros((45, 61), bool),
+         np.ones((45, 61), bool)]
+
+
+@pytest.mark.parametrize('dense', MASKS)
+def test_round_trip(dense):
+    mask = CompactMask.from_dense(dense)
+    assert np.array_equal(np.asarray(mask), dense)
+    assert mask.box == mask_bbox(dense) and mask.area == np.count_nonzero(dense)
+    assert mask.nbytes <= -(-dense.size // 8)
+
+
+@pytest.mark.parametrize('dense', MASKS)
+def test_crop(dense):
+    mask = CompactMask.from_dense(dense)
+    for box in [(0, 0, 45, 61), (10, 5, 30, 50), (0, 40, 12, 61), (44, 60, 45, 61)]:
+        top, left, bottom, right = box
+        assert np.array_equal(mask.crop(box), dense[top:bottom, left:right])
+
+
+@pytest.mark.parametrize('dense', MASKS)
+@pytest.mark.parametrize('shape', [(45, 61), (90, 122), (20, 17), (64, 31)])
+def test_resize_samples_the_nearest_pixel(dense, shape):
+    expected = np.asarray(Image.fromarray(dense.astype(np.uint8)).resize(shape[::-1], Image.Resampling.NEAREST))
+    resized = CompactMask.from_dense(dense).resize(shape)
+    assert resized.shape == shape
+    assert np.array_equal(np.asarray(resized), expected.astype(bool))
+    assert resized.box == mask_bbox(expected) and resized.area == np.count_nonzero(expected)
+
+
+def test_union():
+    masks = [CompactMask.from_dense(dense) for dense in MASKS[:3]]
+    union = masks[0].union(*masks[1:])
+    expected = MASKS[0] | MASKS[1]
+    assert np.array_equal(np.asarray(union), expected)
+    assert union.box == mask_bbox(expected) and union.area == np.count_nonzero(expected)
+    assert (masks[2] | masks[2]).box is None
+    with pytest.raises(ValueError):
+        masks[0].union(CompactMask.empty((45, 60)))
+
+
+def test_digest_depends_only_on_the_pixels():
+    first, second = (CompactMask.from_dense(dense) for dense in MASKS[:2])
+    assert first.union(second).digest() == CompactMask.from_dense(MASKS[0] | MASKS[1]).digest()
+    assert first.digest() != second.digest()
+    assert CompactMask.empty((45, 61)).digest() != CompactMask.empty((61, 45)).digest()
+
+
+def test_composite_matches_the_dense_mask():
+    rng = np.random.default_rng(2)
+    content, stylized = (rng.integers(0, 256, (45, 61, 3), dtype=np.uint8) for _ in range(2))
+    for dense in MASKS:
+        expected = np.where(dense[..., None], stylized, content)
+        assert np.array_equal(np.asarray(composite_with_mask(content, stylized, CompactMask.from_dense(dense))),
+                              expected)
+        assert np.array_equal(np.asarray(composite_with_mask(content, stylized, dense)), expected)
@@ -0,0 +1,92 @@
+"""Tests for batching forwards of different sizes across requests in `scheduler`."""
+from threading import Event, Thread
+from time import monotonic
+
+import numpy as np
+import torch
+from PIL import Image
+
+from scheduler import DynamicBatcher, InferenceScheduler
+from stylization import StyleTransferEngine, stylize
+
+
+def _image(height: int, width: int, seed: int) -> Image.Image:
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width] / 64
+    image = 127 + 60 * np.stack([np.sin(x + y), np.cos(1.3 * x), np.sin(0.7 * y)], -1) + \
+        rng.normal(0, 10, (height, width, 3))
+    return Image.fromarray(image.clip(0, 255).astype(np.uint8))
+
+
+def test_different_sizes_share_a_bucket():
+    torch.manual_seed(0)
+    # Pointwise up to the pooling, so the padding cannot change the valid part of the output
+    module = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 1), torch.nn.ReLU(), torch.nn.MaxPool2d(2))
+    shapes = [(1, 3, 40, 50), (1, 3, 64, 36), (1, 3, 58, 62)]
+    inputs = [torch.rand(shape) for shape in shapes]
+    batches = []
+    module.register_forward_pre_hook(lambda _, args: batches.append(args[0].shape))
+
+    batcher = DynamicBatcher(window_ms=5000, max_batch=4, active=lambda kinds: len(shapes))
+    outputs = [None] * len(inputs)
+
+    def run(i):
+        outputs[i] = batcher.run(module, inputs[i], bucket=64)
+
+    threads = [Thread(target=run, args=(i,)) for i in range(len(inputs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert batches == [(3, 3, 64, 64)]
+    with torch.no_grad():
+        for x, output in zip(inputs, outputs):
+            expected = module(x)
+            assert output.shape == expected.shape
+            assert output.is_contiguous()
+            assert torch.equal(output, expected)
+
+
+def test_stylize_requests_of_different_sizes_share_forwards(random_weights):
+    contents = [_image(200, 260, 0), _image(220, 300, 1), _image(230, 270, 2)]  # All round up to 256 x 320
+    style = _image(256, 256, 3)
+    expected = [stylize(content, style, *random_weights, preserve_color=False) for content in contents]
+
+    engine = StyleTransferEngine.get(*random_weights)
+    shapes = []
+    hooks = [engine.vgg.register_forward_pre_hook(lambda _, args: shapes.append(('encode', args[0].shape))),
+             engine.decoder.register_forward_pre_hook(lambda _, args: shapes.append(('decode', args[0].shape)))]
+    scheduler = InferenceScheduler(workers=len(contents), batch_window_ms=5000)
+    try:
+        futures = [scheduler.submit(stylize, content, style, *random_weights, preserve_color=False)
+                   for content in contents]
+        outputs = [future.result() for future in futures]
+    finally:
+        scheduler.shutdown()
+        for hook in hooks:
+            hook.remove()
+
+    assert sorted(shapes) == [('decode', (3, 512, 32, 40)), ('encode', (3, 3, 256, 256)),
+                              ('encode', (3, 3, 256, 320))]
+    for output, reference in zip(outputs, expected):
+        assert output.shape == reference.shape
+        # Only the pixels near the padded edges see different context
+        assert (output - reference).abs().mean() < 0.03 * reference.abs().mean()
+
+
+def test_other_kinds_of_requests_do_not_hold_up_forwards(random_weights):
+    content, style = _image(64, 64, 0), _image(64, 64, 1)
+    scheduler = InferenceScheduler(workers=2, batch_window_ms=5000)
+    release = Event()
+    try:
+        scheduler.submit(stylize, content, style, *random_weights).result()  # Stylize runs the encoder and decoder
+        segmenting = scheduler.submit(release.wait)  # Running, but never a forward of the encoder or decoder
+        start = monotonic()
+        scheduler.submit(stylize, content, style, *random_weights).result()
+        assert monotonic() - start < 2.5  # Each forward would otherwise wait the 5 s window
+        release.set()
+        segmenting.result()
+    finally:
+        release.set()
+        scheduler.shutdown()
@@ -0,0 +1,37 @@
+"""Tests for stylizing from the precomputed statistics of `style_bank.StyleBank`."""
+import numpy as np
+import pytest
+from PIL import Image
+
+from style_bank import StyleBank, stylize_with_stats
+from stylization import StyleTransferEngine, stylize
+
+
+def _gradient(height: int, width: int, seed: int) -> Image.Image:
+    """A smooth image with a spread of colours, which the pooling of the identity networks keeps."""
+    rng = np.random.default_rng(seed)
+    y, x = np.linspace(0, 1, height)[:, None, None], np.linspace(0, 1, width)[None, :, None]
+    blob = np.exp(-((x - rng.uniform(0.2, 0.8)) ** 2 + (y - rng.uniform(0.2, 0.8)) ** 2) * 8)
+    image = 30 + x * rng.uniform(0, 120, 3) + y * rng.uniform(0, 120, 3) + blob * rng.uniform(-30, 30, 3)
+    return Image.fromarray(np.clip(image, 0, 255).astype(np.uint8))
+
+
+@pytest.mark.parametrize('alpha', [1.0, 0.5])
+def test_preserve_color_matches_stylize(identity_weights, tmp_path, alpha):
+    content, style = _gradient(96, 128, 0), _gradient(128, 128, 1)
+    bank = StyleBank(tmp_path / 'style_bank.bin')
+    stats = bank.register(style, StyleTransferEngine.get(*identity_weights))
+
+    expected = stylize(content, style, *identity_weights, alpha=alpha, preserve_color=True)
+    output = stylize_with_stats(content, stats, *identity_weights, alpha=alpha, preserve_color=True)
+    assert output.shape == expected.shape
+    assert (output - expected).abs().mean() < 0.03  # Mapping from the style's colour statistics is off by 0.1-0.2
+
+
+def test_register_once(identity_weights, tmp_path):
+    style = _gradient(64, 64, 2)
+    bank = StyleBank(tmp_path / 'style_bank.bin')
+    stats = bank.register(style, StyleTransferEngine.get(*identity_weights))
+    assert len(bank) == 1
+    assert bank.register(style, StyleTransferEngine.get(*identity_weights)).key == stats.key
+    assert len(StyleBank(tmp_path / 'style_bank.bin')) == 1  # Read back from the file
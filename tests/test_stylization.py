@@ -0,0 +1,44 @@
+"""Tests for the feature cache of `stylization.stylize`."""
+import numpy as np
+import torch
+from PIL import Image
+
+from stylization import stylize
+
+BUDGET_MB = 0.01  # 64-pixel tiles
+
+
+def _image(seed, size=160):
+    return Image.fromarray(np.random.default_rng(seed).integers(0, 256, (size, size, 3), dtype=np.uint8))
+
+
+def _cached_bytes(feature_cache):
+    tile_features = feature_cache['stylize_features'][1].tile_features
+    return sum(2 * f.numel() * f.element_size() for f, _ in tile_features.values()), len(tile_features)
+
+
+def test_tile_features_are_opt_in(random_weights):
+    feature_cache = {}
+    stylize(_image(0), _image(1), *random_weights, feature_cache=feature_cache, memory_budget_mb=BUDGET_MB)
+    assert _cached_bytes(feature_cache) == (0, 0)
+
+
+def test_tile_features_stay_within_their_cap(random_weights):
+    content, style, feature_cache = _image(0), _image(1), {}
+    stylize(content, style, *random_weights, alpha=1.0, feature_cache=feature_cache, memory_budget_mb=BUDGET_MB,
+            tile_cache_mb=5)
+    cached_bytes, tiles = _cached_bytes(feature_cache)
+    assert 0 < tiles < 9 and cached_bytes <= 5 * 2 ** 20  # Not all of the 3x3 tiles
+
+    # A later alpha reuses the kept tiles and matches an uncached run
+    output = stylize(content, style, *random_weights, alpha=0.5, feature_cache=feature_cache,
+                     memory_budget_mb=BUDGET_MB, tile_cache_mb=5)
+    expected = stylize(content, style, *random_weights, alpha=0.5, memory_budget_mb=BUDGET_MB)
+    assert torch.allclose(output, expected, atol=1e-5)
+
+    # Another content image replaces the features of the previous one
+    other = _image(2, size=96)
+    output = stylize(other, style, *random_weights, feature_cache=feature_cache, memory_budget_mb=BUDGET_MB,
+                     tile_cache_mb=5)
+    assert torch.allclose(output, stylize(other, style, *random_weights, memory_budget_mb=BUDGET_MB), atol=1e-5)
+    assert feature_cache['stylize_features'][1].region.shape[-2:] == (96, 96)
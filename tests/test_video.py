@@ -0,0 +1,77 @@
+"""Tests for stylizing a region across a synthetic clip with `video.run`."""
+import numpy as np
+import pytest
+from PIL import Image
+
+import video
+
+NUM_FRAMES, HEIGHT, WIDTH = 6, 240, 320
+
+
+@pytest.fixture(scope='module')
+def style():
+    rng = np.random.default_rng(1)
+    return Image.fromarray(rng.integers(0, 256, (64, 64, 3), dtype=np.uint8))
+
+
+def _run(tmp_path, weights, style, batch_size, reprompt_every=0):
+    mask = video.box_mask(video.synthetic_box(0, HEIGHT, WIDTH), HEIGHT, WIDTH)
+    output_dir = tmp_path / f'batch_{batch_size}'
+    stats = video.run(video.synthetic_frames(NUM_FRAMES, HEIGHT, WIDTH), style, output_dir, mask,
+                      batch_size=batch_size, reprompt_every=reprompt_every, style_size=64, vgg_path=weights[0],
+                      decoder_path=weights[1])
+    assert stats['frames'] == NUM_FRAMES
+    return mask, output_dir
+
+
+def test_only_the_region_changes(random_weights, style, tmp_path):
+    mask, output_dir = _run(tmp_path, random_weights, style, batch_size=4)
+    # Only the frames, so that `ffmpeg -i frame_%06d.png` and globs see nothing else
+    assert sorted(path.name for path in output_dir.iterdir()) == [f'frame_{i:06d}.png' for i in range(NUM_FRAMES)]
+
+    inside = np.asarray(mask)
+    for index, frame in enumerate(video.synthetic_frames(NUM_FRAMES, HEIGHT, WIDTH)):
+        output = np.asarray(Image.open(output_dir / f'frame_{index:06d}.png'))
+        assert np.array_equal(output[~inside], frame[~inside])
+        assert not np.array_equal(output[inside], frame[inside])
+
+
+def _follow_square(monkeypatch, reprompt_every):
+    """Stand in for SAM, finding the moving square on each re-prompted frame."""
+    segmentation = pytest.importorskip('segmentation')
+    monkeypatch.setattr(segmentation, 'init', lambda: (None, None, None))
+    keyframes = iter(range(reprompt_every, NUM_FRAMES, reprompt_every))
+    monkeypatch.setattr(video, 'reprompt', lambda frame, previous, *sam: video.box_mask(
+        video.synthetic_box(next(keyframes), HEIGHT, WIDTH), HEIGHT, WIDTH))
+
+
+@pytest.mark.parametrize('reprompt_every', [0, 3])
+def test_batched_frames_match_single_frames(random_weights, style, tmp_path, monkeypatch, reprompt_every):
+    # With re-prompting every 3 frames, the mask changes within the second batch of 4
+    if reprompt_every:
+        _follow_square(monkeypatch, reprompt_every)
+    _, batched = _run(tmp_path, random_weights, style, 4, reprompt_every)
+    if reprompt_every:
+        _follow_square(monkeypatch, reprompt_every)
+    _, single = _run(tmp_path, random_weights, style, 1, reprompt_every)
+    for index in range(NUM_FRAMES):
+        name = f'frame_{index:06d}.png'
+        difference = np.abs(np.asarray(Image.open(batched / name), np.int16) -
+                            np.asarray(Image.open(single / name), np.int16))
+        assert difference.max() <= 1  # Rounding of the batched convolutions only
+
+
+def test_region_is_aligned_with_stylize(random_weights, style, tmp_path):
+    from stylization import stylize
+    from utils import composite_with_mask
+
+    frame = next(video.synthetic_frames(1, HEIGHT, WIDTH))
+    mask = video.box_mask((50, 45, 131, 127), HEIGHT, WIDTH)
+    assert video.region_box(mask) == (0, 0, 195, 191)  # Sides that are not multiples of 8
+    video.run([frame], style, tmp_path, mask, style_size=64, preserve_color=False, vgg_path=random_weights[0],
+              decoder_path=random_weights[1])
+    output = np.asarray(Image.open(tmp_path / 'frame_000000.png'), np.int16)
+
+    expected = stylize(Image.fromarray(frame), style, *random_weights, style_size=64, preserve_color=False, mask=mask)
+    expected = np.asarray(composite_with_mask(frame, expected, mask), np.int16)
+    assert np.abs(output - expected).max() <= 1
@@ -0,0 +1,189 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+LOG_LEVEL_VARIABLE = 'SEGIFY_LOG_LEVEL'  # The environment variable setting the level of the app's logs
+
+# The trace of the request being handled on this thread (or context), if any
+_current: ContextVar[Optional['Trace']] = ContextVar('current_trace', default=None)
+# The nesting depth of the stage being recorded
+_depth: ContextVar[int] = ContextVar('trace_depth', default=0)
+
+
+class Trace:
+    """
+    A structured record of the named stages of one request, e.g. one stylization.
+    Stages are recorded with `stage` while the trace is active (see `trace`) and can be nested.
+    """
+
+    def __init__(self, name: str):
+        """
+        :param name: The name of the request, e.g. 'stylize'.
+        """
+        self.name = name
+        self.spans: List[Dict] = []  # One dictionary per finished stage, in order of completion
+        self.profiler: Optional['torch.profiler.profile'] = None  # Set by `trace` when profiling
+        self._origin = perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, name: str, start: float, end: float, depth: int, **args):
+        """Record a finished stage, with `start` and `end` from `time.perf_counter`."""
+        with self._lock:
+            self.spans.append({'name': name, 'start_ms': (start - self._origin) * 1000,
+                               'duration_ms': (end - start) * 1000, 'depth': depth,
+                               'thread': threading.get_ident(), 'args': args})
+
+    @property
+    def total_ms(self) -> float:
+        """The wall time from the first stage's start to the last stage's end."""
+        if not self.spans:
+            return 0.0
+        return max(s['start_ms'] + s['duration_ms'] for s in self.spans) - min(s['start_ms'] for s in self.spans)
+
+    def breakdown(self) -> Dict[str, float]:
+        """
+        Get the total time per stage name, in the order the stages first started.
+        Nested stages are also counted in their parent stage.
+        :return: A dictionary from stage name to milliseconds.
+        """
+        totals: Dict[str, float] = {}
+        for span in sorted(self.spans, key=lambda s: s['start_ms']):
+            totals[span['name']] = totals.get(span['name'], 0.0) + span['duration_ms']
+        return totals
+
+    def summary(self) -> str:
+        """A one-line breakdown for logs."""
+        stages = ', '.join(f'{name} {ms:.1f} ms' for name, ms in self.breakdown().items())
+        return f'{self.name} took {self.total_ms:.1f} ms: {stages}'
+
+    def to_json(self) -> Dict:
+        return {'name': self.name, 'total_ms': self.total_ms, 'breakdown_ms': self.breakdown(), 'spans': self.spans}
+
+    def to_chrome_trace(self) -> Dict:
+        """The trace in the Chrome trace event format, viewable in chrome://tracing or Perfetto."""
+        events = [{'name': s['name'], 'ph': 'X', 'ts': s['start_ms'] * 1000, 'dur': s['duration_ms'] * 1000,
+                   'pid': os.getpid(), 'tid': s['thread'], 'args': s['args']} for s in self.spans]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'request': self.name}}
+
+    def save(self, path: Union[str, Path], chrome: bool = False):
+        """
+        Save the trace as JSON.
+        :param path: The path to save at.
+        :param chrome: Boolean to save in the Chrome trace event format instead. Default False
+        """
+        Path(path).write_text(json.dumps(self.to_chrome_trace() if chrome else self.to_json(), indent=2))
+
+    def profiler_chrome_trace(self) -> Optional[str]:
+        """The captured `torch.profiler` profile in the Chrome trace format, or None if not profiled."""
+        if self.profiler is None:
+            return None
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir, 'profile.json')
+            self.profiler.export_chrome_trace(str(path))
+            return path.read_text()
+
+
+@contextmanager
+def trace(name: str, profile: bool = False):
+    """
+    Record the stages of a request. The trace is logged when the request finishes.
+    Usage: `with trace('stylize') as t: ...`, then e.g. `t.breakdown()`.
+    :param name: The name of the request.
+    :param profile: Boolean to also capture a `torch.profiler` profile of the request. Default False
+    """
+    current = Trace(name)
+    token = _current.set(current)
+    try:
+        if profile:
+            import torch  # Imported here, so that importing this module does not import torch
+            with torch.profiler.profile(record_shapes=True) as current.profiler:
+                yield current
+        else:
+            yield current
+    finally:
+        _current.reset(token)
+        logger.info(current.summary())
+
+
+@contextmanager
+def stage(name: str, **args):
+    """
+    Record a named stage in the active trace. Without an active trace this does nothing.
+    :param name: The stage name, e.g. 'decode'.
+    :param args: Extra JSON-serialisable details to store with the stage.
+    """
+    current = _current.get()
+    if current is None:
+        yield
+        return
+
+    depth = _depth.get()
+    token = _depth.set(depth + 1)
+    start = perf_counter()
+    try:
+        if current.profiler is not None:
+            import torch
+            with torch.profiler.record_function(name):
+                yield
+        else:
+            yield
+    finally:
+        torch = sys.modules.get('torch')  # Without torch there are no kernels to wait for
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.synchronize()  # Kernels run asynchronously, so wait for them to be timed correctly
+        current.add(name, start, perf_counter(), depth, **args)
+        _depth.reset(token)
+
+
+def setup_logging(level: Union[int, str, None] = None):
+    """
+    Write the app's logs, the trace of every request and the warm-up times, to stderr. Streamlit leaves the root
+    logger at WARNING, under which they would not appear. Calling it again, e.g. on every rerun, changes nothing.
+    :param level: The level of the logs shown. Default None, which uses the `SEGIFY_LOG_LEVEL` environment variable,
+        or INFO if it is not set.
+    """
+    level = level or os.environ.get(LOG_LEVEL_VARIABLE, 'INFO')
+    for name in (__name__, 'warmup'):
+        app_logger = logging.getLogger(name)
+        app_logger.setLevel(level.upper() if isinstance(level, str) else level)
+        if not app_logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(levelname)s: %(message)s'))
+            app_logger.addHandler(handler)
+            app_logger.propagate = False  # Not again by a handler the root logger may have
+
+
+def current_trace() -> Optional[Trace]:
+    """The active trace, if any."""
+    return _current.get()
+
+
+def show_trace(current: Trace, container=None):
+    """
+    Show a trace's per-stage breakdown with buttons to download it, in the Streamlit sidebar by default.
+    :param current: The Trace object.
+    :param container: The Streamlit container to show it in. Default None, which uses the sidebar.
+    """
+    import streamlit as st
+
+    expander = (container or st.sidebar).expander(f'Timing of {current.name}: {current.total_ms / 1000:.2f} s')
+    breakdown = current.breakdown()
+    expander.table({'Stage': list(breakdown), 'Milliseconds': [round(ms, 1) for ms in breakdown.values()]})
+    expander.download_button('Download trace (JSON)', json.dumps(current.to_json(), indent=2),
+                             file_name=f'{current.name}_trace.json', mime='application/json')
+    expander.download_button('Download trace (Chrome format)', json.dumps(current.to_chrome_trace()),
+                             file_name=f'{current.name}_chrome_trace.json', mime='application/json')
+    profile = current.profiler_chrome_trace()
+    if profile is not None:
+        expander.download_button('Download torch profile (Chrome format)', profile,
+                                 file_name=f'{current.name}_torch_profile.json', mime='application/json')
@@ -1,18 +1,82 @@
 import os
-from PIL import Image
-from typing import Union, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from glob import escape as glob_escape
+from hashlib import blake2b, sha256
+from PIL import Image, ImageFilter
+from typing import Dict, Optional, Union, Tuple
 import numpy as np
 from pathlib import Path
-from shutil import rmtree
-from requests import get
+from shutil import copyfileobj, rmtree
+from threading import Lock
+from requests import RequestException, get, head
 
+from masks import CompactMask, mask_bbox  # `mask_bbox` is re-exported for the older imports
+from tracing import stage
 
-def get_model(model_name: str, url: str, dir_str: str = 'models') -> Tuple[bool, str]:
+DOWNLOAD_CHUNK_SIZE = 4 * 2 ** 20  # 4 MiB
+
+# One lock per model file, so that threads asking for the same model download it only once
+_download_locks: Dict[Path, Lock] = {}
+_download_locks_lock = Lock()
+
+
+def file_sha256(path: Union[str, Path], chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> str:
+    """The hex SHA-256 digest of a file."""
+    digest = sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _ranged_length(url: str, timeout: float) -> Optional[int]:
+    """The size of the file at `url` if the server supports range requests, otherwise None."""
+    response = head(url, allow_redirects=True, timeout=timeout)
+    response.raise_for_status()
+    if response.headers.get('Accept-Ranges') != 'bytes' or 'Content-Length' not in response.headers:
+        return None
+    return int(response.headers['Content-Length'])
+
+
+def _download_range(url: str, path: Path, start: int, end: Optional[int], chunk_size: int, timeout: float):
+    """
+    Download bytes `start` to `end` (inclusive, None for the end of the file) of `url` into `path`.
+    Bytes already in `path` from an interrupted download are kept and only the rest is requested.
+    """
+    done = path.stat().st_size if path.exists() else 0
+    if end is not None and start + done > end:
+        return
+    headers = {'Range': f'bytes={start + done}-{"" if end is None else end}'} if start + done or end is not None else {}
+    with get(url, stream=True, headers=headers, timeout=timeout) as response:
+        if response.status_code == 416 and done and end is None:
+            return  # Range not satisfiable: an earlier run got the whole file but stopped before renaming it
+        response.raise_for_status()
+        if headers and response.status_code != 206:
+            if start or end is not None:
+                raise IOError(f'The server ignored the range request for bytes {start}-{end}')
+            done = 0  # The server sent the whole file, so start over
+        with path.open('ab' if done else 'wb') as f:
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+
+
+def get_model(model_name: str, url: str, dir_str: str = 'models', sha256_digest: Optional[str] = None,
+              chunk_size: int = DOWNLOAD_CHUNK_SIZE, segments: int = 1,
+              timeout: float = 60.0) -> Tuple[bool, str]:
     """
     Get model file from web.
+    The file is downloaded to `<model_name>.part` and only renamed to `model_name` once complete (and verified), so
+    an interrupted download never leaves a truncated model behind. Rerunning resumes it with HTTP range requests, and
+    a `.part` file that is already complete is only verified and renamed.
     :param model_name: The model file's name (with extension)
     :param url: The url
     :param dir_str: The path to save (without the `model_name`)
+    :param sha256_digest: If specified, the expected hex SHA-256 digest of the file. An existing file that does not
+        match (e.g. truncated by an older download) is downloaded again. Default None
+    :param chunk_size: The number of bytes read and written at a time. Default `DOWNLOAD_CHUNK_SIZE`.
+    :param segments: The number of byte ranges downloaded in parallel, if the server supports range requests.
+        Default 1.
+    :param timeout: The connection and read timeout in seconds. Default 60.
     :return: A 2-tuple where the first value (boolean) indicates whether the download was successful and
                 the second value (str) gives a related output message.
     """
@@ -21,26 +85,93 @@ def get_model(model_name: str, url: str, dir_str: str = 'models') -> Tuple[bool,
 
     # Define the URL and the local file path
     model_file = Path(dir_str, model_name)  # Use Path object
+    with _download_locks_lock:
+        lock = _download_locks.setdefault(model_file.resolve(), Lock())
+    with lock:
+        return _get_model(model_file, url, sha256_digest, chunk_size, segments, timeout)
+
+
+def _get_model(model_file: Path, url: str, sha256_digest: Optional[str], chunk_size: int, segments: int,
+               timeout: float) -> Tuple[bool, str]:
+    model_name = model_file.name
+    part_file = model_file.with_name(model_name + '.part')
 
     # Check if the file already exists
-    if not model_file.exists():
-        # Download the file using requests
-        response = get(url, stream=True)
-
-        if response.status_code == 200:
-            # Create the file in write-binary mode
-            with model_file.open("wb") as f:
-                for chunk in response.iter_content(1024):
-                    if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
-            return True, f"Downloaded {model_name} successfully!"
+    if model_file.exists():
+        if sha256_digest is None or file_sha256(model_file, chunk_size) == sha256_digest.lower():
+            return True, 'File already exists'
+        model_file.unlink()
+
+    try:
+        size = _ranged_length(url, timeout) if segments > 1 else None
+        if size is not None and part_file.exists() and part_file.stat().st_size == size:
+            pass  # Complete, an earlier run stopped before renaming it
+        elif size is None or size < 2 * segments * chunk_size:  # Not worth splitting
+            _download_range(url, part_file, 0, None, chunk_size, timeout)
         else:
-            return False, f"Download failed with status code: {response.status_code}"
-    else:
-        return True, 'File already exists'
+            # Each segment has its own part file named by its range, so each one resumes on its own
+            bounds = [(i * size // segments, (i + 1) * size // segments - 1) for i in range(segments)]
+            segment_files = [part_file.with_name(f'{part_file.name}{start}-{end}') for start, end in bounds]
+            with ThreadPoolExecutor(segments) as executor:
+                futures = [executor.submit(_download_range, url, path, start, end, chunk_size, timeout)
+                           for path, (start, end) in zip(segment_files, bounds)]
+                for future in futures:
+                    future.result()
+            with part_file.open('wb') as f:
+                for path in segment_files:
+                    with path.open('rb') as segment:
+                        copyfileobj(segment, f, chunk_size)
+            for path in part_file.parent.glob(f'{glob_escape(part_file.name)}*-*'):
+                path.unlink()
+    except (RequestException, OSError) as e:
+        return False, f'Download of {model_name} failed, rerun to resume it: {e}'
+
+    if sha256_digest is not None:
+        digest = file_sha256(part_file, chunk_size)
+        if digest != sha256_digest.lower():
+            part_file.unlink()
+            return False, f'Checksum mismatch for {model_name}: expected {sha256_digest}, got {digest}'
+
+    os.replace(part_file, model_file)
+    return True, f"Downloaded {model_name} successfully!"
+
+
+def get_models(models: Dict[str, str], dir_str: str = 'models', sha256_digests: Optional[Dict[str, str]] = None,
+               max_workers: int = 4, **kwargs) -> Dict[str, Tuple[bool, str]]:
+    """
+    Get several model files from the web concurrently, see `get_model`.
+    :param models: A dictionary from model file name to url.
+    :param dir_str: The path to save (without the model names)
+    :param sha256_digests: If specified, a dictionary from model file name to its expected hex SHA-256 digest.
+    :param max_workers: The number of models downloaded at the same time. Default 4.
+    :param kwargs: Further arguments for `get_model`, e.g. `segments`.
+    :return: A dictionary from model file name to the 2-tuple returned by `get_model`.
+    """
+    sha256_digests = sha256_digests or {}
+    with ThreadPoolExecutor(max_workers) as executor:
+        futures = {name: executor.submit(get_model, name, url, dir_str, sha256_digests.get(name), **kwargs)
+                   for name, url in models.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def image_hash(image: Union[np.ndarray, Image.Image, CompactMask]) -> str:
+    """
+    Hash the pixel content of an image, so that equal images share cache entries regardless of where they came from.
+    :param image: The image as a numpy array or a PIL.Image object, or a CompactMask object.
+    :return: The hex digest of the image's shape, dtype and pixels.
+    """
+    if isinstance(image, CompactMask):
+        return image.digest()  # Hashes the packed pixels, without decoding them
+    array = np.ascontiguousarray(image)
+    digest = blake2b(digest_size=16)
+    digest.update(f'{array.shape}{array.dtype}'.encode())
+    digest.update(array.data)
+    return digest.hexdigest()
+
 
 def combine_with_mask(content_path: Union[str, Path], style_path: Union[str, Path],
-                      masked_array: np.ndarray, save_path: Union[str, Path, None] = None) -> Image.Image:
+                      masked_array: Union[np.ndarray, CompactMask],
+                      save_path: Union[str, Path, None] = None) -> Image.Image:
     """
     Combine the content image with the style image based on the mask.
     :param content_path: The path to the original content image
@@ -54,7 +185,7 @@ def combine_with_mask(content_path: Union[str, Path], style_path: Union[str, Pat
     image2 = Image.open(style_path)
 
     # Load the boolean numpy array
-    boolean_array = (~masked_array).copy()
+    boolean_array = ~np.asarray(masked_array, dtype=bool)
 
     # Convert boolean array to integer (0s and 1s)
     boolean_array = boolean_array.astype(np.uint8)
@@ -88,6 +219,61 @@ def combine_with_mask(content_path: Union[str, Path], style_path: Union[str, Pat
     return combined_image
 
 
+def composite_with_mask(content: Union[Image.Image, np.ndarray], stylized: Union['torch.Tensor', np.ndarray],
+                        masked_array: Union[np.ndarray, CompactMask], feather: float = 0.0,
+                        save_path: Union[str, Path, None] = None) -> Image.Image:
+    """
+    Combine the content image with the stylized image based on the mask, in memory.
+    Unlike `combine_with_mask`, nothing is read from disk and the blend is a single vectorized operation.
+    :param content: The original content image, as a PIL.Image object or an (H, W, 3) uint8 array.
+    :param stylized: The stylized image, as the (1, 3, H, W) or (3, H, W) tensor from `stylize` with values in [0, 1]
+        or an (H, W, 3) uint8 array. It is resized to the content's size if needed.
+    :param masked_array: The mask corresponding to the segment, as an array or a CompactMask object. It is resized to
+        the content's size if needed. A CompactMask of the content's size only blends the pixels inside its box.
+    :param feather: If positive, the radius in pixels of the Gaussian blur softening the mask's edges. Default 0.
+    :param save_path: The path where the new image will be saved. To not save, leave None.
+    :return: The Pil.Image object for the final image.
+    """
+    with stage('composite'):
+        if isinstance(content, Image.Image):
+            content = content.convert('RGB')
+        content = np.asarray(content)[..., :3]
+        H, W = content.shape[:2]
+
+        if not isinstance(stylized, np.ndarray):
+            # Same conversion as `torchvision.utils.save_image`
+            stylized = stylized.detach().squeeze(0).mul(255).add_(0.5).clamp_(0, 255).permute(1, 2, 0)
+            stylized = stylized.cpu().byte().numpy()
+        if stylized.shape[:2] != (H, W):
+            stylized = np.asarray(Image.fromarray(stylized).resize((W, H), Image.Resampling.LANCZOS))
+
+        if isinstance(masked_array, CompactMask) and masked_array.shape == (H, W) and feather <= 0:
+            combined = content.copy()
+            if masked_array.box is not None:
+                top, left, bottom, right = masked_array.box
+                combined[top:bottom, left:right] = np.where(masked_array.crop(masked_array.box)[..., None],
+                                                            stylized[top:bottom, left:right],
+                                                            content[top:bottom, left:right])
+        elif masked_array.shape == (H, W) and feather <= 0:
+            combined = np.where(masked_array[..., None], stylized, content)
+        else:
+            mask = Image.fromarray(np.asarray(masked_array, dtype=np.uint8) * 255)
+            if mask.size != (W, H):
+                mask = mask.resize((W, H), Image.Resampling.LANCZOS)
+            if feather > 0:
+                mask = mask.filter(ImageFilter.GaussianBlur(feather))
+            weight = np.asarray(mask, dtype=np.float32)[..., None] / 255
+            combined = (content + (stylized.astype(np.float32) - content) * weight + 0.5).astype(np.uint8)
+
+        combined_image = Image.fromarray(combined)
+
+    if save_path:
+        combined_image.save(save_path)
+        print(f'Final image saved at {save_path}')
+
+    return combined_image
+
+
 def create_folder(folder_name):
     """
     Creates a new folder with the specified name.
@@ -0,0 +1,278 @@
+"""
+Stylize one region across the frames of a video or frame sequence.
+
+Example:
+    python video.py --frames clip.mp4 --style imgs/test_images/style/starry_night.jpg --point 320 240 --output out
+    python video.py --synthetic 48 --style imgs/test_images/style/starry_night.jpg --output out
+
+Frames are decoded on a reader thread, stylized in batches and written on a writer thread, with bounded queues
+between the stages. The style is encoded once for the whole clip, recoloured to the first frame when preserving
+colour. The region's mask is found once on the first frame, from a mask image or SAM point prompts, and reused for
+every frame; with `--reprompt-every N` SAM is prompted again every N frames with the box of the previous mask, so
+the mask follows a moving region. Only the padded box around the mask is run through the networks; the box stays
+fixed until the mask changes, so the AdaIN statistics and the context of the region do not change between batches,
+which would make the region flicker. Reading video files
+needs PyAV (`pip install av`); the outputs are numbered PNG frames, e.g. for
+`ffmpeg -framerate 24 -i out/frame_%06d.png out.mp4`.
+"""
+import argparse
+from pathlib import Path
+from queue import Queue
+from threading import Thread
+from time import time
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.transforms.functional import to_tensor
+
+from batch import Writer, list_images
+from masks import CompactMask
+from stylization import REGION_PADDING, StyleTransferEngine
+from tracing import stage
+from utils import composite_with_mask
+
+REPROMPT_MARGIN = 0.1  # The box prompt of a re-prompted frame is the previous mask's box grown by this fraction
+
+
+def region_box(mask: CompactMask) -> Optional[Tuple[int, int, int, int]]:
+    """The box run through the networks, the mask's box padded like the regions of `stylize`, or None if empty."""
+    if mask.box is None:
+        return None
+    H, W = mask.shape
+    top, left, bottom, right = mask.box
+    return (max(top - REGION_PADDING, 0), max(left - REGION_PADDING, 0), min(bottom + REGION_PADDING, H),
+            min(right + REGION_PADDING, W))
+
+
+class FrameReader:
+    """Decodes frames on a background thread into a bounded queue, and iterates over them as (index, frame)."""
+
+    def __init__(self, frames: Iterable[np.ndarray], queue_size: int):
+        self.queue: Queue = Queue(maxsize=queue_size)  # Blocks decoding when the model stage falls behind
+        self.error: Optional[BaseException] = None
+        self._thread = Thread(target=self._run, args=(frames,), daemon=True)
+        self._thread.start()
+
+    def _run(self, frames: Iterable[np.ndarray]):
+        try:
+            for index, frame in enumerate(frames):
+                self.queue.put((index, frame))
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.queue.put(None)
+
+    def __iter__(self) -> Iterator[Tuple[int, np.ndarray]]:
+        while (item := self.queue.get()) is not None:
+            yield item
+        if self.error:
+            raise self.error
+
+
+def read_frames(source: Path) -> Iterator[np.ndarray]:
+    """
+    Decode the frames of a video file, or of a directory of images in name order.
+    :return: An iterator over (H, W, 3) uint8 frames.
+    """
+    if source.is_dir():
+        for path in list_images(source):
+            yield np.asarray(Image.open(path).convert('RGB'))
+        return
+
+    try:
+        from torchvision.io import VideoReader
+        reader = VideoReader(str(source), 'video')
+    except (ImportError, RuntimeError) as e:
+        raise RuntimeError(f'Cannot decode {source}, install PyAV (`pip install av`) or pass a directory of '
+                           f'frames') from e
+    for frame in reader:
+        yield frame['data'].permute(1, 2, 0).numpy()
+
+
+def synthetic_box(index: int, height: int, width: int) -> Tuple[int, int, int, int]:
+    """The (top, left, bottom, right) box of the square moving across frame `index` of `synthetic_frames`."""
+    side = min(height, width) // 3
+    left = (index * 4) % (width - side)
+    top = (height - side) // 2 + int(round(np.sin(index / 6) * (height - side) / 4))
+    return top, left, top + side, left + side
+
+
+def synthetic_frames(num_frames: int, height: int = 240, width: int = 320) -> Iterator[np.ndarray]:
+    """
+    Generate a test clip: a textured square moving over a smooth background, see `synthetic_box` for its position.
+    :return: An iterator over (height, width, 3) uint8 frames.
+    """
+    rng = np.random.default_rng(0)
+    background = np.asarray(Image.fromarray(rng.integers(0, 256, (6, 8, 3), dtype=np.uint8))
+                            .resize((width, height), Image.Resampling.BICUBIC))
+    texture = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    for index in range(num_frames):
+        frame = background.copy()
+        top, left, bottom, right = synthetic_box(index, height, width)
+        frame[top:bottom, left:right] = texture[:bottom - top, :right - left]
+        yield frame
+
+
+def box_mask(box: Tuple[int, int, int, int], height: int, width: int) -> CompactMask:
+    """A mask covering a (top, left, bottom, right) box."""
+    mask = np.zeros((height, width), bool)
+    top, left, bottom, right = box
+    mask[top:bottom, left:right] = True
+    return CompactMask.from_dense(mask)
+
+
+def reprompt(frame: np.ndarray, previous: CompactMask, model_file, model_type, device) -> CompactMask:
+    """
+    Find the region of `previous` in a new frame, prompting SAM with the previous mask's box grown by
+    `REPROMPT_MARGIN`. An empty previous mask is kept.
+    """
+    from segmentation import predict_mask
+
+    if previous.box is None:
+        return previous
+    top, left, bottom, right = previous.box
+    H, W = previous.shape
+    dy, dx = (bottom - top) * REPROMPT_MARGIN, (right - left) * REPROMPT_MARGIN
+    box = (max(left - dx, 0), max(top - dy, 0), min(right + dx, W - 1), min(bottom + dy, H - 1))
+    return predict_mask(frame, model_file, model_type, device, box=box)
+
+
+def run(frames: Iterable[np.ndarray], style: Image.Image, output_dir: Path,
+        mask: Union[np.ndarray, CompactMask, None] = None, points: Optional[Sequence[Tuple[float, float]]] = None,
+        alpha: float = 1.0, batch_size: int = 4, queue_size: int = 8, reprompt_every: int = 0,
+        style_size: int = 512, preserve_color: bool = True, vgg_path: str = 'models/vgg_normalised.pth',
+        decoder_path: str = 'models/decoder.pth', precision: str = 'fp32',
+        channels_last: bool = False) -> Dict[str, float]:
+    """
+    Stylize a region across a clip and save the frames as `frame_000000.png`, `frame_000001.png`, ...
+    :param frames: The (H, W, 3) uint8 frames, all of the same size, e.g. from `read_frames`.
+    :param style: The style image.
+    :param output_dir: The directory for the output frames.
+    :param mask: If specified, the region's mask on the first frame. It is resized to the frame size if needed.
+    :param points: If specified (and `mask` is not), the (x, y) pixels of the region on the first frame, which SAM
+        segments. Default None, and without either the whole frame is stylized.
+    :param batch_size: The number of frames run through the networks together. Default 4.
+    :param queue_size: The maximum number of frames waiting between two stages. Default 8.
+    :param reprompt_every: If positive, SAM finds the region again every this many frames, see `reprompt`.
+        Default 0 (the first frame's mask is reused).
+    :param style_size: The (minimum) size for the style image, 0 to keep its size. Default 512.
+    The remaining parameters are as in `stylization.stylize`.
+    :return: A dictionary with the number of frames, the seconds taken and the frames per second.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    engine = StyleTransferEngine.get(vgg_path, decoder_path, 'cpu' if precision == 'int8' else None,
+                                     precision=precision, channels_last=channels_last)
+    sam = None
+    if points or reprompt_every > 0:
+        from segmentation import init  # Only needed, and only imported, for SAM prompts
+        sam = init()
+
+    writer = Writer(output_dir, queue_size, track_progress=False)  # Keeps the folder to frames, e.g. for ffmpeg
+    style_stats, current, box = None, None, None
+    batch: List[Tuple[int, np.ndarray, CompactMask]] = []
+    start, done = time(), 0
+
+    def flush():
+        nonlocal done
+        if box is None:  # Nothing to stylize
+            for index, frame, _ in batch:
+                writer.put(f'frame_{index:06d}.png', Image.fromarray(frame))
+        else:
+            top, left, bottom, right = box  # The same for every frame of the batch
+            with stage('transform'):
+                content = torch.stack([to_tensor(frame[top:bottom, left:right]) for _, frame, _ in batch])
+            style_mean, style_std = (stats.expand(len(batch), -1, -1, -1) for stats in style_stats)
+            outputs = engine.transfer_with_stats(content.to(engine.device, engine.dtype), style_mean, style_std, alpha)
+            with stage('composite'):
+                for (index, frame, frame_mask), output in zip(batch, outputs):
+                    # The decoder rounds the sides up to multiples of 8, cropped as in `stylize` to stay aligned
+                    output = output[..., :bottom - top, :right - left]
+                    region = composite_with_mask(frame[top:bottom, left:right], output,
+                                                 frame_mask.crop((top, left, bottom, right)))
+                    image = frame.copy()
+                    image[top:bottom, left:right] = np.asarray(region)
+                    writer.put(f'frame_{index:06d}.png', Image.fromarray(image))
+        done += len(batch)
+        batch.clear()
+        print(f'{done} frames ({done / (time() - start):.2f} frames/s)')
+
+    for index, frame in FrameReader(frames, queue_size):
+        H, W = frame.shape[:2]
+        if style_stats is None:
+            # Encoded once for the clip, with the colours of the first frame
+            style_stats = engine.style_stats(engine.prepare_style(style, to_tensor(frame), style_size,
+                                                                  preserve_color=preserve_color))
+            if mask is not None:
+                current = mask if isinstance(mask, CompactMask) else CompactMask.from_dense(mask)
+                current = current.resize((H, W))
+            elif points:
+                from segmentation import predict_mask
+                current = predict_mask(frame, *sam, points=points)
+            else:
+                current = box_mask((0, 0, H, W), H, W)
+        elif reprompt_every > 0 and index % reprompt_every == 0:
+            with stage('reprompt'):
+                current = reprompt(frame, current, *sam)
+
+        # A batch is run on one box, so a new mask's box starts a new batch
+        if batch and region_box(current) != box:
+            flush()
+        box = region_box(current)
+        batch.append((index, frame, current))
+        if len(batch) == batch_size:
+            flush()
+    if batch:
+        flush()
+
+    writer.close()
+    seconds = time() - start
+    print(f'Stylized {done} frames in {seconds:.1f} seconds ({done / seconds:.2f} frames/s)')
+    return {'frames': done, 'seconds': seconds, 'fps': done / seconds}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stylize a region across the frames of a video.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--frames', type=Path, help='Video file (needs PyAV) or directory of frame images.')
+    source.add_argument('--synthetic', type=int, metavar='N',
+                        help='Stylize the moving square of an N-frame synthetic clip, e.g. to measure frames/s.')
+    parser.add_argument('--style', type=Path, required=True, help='Style image.')
+    region = parser.add_mutually_exclusive_group()
+    region.add_argument('--mask', type=Path, help='Mask image of the region on the first frame (non-zero inside).')
+    region.add_argument('--point', type=float, nargs=2, action='append', metavar=('X', 'Y'),
+                        help='A pixel of the region on the first frame, segmented with SAM. Can be repeated.')
+    parser.add_argument('--reprompt-every', type=int, default=0,
+                        help='Find the region again with SAM every N frames. Default 0 (reuse the first mask).')
+    parser.add_argument('--output', type=Path, required=True, help='Directory for the output frames.')
+    parser.add_argument('--alpha', type=float, default=1.0, help='Stylization weight. Default 1.0.')
+    parser.add_argument('--batch-size', type=int, default=4, help='Frames per network forward. Default 4.')
+    parser.add_argument('--queue-size', type=int, default=8, help='Frames buffered between stages. Default 8.')
+    parser.add_argument('--style-size', type=int, default=512, help='Minimum style size, 0 to keep. Default 512.')
+    parser.add_argument('--no-preserve-color', dest='preserve_color', action='store_false',
+                        help='Do not preserve the colors of the content frames.')
+    parser.add_argument('--precision', choices=['fp32', 'bf16', 'int8'], default='fp32',
+                        help='Inference mode of the networks, int8 runs on the CPU. Default fp32.')
+    parser.add_argument('--channels-last', action='store_true', help='Use the channels_last memory format.')
+    parser.add_argument('--vgg', default='models/vgg_normalised.pth', help='Path to the vgg model.')
+    parser.add_argument('--decoder', default='models/decoder.pth', help='Path to the decoder model.')
+    args = parser.parse_args()
+
+    mask = None
+    if args.synthetic:
+        frames = synthetic_frames(args.synthetic)
+        if not args.point:
+            mask = box_mask(synthetic_box(0, 240, 320), 240, 320)
+    else:
+        frames = read_frames(args.frames)
+    if args.mask:
+        mask = np.asarray(Image.open(args.mask).convert('L')) > 0
+
+    run(frames, Image.open(args.style).convert('RGB'), args.output, mask, args.point, args.alpha, args.batch_size,
+        args.queue_size, args.reprompt_every, args.style_size, args.preserve_color, args.vgg, args.decoder,
+        args.precision, args.channels_last)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Load the models on a background thread while the user is still uploading images.
+
+`main.py` calls `start_warmup` on its first run. The thread imports torch, segment_anything and the stylization code,
+downloads missing checkpoints and loads SAM and the AdaIN engine into the process-wide caches (`load_sam` and
+`StyleTransferEngine.get`) that the segment and style pages use, so the first requests skip that cost. A page that
+needs a model before the warm-up has loaded it simply waits for it, as the caches compute each value only once.
+"""
+import logging
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+_thread: Optional[Thread] = None
+_thread_lock = Lock()
+
+
+def _download_models():
+    from segmentation import SAM_NAME, SAM_SHA256, SAM_URL
+    from stylization import VGG_NAME, VGG_SHA256, VGG_URL
+    from utils import get_models
+
+    # Fetch both checkpoints at once, each in parallel segments, before the `init` functions check for them
+    results = get_models({VGG_NAME: VGG_URL, SAM_NAME: SAM_URL}, sha256_digests={VGG_NAME: VGG_SHA256,
+                                                                                 SAM_NAME: SAM_SHA256}, segments=4)
+    for name, (success, message) in results.items():
+        if not success:
+            raise IOError(message)
+
+
+def _warm_up_stylization():
+    import torch
+    from stylization import StyleTransferEngine, init
+
+    init()
+    engine = StyleTransferEngine.get()
+    with torch.no_grad():  # The first forward pass sets up the kernels, so run it here too
+        engine.decoder(engine.vgg(torch.zeros(1, 3, 64, 64, device=engine.device, dtype=engine.dtype)))
+
+
+def _warm_up_segmentation():
+    from segmentation import init, load_sam
+
+    load_sam(*init())
+
+
+def warm_up():
+    """
+    Import the heavy modules, download the missing checkpoints concurrently and load the AdaIN engine and SAM.
+    A step that fails is logged and left to be done on first use, without affecting the others.
+    """
+    steps = (('Download', _download_models), ('AdaIN', _warm_up_stylization), ('SAM', _warm_up_segmentation))
+    for name, step in steps:
+        start = perf_counter()
+        try:
+            step()
+        except BaseException:  # `init` exits when a download fails
+            logger.exception(f'{name} warm-up failed, it will be done on first use')
+        else:
+            logger.info(f'{name} warm-up took {perf_counter() - start:.1f} s')
+
+
+def start_warmup() -> Thread:
+    """
+    Start `warm_up` on a daemon thread, once per process.
+    :return: The warm-up thread, the same one for every call.
+    """
+    global _thread
+    with _thread_lock:
+        if _thread is None:
+            _thread = Thread(target=warm_up, name='model-warmup', daemon=True)
+            _thread.start()
+        return _thread